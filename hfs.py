@@ -45,15 +45,197 @@ import gettext
 from datetime import datetime
 import traceback
 import thread
+import email.utils
+import contextlib
+import errno
+import select
+import asyncore
+import collections
+import Queue
+import heapq
+import itertools
+import json
+import io
+import hashlib
+import base64
+import binascii
+import zlib
+import struct
+import multiprocessing
+import bisect
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile # pysendfile package on python 2
+    except ImportError:
+        sendfile = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # scandir package on python 2
+    except ImportError:
+        scandir = None
+
+try:
+    import pyinotify # optional: invalidate cached listings as soon as they change
+except ImportError:
+    pyinotify = None
+
+try:
+    import xxhash # optional: a fast non-cryptographic digest
+except ImportError:
+    xxhash = None
+
+try:
+    import pwd, grp # owner names in tar archives; not on Windows
+except ImportError:
+    pwd = grp = None
+
+try:
+    from os import posix_fallocate # python 3.3 on posix systems
+except ImportError:
+    posix_fallocate = None
 
 TRANSMIT_CHUNK_SIZE = 1024
-RECEIVE_CHUNK_SIZE = 1024
+# the largest block handed to sendfile() in one call
+SENDFILE_CHUNK_SIZE = 1024 * 1024
+# bandwidth shaping: a throttled transfer moves about SHAPING_INTERVAL
+# seconds worth of data per write, but never less than TRANSMIT_CHUNK_SIZE
+SHAPING_INTERVAL = 0.1
+# requests with more ranges than this are answered with the whole file
+MAX_RANGES = 64
+# async engine: bytes buffered per connection and direction before the
+# event loop or the worker thread has to wait for the other side
+LOOP_BUFFER_SIZE = 256 * 1024
+# async engine: the largest request head read before it is dispatched
+LOOP_MAX_HEAD_SIZE = 64 * 1024
+# async engine: seconds a worker waits for the event loop before giving up
+LOOP_IO_TIMEOUT = 300
+# number of worker threads of the async engine when --workers is 0
+ASYNC_WORKERS = 16
+# threaded engine: how often a worker waiting for the next request of a
+# kept-alive connection checks whether connections are queued for a worker
+KEEPALIVE_POLL_INTERVAL = 0.2
+# seconds a client turned away with 503 is asked to wait
+RETRY_AFTER = 5
+# directory listings kept by the listing cache when --listing-cache-size is not given
+LISTING_CACHE_SIZE = 256
+# Without inotify a directory's mtime doesn't change when a file in it is
+# rewritten, so cached sizes and dates are trusted for at most this many
+# seconds. Directories modified within LISTING_CACHE_SETTLE seconds are not
+# cached at all, since another change in the same mtime tick would go unseen.
+LISTING_CACHE_MAX_AGE = 10
+LISTING_CACHE_SETTLE = 2
+# larger folders and pages are streamed without being kept in the listing cache
+LISTING_CACHE_MAX_ENTRIES = 10000
+LISTING_CACHE_MAX_PAGE = 512 * 1024
+# entries shown on one listing page when --listing-page-size is not given
+LISTING_PAGE_SIZE = 1000
+# streamed pages are written in pieces of about this size
+STREAM_FLUSH_SIZE = 16 * 1024
+# uploads: multipart bodies are read and searched in blocks of this size,
+# and the headers of a part may be at most MULTIPART_MAX_HEADER bytes
+MULTIPART_BLOCK_SIZE = 256 * 1024
+MULTIPART_MAX_HEADER = 16 * 1024
+# uploads are written to disk in blocks of this size by a writer thread,
+# while the next block is received; UPLOAD_FREE_BUFFERS blocks are kept
+# for the next uploads instead of being allocated again
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+UPLOAD_FREE_BUFFERS = 16
+# content digests: the algorithm of the digest sent with downloads when
+# --digest is not given, how many digests of shared files are kept, and
+# the longest a new digest waits to be saved
+DIGEST_ALGORITHM = "sha-256"
+DIGEST_CACHE_SIZE = 100000
+DIGEST_CACHE_SAVE_INTERVAL = 10
+# tar downloads are gzipped in blocks of this size on a pool of threads;
+# the level and the number of threads when --gzip-level and --gzip-workers
+# are not given
+GZIP_BLOCK_SIZE = 1024 * 1024
+GZIP_LEVEL = 6
+GZIP_WORKERS = multiprocessing.cpu_count()
+# --adaptive-gzip: how much faster the network or the compression must be
+# before the level is changed, the weight of the last block in the speed
+# estimates, and after how many blocks the estimate of a level is dropped
+GZIP_ADAPT_MARGIN = 0.1
+GZIP_ADAPT_WEIGHT = 0.3
+GZIP_ADAPT_MEMORY = 32
+# tar downloads are read ahead of the archiver by ARCHIVE_READERS threads, in
+# blocks of ARCHIVE_READ_BLOCK, at most ARCHIVE_READ_AHEAD bytes and
+# ARCHIVE_READ_AHEAD_FILES files ahead; ARCHIVE_SEND_QUEUE writes of the
+# compressed stream can wait for the network
+ARCHIVE_READERS = 4
+ARCHIVE_READ_BLOCK = 1024 * 1024
+ARCHIVE_READ_AHEAD = 16 * 1024 * 1024
+ARCHIVE_READ_AHEAD_FILES = 256
+ARCHIVE_SEND_QUEUE = 8
+# archive cache (--archive-cache): its size in MiB when --archive-cache-size
+# is not given, and how long an archive stays after it was used, in case it
+# is being sent
+ARCHIVE_CACHE_SIZE = 1024
+ARCHIVE_CACHE_GRACE = 60
+# file lists posted for archive downloads: how long one is kept after it
+# was last used when --download-ttl is not given, how many are kept when
+# --max-downloads is not given, the largest one and all of them together
+# (bytes of paths), the largest request body posting one, and how often
+# expired lists are removed
+DOWNLOAD_TTL = 3600
+DOWNLOAD_MAX_ENTRIES = 1000
+DOWNLOAD_MAX_ENTRY_SIZE = 256 * 1024
+DOWNLOAD_MAX_TOTAL_SIZE = 32 * 1024 * 1024
+DOWNLOAD_MAX_REQUEST = 4 * DOWNLOAD_MAX_ENTRY_SIZE
+DOWNLOAD_CLEANUP_INTERVAL = 60
+# resumable uploads: the session directory inside UPLOAD_PATH, the size of
+# the pieces the upload page sends, and how long an abandoned session is kept
+UPLOAD_SESSION_DIR = ".hfs-sessions"
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_TTL = 7 * 24 * 3600
+# the upload page gives up after this many failed attempts in a row
+UPLOAD_MAX_RETRIES = 10
+# upload page defaults: files uploaded at the same time, and pieces of one
+# file sent in parallel
+UPLOAD_CONCURRENCY = 2
+UPLOAD_STREAMS = 2
+# deduplicating upload store (--dedup): the directory inside UPLOAD_PATH,
+# the digest naming its objects, how often objects no uploaded file links
+# to any more are removed, and how old they must be
+UPLOAD_OBJECT_DIR = ".hfs-objects"
+UPLOAD_OBJECT_DIGEST = "sha-256"
+UPLOAD_OBJECT_SWEEP_INTERVAL = 3600
+UPLOAD_OBJECT_GRACE = 60
+
+ENGINE_THREADED = "threaded"
+ENGINE_ASYNC = "async"
+ENGINES = (ENGINE_THREADED, ENGINE_ASYNC)
 # the prefix to add before the root directory
 # For example, if PREFIX is "/root" and the host is 127.0.0.1, then
 # the root directory is http://127.0.0.1/root
 PREFIX = "/files"
 DOWNLOAD_TAR_PREFIX = "/download_tar"
+# archive formats offered by DOWNLOAD_TAR_PREFIX: file name and content type
+ARCHIVE_TGZ = "tgz"
+ARCHIVE_TAR = "tar"
+ARCHIVE_ZIP = "zip"
+ARCHIVE_FORMATS = collections.OrderedDict([
+    (ARCHIVE_TGZ, ("archive.tar.gz", "application/x-tar")),
+    (ARCHIVE_TAR, ("archive.tar", "application/x-tar")),
+    (ARCHIVE_ZIP, ("archive.zip", "application/zip"))])
 UPLOAD_PREFIX = "/upload"
+STATUS_PREFIX = "/status"
+
+# Kinds of responses that have their own Cache-Control policy.
+CACHE_FILE = "file"         # shared files
+CACHE_LISTING = "listing"   # directory listings
+CACHE_ARCHIVE = "archive"   # tar downloads
+CACHE_PAGE = "page"         # other pages (upload page, redirects, errors)
+CACHE_ROUTES = (CACHE_FILE, CACHE_LISTING, CACHE_ARCHIVE, CACHE_PAGE)
+# Files are revalidated with their ETag on every request; routes missing
+# from the table get the old no-cache/expired headers.
+DEFAULT_CACHE_CONTROL = {CACHE_FILE: "no-cache"}
 
 ###### Initialize Translations ######
 try:
@@ -71,6 +253,184 @@ def is_dir(path, AllowLink=False):
     """ Determine whether path is a directory, excluding symbolic links """
     return os.path.isdir(path) and (AllowLink or (not os.path.islink(path)))
 
+class FileEntry:
+    """ A directory entry with the information shown in listings. """
+
+    def __init__(self, name, path, st, is_link, AllowLink=False):
+        """ @param st the stat result of path, following symbolic links
+            @param AllowLink whether a link to a directory counts as one """
+        self.name = name
+        self.path = path
+        self.st = st
+        self.is_link = is_link
+        self.is_dir = stat.S_ISDIR(st.st_mode) and (AllowLink or not is_link)
+        self.is_file = stat.S_ISREG(st.st_mode)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.id = (st.st_dev, st.st_ino)
+
+    def to_json(self, path):
+        """ Describe the entry as a dict for the JSON listings. """
+        name = self.name
+        if isinstance(name, bytes):
+            name = name.decode(get_system_encoding() or "utf-8", "replace")
+        if isinstance(path, bytes):
+            path = path.decode(get_system_encoding() or "utf-8", "replace")
+        return {"name": name, "path": path,
+                "type": "dir" if self.is_dir else "file",
+                "size": self.size if self.is_file else None,
+                "mtime": self.mtime}
+
+def stat_entry(name, path, AllowLink=False):
+    """ Build the FileEntry of path, or return None if it doesn't exist. """
+    try:
+        st = os.lstat(path)
+        is_link = stat.S_ISLNK(st.st_mode)
+        if is_link:
+            st = os.stat(path)
+    except OSError: # vanished, or a broken link
+        return None
+    return FileEntry(name, path, st, is_link, AllowLink)
+
+def scan_dir(localpath, AllowLink=False):
+    """ Yield a FileEntry for every entry of a directory, in directory order.
+        With scandir the entry type comes with the listing, so each entry
+        costs one stat() call (two for symbolic links). Broken links and
+        entries that vanish during the scan are skipped. """
+    if scandir is None:
+        for name in os.listdir(localpath):
+            entry = stat_entry(name, os.path.join(localpath, name), AllowLink)
+            if entry is not None:
+                yield entry
+        return
+
+    for dirent in scandir(localpath):
+        try:
+            is_link = dirent.is_symlink()
+            st = dirent.stat() # follows links
+        except OSError:
+            continue
+        yield FileEntry(dirent.name, dirent.path, st, is_link, AllowLink)
+
+def walk_tree(path, localpath, AllowLink=False, read_entries=None):
+    """ Yield (path, FileEntry) for every file and folder below the folder
+        localpath, depth first with a stack instead of recursion, so that
+        the depth of the tree is not limited. path is the name of the folder
+        the yielded paths start with. The entries of a folder come in
+        directory order, before the contents of its subfolders. Folders are
+        entered only once on each branch, so symbolic links that loop back
+        are not followed again.
+        @param AllowLink whether links to folders are entered
+        @param read_entries a function (path, localpath) returning the
+        entries of a folder instead of scan_dir() """
+    if read_entries is None:
+        read_entries = lambda path, localpath: scan_dir(localpath, AllowLink)
+    try:
+        st = os.stat(localpath)
+        ancestors = frozenset([(st.st_dev, st.st_ino)])
+    except OSError: # the virtual root
+        ancestors = frozenset()
+    stack = [(path, localpath, ancestors)]
+    while stack:
+        vpath, lpath, ancestors = stack.pop()
+        subfolders = []
+        try:
+            for entry in read_entries(vpath, lpath):
+                if entry is None or not (entry.is_dir or entry.is_file):
+                    continue
+                path = posixpath.join(vpath, entry.name)
+                yield path, entry
+                if entry.is_dir and entry.id not in ancestors:
+                    subfolders.append((path, entry.path, ancestors | frozenset([entry.id])))
+        except OSError as e: # unreadable folder
+            DEBUG("walk_tree: " + str(e))
+        subfolders.reverse() # visit them in directory order
+        stack.extend(subfolders)
+
+def record_items(items, limit, on_complete, size=len):
+    """ Yield items, then call on_complete with the list of them once
+        they are exhausted, unless their total size was more than limit. """
+    kept = []
+    total = 0
+    for item in items:
+        if kept is not None:
+            kept.append(item)
+            total += size(item)
+            if total > limit:
+                kept = None # too large; stop keeping
+        yield item
+    if kept is not None:
+        on_complete(kept)
+
+LISTING_SORTS = ("name", "size", "mtime", "none")
+# values of the format parameter of listings, with their content types
+LISTING_FORMATS = {"html": "text/html", "json": "application/json",
+                   "ndjson": "application/x-ndjson"}
+
+class ListingView:
+    """ The part of a folder shown by a listing page: the entries from
+        offset on, at most limit of them (0: no limit), ordered by sort.
+        Directories come first unless sort is "none", which keeps the order
+        of the directory itself. """
+
+    def __init__(self, offset=0, limit=0, sort="name", reverse=False, default_limit=0):
+        self.offset = offset
+        self.limit = limit
+        self.sort = sort
+        self.reverse = reverse
+        self.default_limit = default_limit
+
+    def key(self):
+        return (self.offset, self.limit, self.sort, self.reverse)
+
+    def query(self, **changes):
+        """ Return the query string of this view with some fields changed.
+            Fields with their default values are left out. """
+        fields = {"offset": self.offset, "limit": self.limit,
+                  "sort": self.sort, "reverse": self.reverse}
+        fields.update(changes)
+        params = []
+        if fields["sort"] != "name":
+            params.append("sort=" + fields["sort"])
+        if fields["reverse"]:
+            params.append("order=desc")
+        if fields["offset"]:
+            params.append("offset=%d" % (fields["offset"]))
+        if fields["limit"] != self.default_limit:
+            params.append("limit=%d" % (fields["limit"]))
+        return "&".join(params)
+
+    def sort_key(self, entry):
+        size = entry.size if entry.is_file else 0
+        value = {"name": entry.name, "size": size, "mtime": entry.mtime}[self.sort]
+        # directories go first in both orders
+        return ((entry.is_dir if self.reverse else not entry.is_dir), value, entry.name)
+
+    def select(self, entries):
+        """ Return an iterator over the entries of this view, plus the next
+            one if there is one, to tell whether there is another page.
+            Sorting keeps no more than offset + limit entries in memory, and
+            with sort "none" entries are read only as far as they are shown. """
+        stop = self.offset + self.limit + 1 if self.limit else None
+        if self.sort != "none":
+            if stop is None:
+                entries = sorted(entries, key=self.sort_key, reverse=self.reverse)
+            elif self.reverse:
+                entries = heapq.nlargest(stop, entries, key=self.sort_key)
+            else:
+                entries = heapq.nsmallest(stop, entries, key=self.sort_key)
+        return itertools.islice(entries, self.offset, stop)
+
+    def page(self, entries):
+        """ Yield the entries of this view. Afterwards has_more tells
+            whether there is another page. """
+        self.has_more = False
+        for i, entry in enumerate(self.select(entries)):
+            if self.limit and i >= self.limit:
+                self.has_more = True
+                break
+            yield entry
+
 def prefix(path):
     """ Get the top-level folder in path.
         For example, the output for "/usr/bin/python" will be "/usr" """
@@ -125,13 +485,89 @@ def human_readable_size(nsize):
         return ("%(SIZE).1f " + _("KiB")) % {"SIZE": float(nsize) / K}
     return str(nsize) + " " + _("B")
 
-def multipart_boundary_length(content_type):
-    """ Parse the content-type field and return the boundary length. """
-    match = re.search(r'boundary=(--*[0-9a-z][0-9a-z]*)', content_type, re.I)
-    if match:
-        return len(match.group(1))
+def safe_filename(filename):
+    """ Strip the directories a client may send with the name of an uploaded
+        file. Returns None if nothing usable is left, or if the name is that
+        of a directory of the server. """
+    filename = filename.replace("\0", "").replace("\\", "/").split("/")[-1].strip()
+    if filename in ("", os.curdir, os.pardir, UPLOAD_SESSION_DIR, UPLOAD_OBJECT_DIR):
+        return None
+    return filename
+
+def safe_member_path(name):
+    """ Return the path, relative to the upload directory, that a member of
+        an uploaded archive is extracted to, or None if it would end up
+        outside of it or in a directory of the server. """
+    name = name.replace("\0", "").replace("\\", "/")
+    parts = [part for part in name.split("/") if part not in ("", os.curdir)]
+    if not parts or name.startswith("/") or os.pardir in parts or ":" in parts[0] \
+            or parts[0] in (UPLOAD_SESSION_DIR, UPLOAD_OBJECT_DIR):
+        return None
+    return os.path.join(*parts)
+
+def parse_byte_ranges(header, size):
+    """ Parse the value of a Range header for a resource of size bytes.
+        Returns a list of inclusive (first, last) pairs, an empty list if
+        none of the ranges can be satisfied, or None if the header is
+        malformed and should be ignored (RFC 7233). """
+    unit, sep, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not sep:
+        return None
+    specs = [spec.strip() for spec in specs.split(",") if spec.strip()]
+    if len(specs) == 0 or len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.partition("-")
+        first, last = first.strip(), last.strip()
+        if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if first == "": # suffix range: the last N bytes
+            if last == "":
+                return None
+            if int(last) > 0 and size > 0:
+                ranges.append((max(size - int(last), 0), size - 1))
+        else:
+            first = int(first)
+            if last != "" and int(last) < first: # invalid range
+                return None
+            last = (size - 1 if last == "" else min(int(last), size - 1))
+            if first < size:
+                ranges.append((first, last))
+    return ranges
+
+def make_etag(st):
+    """ Build an entity tag from the inode, size and mtime of a stat result.
+        The tag is weak if the file was modified within the last second,
+        because another write in the same second may leave it unchanged. """
+    tag = '"%x-%x-%x"' % (st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+    if time.time() - st.st_mtime < 1:
+        return "W/" + tag
+    return tag
+
+def etag_matches(header, etag, weak=True):
+    """ Check whether etag is listed in an If-Match/If-None-Match style header.
+        weak selects the weak comparison function of RFC 7232. """
+    if header.strip() == "*":
+        return True
+    if weak:
+        opaque = lambda tag: (tag[2:] if tag.startswith("W/") else tag)
+    elif etag.startswith("W/"):
+        return False
     else:
-        return 0
+        opaque = lambda tag: tag
+    for tag in header.split(","):
+        if opaque(tag.strip()) == opaque(etag):
+            return True
+    return False
+
+def parse_http_date(value):
+    """ Convert an HTTP date to seconds since the epoch, or None. """
+    try:
+        return email.utils.mktime_tz(email.utils.parsedate_tz(value))
+    except Exception:
+        return None
 
 def WRITE_LOG(message, client=None):
     t = time.localtime()
@@ -149,59 +585,2051 @@ def PRINT_DEBUG_MESSAGE(message):
     sys.stderr.write("DEBUG: %s\n" % (message))
 DEBUG = PRINT_DEBUG_MESSAGE
 
-class RateLimiter:
-    MAX_PRECISION = 0.1
-
-    def __init__(self, maxrate):
-        """ @param rate allowed calls to limit() per second; a value of 0
-                    means no limit.  """
-        if maxrate == 0:
-            self.limit = lambda: 0
+class TokenBucket:
+    """ A token bucket refilled with rate tokens (bytes) per second.
+        Callers may overdraw the bucket and repay the debt by waiting, so
+        concurrent callers are served in arrival order and get a fair share
+        of the rate as long as each one takes a quantum at a time. """
+
+    def __init__(self, rate=0):
+        """ @param rate tokens per second; a value of 0 means no limit. """
+        self.__lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.__lock:
+            self.rate = rate
+            self.__burst = max(rate * SHAPING_INTERVAL, 1)
+            self.__tokens = self.__burst
+            self.__stamp = time.time()
+
+    def reserve(self, amount):
+        """ Take amount tokens from the bucket.
+            Returns the number of seconds to wait before using them. """
+        if self.rate == 0:
+            return 0
+        with self.__lock:
+            now = time.time()
+            self.__tokens = min(self.__burst,
+                                self.__tokens + (now - self.__stamp) * self.rate)
+            self.__stamp = now
+            self.__tokens -= amount
+            if self.__tokens >= 0:
+                return 0
+            return -self.__tokens / self.rate
+
+class Throttle:
+    """ Bandwidth shaping of a single transfer.
+        Every block of data is charged to all buckets (server, client and
+        transfer) and the transfer waits for the slowest of them. """
+
+    def __init__(self, buckets, on_release=None):
+        """ @param on_release called when the last reference is released """
+        self.buckets = [b for b in buckets if b.rate != 0]
+        self.__refs = 1
+        self.__on_release = on_release
+        self.__lock = threading.Lock()
+        if self.buckets:
+            min_rate = min(b.rate for b in self.buckets)
+            self.quantum = int(min(max(min_rate * SHAPING_INTERVAL, TRANSMIT_CHUNK_SIZE),
+                                   SENDFILE_CHUNK_SIZE))
         else:
-            self.__period = 1.0 / maxrate
-            self.__prev_time = time.time()
-            self.__counter = 0
-            self.__counter_max = 0
-            self.limit = lambda: self.__call_limit()
+            self.quantum = SENDFILE_CHUNK_SIZE
+
+    def reserve(self, amount):
+        """ Charge amount bytes and return the seconds to wait. """
+        delay = 0
+        for bucket in self.buckets:
+            delay = max(delay, bucket.reserve(amount))
+        return delay
+
+    def wait(self, amount):
+        """ Charge amount bytes and block until they may be transferred. """
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+    def retain(self):
+        """ Keep the transfer open after its creator releases it, e.g. while
+            the event loop is still sending a deferred file body. """
+        with self.__lock:
+            self.__refs += 1
+
+    def release(self):
+        with self.__lock:
+            self.__refs -= 1
+            done = (self.__refs == 0)
+        if done and self.__on_release:
+            self.__on_release()
+
+class BandwidthShaper:
+    """ Shape the bandwidth of one direction (downloads or uploads) with a
+        server-wide cap, a cap per client address and a cap per transfer. """
+
+    def __init__(self, global_rate=0, client_rate=0):
+        self.__global_bucket = TokenBucket(global_rate)
+        self.__client_rate = client_rate
+        self.__clients = {} # map client address to [bucket, number of transfers]
+        self.__lock = threading.Lock()
+
+    def set_rates(self, global_rate, client_rate):
+        """ Set the server-wide and per-client rates in bytes/sec (0: no limit) """
+        self.__global_bucket.set_rate(global_rate)
+        with self.__lock:
+            self.__client_rate = client_rate
+            for bucket, count in self.__clients.values():
+                bucket.set_rate(client_rate)
+
+    @contextlib.contextmanager
+    def transfer(self, client, rate=0):
+        """ Open a Throttle for a transfer to/from client limited to rate
+            bytes/sec (0: no per-transfer limit). """
+        with self.__lock:
+            if client not in self.__clients:
+                self.__clients[client] = [TokenBucket(self.__client_rate), 0]
+            entry = self.__clients[client]
+            entry[1] += 1
+        throttle = Throttle([self.__global_bucket, entry[0], TokenBucket(rate)],
+                            lambda: self.__close_transfer(client, entry))
+        try:
+            yield throttle
+        finally:
+            throttle.release()
+
+    def __close_transfer(self, client, entry):
+        with self.__lock:
+            entry[1] -= 1
+            if entry[1] == 0 and self.__clients.get(client) is entry:
+                self.__clients.pop(client)
+
+class ChunkedWriter:
+    """ Encode the data written to file with the chunked transfer coding. """
+    def __init__(self, file):
+        self.__file = file
+
+    def write(self, data):
+        if data:
+            self.__file.write("%x\r\n%s\r\n" % (len(data), data))
+
+    def flush(self):
+        pass
 
-    def __call_limit(self):
-        self.__counter += 1
-        if self.__counter > self.__counter_max:
-            self.__counter = 0
-            interval = time.time() - self.__prev_time
-            min_interval = self.__period * (self.__counter_max + 1)
+    def close(self):
+        """ Write the last chunk. It does not close the underlying file. """
+        self.__file.write("0\r\n\r\n")
 
-            if interval < min_interval:
-                time.sleep(min_interval - interval)
+class UnframedWriter:
+    """ Pass the data through; used where the end of the connection marks
+        the end of the body. """
+    def __init__(self, file):
+        self.__file = file
+
+    def write(self, data):
+        self.__file.write(data)
+
+    def flush(self):
+        pass
 
-            if interval < self.MAX_PRECISION:
-                self.__counter_max += 1
-            elif interval > 2 * self.MAX_PRECISION and self.__counter_max > 0:
-                self.__counter_max -= 1
+    def close(self):
+        pass
+
+class QueuedWriter:
+    """ Write to file on a thread of its own, so that the writer goes on
+        while the data is sent. At most depth writes are waiting. """
+
+    def __init__(self, file, depth):
+        self.__file = file
+        self.__queue = Queue.Queue(depth)
+        self.__thread = None
+        self.__written = 0
+        self.__busy = 0.0 # seconds spent writing
+        self.error = None
 
-            self.__prev_time = time.time()
+    def get_stats(self):
+        """ Return the bytes written so far and the seconds it took. """
+        return self.__written, self.__busy
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        if not data:
+            return
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run)
+            self.__thread.daemon = True
+            self.__thread.start()
+        self.__queue.put(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """ Wait for the queued data to be written. It does not close the
+            underlying file; the error of a failed write is raised. """
+        if self.__thread is not None:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+        if self.error is not None:
+            raise self.error
+
+    def __run(self):
+        while True:
+            data = self.__queue.get()
+            if data is None:
+                return
+            if self.error is None: # the rest is dropped after an error
+                try:
+                    t0 = time.time()
+                    self.__file.write(data)
+                    self.__busy += time.time() - t0
+                    self.__written += len(data)
+                except Exception as e:
+                    self.error = e
 
 class RateLimitingWriter:
     """ Limit the writing rate to the file """
-    def __init__(self, file, maxrate):
+    def __init__(self, file, throttle):
         """ Constructor of RateLimitingWriter
             @param file the file object to be written to.
             It can be any object with write() method.
-            @param maxrate maximum bytes to write per second """
+            @param throttle the Throttle of the transfer """
         self.__file = file
-        self.__limiter = RateLimiter(maxrate)
+        self.__throttle = throttle
 
     def write(self, data):
+        quantum = self.__throttle.quantum
         length = len(data)
-        nleft = length
-        index = 0
-        while nleft > 0:
-            end = index + TRANSMIT_CHUNK_SIZE
-            end = (length if end > length else end)
-            self.__file.write(data[index:end])
-            nleft -= TRANSMIT_CHUNK_SIZE
-            index += TRANSMIT_CHUNK_SIZE
-            self.__limiter.limit()
+        if length <= quantum:
+            self.__throttle.wait(length)
+            self.__file.write(data)
+            return
+        for index in range(0, length, quantum):
+            block = data[index:index + quantum]
+            self.__throttle.wait(len(block))
+            self.__file.write(block)
+
+class CompressJob:
+    """ Raw deflate compression of one block of a ParallelGzipWriter. """
+
+    def __init__(self, data, level):
+        self.__data = data
+        self.level = level
+        self.length = len(data)
+        self.elapsed = 0 # seconds the compression took
+        self.__result = None
+        self.__error = None
+        self.__done = threading.Event()
+
+    def run(self):
+        try:
+            t0 = time.time()
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.__result = c.compress(self.__data) + c.flush(zlib.Z_SYNC_FLUSH)
+            self.elapsed = time.time() - t0
+        except Exception as e:
+            self.__error = e
+        finally:
+            self.__data = None
+            self.__done.set()
+
+    def get_result(self):
+        """ Wait for the compressed block and return it. """
+        self.__done.wait()
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+class GzipStats:
+    """ The gzip levels tar downloads are compressed with, for STATUS_PREFIX. """
+
+    def __init__(self):
+        self.level = None # of the last block
+        self.__blocks = collections.defaultdict(int)
+        self.__lock = threading.Lock()
+
+    def add(self, level):
+        with self.__lock:
+            self.level = level
+            self.__blocks[level] += 1
+
+    def get_blocks(self):
+        """ Return (level, blocks compressed with it) pairs. """
+        with self.__lock:
+            return sorted(self.__blocks.items())
+
+class AdaptiveGzipLevel:
+    """ Chooses the gzip level of the blocks of a tar download, from 0
+        (stored) to 9, to send the most archive data per second. It keeps
+        estimates of the speed and ratio of each level used on the last
+        GZIP_ADAPT_MEMORY blocks, and of the speed of the network (the
+        compressed bytes per second the sender takes). If the network takes
+        the data slower than it is compressed, one level higher is tried;
+        if the compression is slower, one level lower. Levels estimated to
+        be worse than the current one are not tried again until their
+        estimate is dropped. The level changes at block boundaries. """
+
+    def __init__(self, level, workers, sender, client=None):
+        """ @param workers the threads compressing blocks at the same time
+            @param sender a QueuedWriter sending the compressed stream """
+        self.level = level
+        self.__workers = max(workers, 1)
+        self.__sender = sender
+        self.__client = client
+        self.__blocks = 0
+        self.__estimates = {} # level: (bytes/s of a worker, ratio, block)
+        self.__network = None # compressed bytes per second
+        self.__sent = (0, 0.0) # sender stats of the last network estimate
+
+    def update(self, level, length, compressed, elapsed):
+        """ Account for a block compressed at level and choose the next level. """
+        if length == 0:
+            return
+        self.__blocks += 1
+        speed = length / max(elapsed, 1e-6)
+        ratio = float(compressed) / length
+        estimate = self.__get_estimate(level)
+        if estimate is not None:
+            w = GZIP_ADAPT_WEIGHT
+            speed = (1 - w) * estimate[0] + w * speed
+            ratio = (1 - w) * estimate[1] + w * ratio
+        self.__estimates[level] = (speed, ratio, self.__blocks)
+
+        network = self.__update_network()
+        if network is None or level != self.level:
+            return
+        compression = self.__workers * speed
+        transfer = network / ratio # uncompressed bytes per second
+        if transfer < compression * (1 - GZIP_ADAPT_MARGIN) and level < 9:
+            candidate = level + 1
+        elif compression < transfer * (1 - GZIP_ADAPT_MARGIN) and level > 0:
+            candidate = level - 1
+        else:
+            return
+        if self.__get_estimate(candidate) is not None \
+                and self.__predict(candidate, network) <= self.__predict(level, network):
+            return
+        WRITE_LOG(_("Gzip level %(OLD)d -> %(NEW)d (network %(NET)s/s, compression %(CPU)s/s)")
+                  % {"OLD": level, "NEW": candidate,
+                     "NET": human_readable_size(network),
+                     "CPU": human_readable_size(compression * ratio)}, self.__client)
+        self.level = candidate
+
+    def __update_network(self):
+        """ Estimate the speed of the network from the data sent since the
+            last estimate, once it is at least a block. """
+        written, busy = self.__sender.get_stats()
+        length, elapsed = written - self.__sent[0], busy - self.__sent[1]
+        if length >= GZIP_BLOCK_SIZE and elapsed > 0:
+            speed = length / elapsed
+            if self.__network is not None:
+                w = GZIP_ADAPT_WEIGHT
+                speed = (1 - w) * self.__network + w * speed
+            self.__network = speed
+            self.__sent = (written, busy)
+        return self.__network
+
+    def __get_estimate(self, level):
+        estimate = self.__estimates.get(level)
+        if estimate is None or self.__blocks - estimate[2] > GZIP_ADAPT_MEMORY:
+            return None
+        return estimate
+
+    def __predict(self, level, network):
+        """ The uncompressed bytes per second sent at level. """
+        speed, ratio, block = self.__estimates[level]
+        return min(self.__workers * speed, network / ratio)
+
+class ParallelGzipWriter:
+    """ Write a gzip stream to file, compressing blocks of GZIP_BLOCK_SIZE
+        on a WorkerPool like pigz. Every block is compressed on its own and
+        ends with a sync flush, so the compressed blocks can simply be
+        joined in order; close() adds an empty final block and the gzip
+        trailer. The CRC is computed as the data is written. At most
+        in_flight blocks of the stream are waiting or being compressed;
+        without a pool, blocks are compressed as they are written. """
+
+    def __init__(self, file, pool, level=GZIP_LEVEL, in_flight=2, adapter=None, stats=None):
+        """ @param adapter an AdaptiveGzipLevel choosing the level of each block
+            @param stats a GzipStats counting the blocks of each level """
+        self.__file = file
+        self.__pool = pool
+        self.__level = level
+        self.__in_flight = in_flight
+        self.__adapter = adapter
+        self.__stats = stats
+        self.__buffer = []
+        self.__buffered = 0
+        self.__jobs = collections.deque()
+        self.__crc = 0
+        self.__length = 0
+        # magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        self.__file.write("\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+
+    def write(self, data):
+        if not data:
+            return
+        self.__crc = zlib.crc32(data, self.__crc)
+        self.__length += len(data)
+        self.__buffer.append(data)
+        self.__buffered += len(data)
+        if self.__buffered >= GZIP_BLOCK_SIZE:
+            self.__submit()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """ Write the rest of the stream. It does not close the underlying file. """
+        if self.__buffered:
+            self.__submit()
+        while self.__jobs:
+            self.__write_block()
+        self.__file.write("\x03\x00") # empty final block
+        self.__file.write(struct.pack("<II", self.__crc & 0xffffffff,
+                                      self.__length & 0xffffffff))
+
+    def __submit(self):
+        level = (self.__adapter.level if self.__adapter is not None else self.__level)
+        if self.__stats is not None:
+            self.__stats.add(level)
+        job = CompressJob("".join(self.__buffer), level)
+        self.__buffer = []
+        self.__buffered = 0
+        if self.__pool is None or not self.__pool.submit(job.run):
+            job.run()
+        self.__jobs.append(job)
+        while len(self.__jobs) > self.__in_flight:
+            self.__write_block()
+
+    def __write_block(self):
+        job = self.__jobs.popleft()
+        result = job.get_result()
+        if self.__adapter is not None:
+            self.__adapter.update(job.level, job.length, len(result), job.elapsed)
+        self.__file.write(result)
+
+class ArchiveMember:
+    """ A regular file put in an archive. """
+
+    def __init__(self, name, path, st):
+        """ @param name the name of the file in the archive
+            @param st the stat result of path, following symbolic links """
+        self.name = name
+        self.path = path
+        self.st = st
+        self.size = st.st_size
+
+class VirtualArchive:
+    """ An uncompressed archive that is laid out before it is sent, so that
+        its size is known and any byte range of it can be produced.
+        The layout is a list of pieces, each a string, a function returning
+        the string (called only if the piece is sent) or an ArchiveMember
+        whose data is copied from its file. """
+
+    def __init__(self, format, members):
+        self.members = members
+        self.size = 0
+        self.mtime = max([m.st.st_mtime for m in members] or [0])
+        self.__offsets = []
+        self.__pieces = []
+        # a strong tag unless a member was modified within the last second,
+        # like make_etag(), so that If-Range can resume the download; the
+        # mode and owner are in the headers, so they are part of it too
+        h = hashlib.sha1(format)
+        for m in members:
+            h.update("%s\0%x-%x-%x-%o-%d-%d\0" % (m.name, m.st.st_ino, m.size,
+                                                int(m.st.st_mtime * 1000000),
+                                                m.st.st_mode, m.st.st_uid, m.st.st_gid))
+        self.etag = '"%s-%s"' % (format, h.hexdigest())
+        if time.time() - self.mtime < 1:
+            self.etag = "W/" + self.etag
+
+    def add(self, source, length=None):
+        if length is None:
+            length = len(source)
+        if length > 0:
+            self.__offsets.append(self.size)
+            self.__pieces.append((length, source))
+            self.size += length
+
+    def iter_pieces(self, offset, length):
+        """ Yield (source, start, count) for the pieces of length bytes of
+            the archive from offset; start is the offset in the piece. """
+        end = offset + length
+        index = max(bisect.bisect_right(self.__offsets, offset) - 1, 0)
+        while offset < end and index < len(self.__pieces):
+            piece_length, source = self.__pieces[index]
+            start = offset - self.__offsets[index]
+            count = min(piece_length - start, end - offset)
+            yield source, start, count
+            offset += count
+            index += 1
+
+TAR_OWNER_NAMES = {}
+
+def make_tarinfo(name, st):
+    """ Build the TarInfo of a regular file from its stat result, like
+        TarFile.gettarinfo() does but without another stat() call. """
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.size = st.st_size
+    info.mtime = int(st.st_mtime)
+    owner = (st.st_uid, st.st_gid)
+    names = TAR_OWNER_NAMES.get(owner)
+    if names is None:
+        names = ["", ""]
+        try:
+            names[0] = pwd.getpwuid(st.st_uid)[0]
+        except (AttributeError, KeyError): # no pwd module, or no such user
+            pass
+        try:
+            names[1] = grp.getgrgid(st.st_gid)[0]
+        except (AttributeError, KeyError):
+            pass
+        TAR_OWNER_NAMES[owner] = names
+    info.uname, info.gname = names
+    return info
+
+class TarArchive(VirtualArchive):
+    """ A tar archive in the format written by the tarfile module. """
+
+    def __init__(self, members):
+        VirtualArchive.__init__(self, ARCHIVE_TAR, members)
+        tar = tarfile.TarFile(fileobj=io.BytesIO(), mode="w", dereference=True)
+        for m in members:
+            info = make_tarinfo(m.name, m.st)
+            self.add(info.tobuf(tar.format, tar.encoding, tar.errors))
+            self.add(m, m.size)
+            self.add(tarfile.NUL * (-m.size % tarfile.BLOCKSIZE))
+        self.add(tarfile.NUL * (2 * tarfile.BLOCKSIZE)) # end of archive
+        self.add(tarfile.NUL * (-self.size % tarfile.RECORDSIZE))
+
+ZIP_LIMIT = 0xffffffff # sizes and offsets from this on need ZIP64 fields
+ZIP_MAX_ENTRIES = 0xffff
+
+def zip_dos_time(mtime):
+    """ Return the MS-DOS time and date of a zip entry. """
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1 # 1980-01-01
+    if t.tm_year > 2107:
+        return (23 << 11) | (59 << 5) | 29, (127 << 9) | (12 << 5) | 31
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+class ZipArchive(VirtualArchive):
+    """ A zip archive of stored (uncompressed) files. The CRC of a file is
+        in its local header, as many unzip tools expect, so get_crc(member)
+        is called when the header is sent. ZIP64 fields are used only for
+        the members and records that need them. """
+
+    def __init__(self, members, get_crc):
+        VirtualArchive.__init__(self, ARCHIVE_ZIP, members)
+        self.__get_crc = get_crc
+        self.__entries = []
+        for m in members:
+            name = m.name
+            flags = 0
+            try:
+                name.decode("ascii")
+            except UnicodeDecodeError:
+                try:
+                    name.decode("utf-8")
+                    flags |= 0x800 # the name is utf-8
+                except UnicodeDecodeError:
+                    pass
+            entry = (m, name, flags, self.size)
+            self.__entries.append(entry)
+            header_length = 30 + len(name) + (20 if m.size >= ZIP_LIMIT else 0)
+            self.add(lambda entry=entry: self.__local_header(*entry), header_length)
+            self.add(m, m.size)
+
+        directory_offset = self.size
+        directory_length = 0
+        for m, name, flags, offset in self.__entries:
+            fields = self.__zip64_fields(m, offset)
+            directory_length += 46 + len(name) + (4 + 8 * len(fields) if fields else 0)
+        zip64 = (len(members) >= ZIP_MAX_ENTRIES or directory_offset >= ZIP_LIMIT
+                 or directory_length >= ZIP_LIMIT)
+        end_length = (56 + 20 if zip64 else 0) + 22
+        self.add(lambda: self.__central_directory(directory_offset, directory_length, zip64),
+                 directory_length + end_length)
+
+    @staticmethod
+    def __zip64_fields(m, offset):
+        fields = []
+        if m.size >= ZIP_LIMIT:
+            fields += [m.size, m.size]
+        if offset >= ZIP_LIMIT:
+            fields.append(offset)
+        return fields
+
+    def __local_header(self, m, name, flags, offset):
+        dostime, dosdate = zip_dos_time(m.st.st_mtime)
+        crc = self.__get_crc(m)
+        if m.size >= ZIP_LIMIT:
+            extra = struct.pack("<HHQQ", 1, 16, m.size, m.size)
+            version, size = 45, ZIP_LIMIT
+        else:
+            extra = ""
+            version, size = 20, m.size
+        return struct.pack("<IHHHHHIIIHH", 0x04034b50, version, flags, 0, dostime, dosdate,
+                           crc, size, size, len(name), len(extra)) + name + extra
+
+    def __central_directory(self, directory_offset, directory_length, zip64):
+        records = []
+        for m, name, flags, offset in self.__entries:
+            dostime, dosdate = zip_dos_time(m.st.st_mtime)
+            fields = self.__zip64_fields(m, offset)
+            if fields:
+                extra = struct.pack("<HH", 1, 8 * len(fields)) \
+                    + struct.pack("<%dQ" % len(fields), *fields)
+                version = 45
+            else:
+                extra = ""
+                version = 20
+            size = min(m.size, ZIP_LIMIT)
+            records.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | version,
+                                       version, flags, 0, dostime, dosdate, self.__get_crc(m),
+                                       size, size, len(name), len(extra), 0, 0, 0,
+                                       (m.st.st_mode & 0xffff) << 16, min(offset, ZIP_LIMIT)))
+            records.append(name + extra)
+        count = len(self.__entries)
+        if zip64:
+            end_offset = directory_offset + directory_length
+            records.append(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0,
+                                       count, count, directory_length, directory_offset))
+            records.append(struct.pack("<IIQI", 0x07064b50, 0, end_offset, 1))
+        records.append(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, min(count, ZIP_MAX_ENTRIES),
+                                   min(count, ZIP_MAX_ENTRIES),
+                                   min(directory_length, ZIP_LIMIT),
+                                   min(directory_offset, ZIP_LIMIT), 0))
+        return "".join(records)
+
+class ReadAheadFile:
+    """ A file of an ArchiveReadAhead. info is its TarInfo, or None if it
+        could not be opened; blocks are read and not archived yet. """
+
+    def __init__(self, member):
+        self.member = member
+        self.info = None
+        self.blocks = collections.deque()
+        self.done = False # all of it is in blocks
+
+class ArchiveReadAhead:
+    """ Reads the files of a tar download ahead of the archiver, so that
+        opening and reading many small files overlaps with compressing and
+        sending. A walker thread lists the members and reader threads take
+        the files in order and read them in blocks, at most read_ahead
+        bytes and max_files files ahead of the archiver. The file being
+        archived is always read, so the readers can't all end up waiting
+        for the archiver to make room. """
+
+    def __init__(self, members, readers=ARCHIVE_READERS, read_ahead=ARCHIVE_READ_AHEAD,
+                 max_files=ARCHIVE_READ_AHEAD_FILES):
+        """ @param members an iterable of ArchiveMembers, walked on a thread """
+        self.changed = False # a file changed since it was listed
+        self.__tar = tarfile.TarFile(fileobj=io.BytesIO(), mode="w", dereference=True)
+        self.__read_ahead = read_ahead
+        self.__max_files = max_files
+        self.__cond = threading.Condition()
+        self.__files = collections.deque()  # not archived yet
+        self.__unread = collections.deque() # not taken by a reader yet
+        self.__buffered = 0
+        self.__walking = True
+        self.__closed = False
+        self.__error = None
+        threads = [threading.Thread(target=self.__walk, args=(members,))]
+        threads += [threading.Thread(target=self.__read) for i in range(readers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+    def close(self):
+        """ Stop the threads; the blocks read ahead are dropped. """
+        with self.__cond:
+            self.__closed = True
+            self.__files.clear()
+            self.__unread.clear()
+            self.__cond.notify_all()
+
+    def write_tar(self, out):
+        """ Write the files to out as a tar archive, in the format tarfile
+            writes. Returns the length of the archive. """
+        tar = self.__tar
+        length = 0
+        for rf in self.__iter_files():
+            info = self.__wait_info(rf)
+            if info is None:
+                continue
+            DEBUG("send_tar: add file " + rf.member.path)
+            header = info.tobuf(tar.format, tar.encoding, tar.errors)
+            out.write(header)
+            for block in self.__iter_blocks(rf):
+                out.write(block)
+            padding = -info.size % tarfile.BLOCKSIZE
+            out.write(tarfile.NUL * padding)
+            length += len(header) + info.size + padding
+        # two zero blocks, padded to a whole record
+        end = 2 * tarfile.BLOCKSIZE + (-(length + 2 * tarfile.BLOCKSIZE) % tarfile.RECORDSIZE)
+        out.write(tarfile.NUL * end)
+        return length + end
+
+    def __iter_files(self):
+        while True:
+            with self.__cond:
+                while not self.__files and self.__walking:
+                    self.__cond.wait()
+                if not self.__files:
+                    if self.__error is not None:
+                        raise self.__error
+                    return
+                rf = self.__files[0]
+            yield rf
+            with self.__cond:
+                self.__files.popleft()
+                self.__buffered -= sum(len(block) for block in rf.blocks)
+                rf.blocks.clear()
+                self.__cond.notify_all()
+
+    def __wait_info(self, rf):
+        with self.__cond:
+            while rf.info is None and not rf.done:
+                self.__cond.wait()
+            return rf.info
+
+    def __iter_blocks(self, rf):
+        while True:
+            with self.__cond:
+                while not rf.blocks and not rf.done:
+                    self.__cond.wait()
+                if not rf.blocks:
+                    return
+                block = rf.blocks.popleft()
+                self.__buffered -= len(block)
+                self.__cond.notify_all()
+            yield block
+
+    def __walk(self, members):
+        try:
+            for member in members:
+                rf = ReadAheadFile(member)
+                with self.__cond:
+                    while len(self.__files) >= self.__max_files and not self.__closed:
+                        self.__cond.wait()
+                    if self.__closed:
+                        return
+                    self.__files.append(rf)
+                    self.__unread.append(rf)
+                    self.__cond.notify_all()
+        except Exception as e: # listing a directory failed
+            DEBUG("send_tar: " + str(e))
+            self.__error = e
+        finally:
+            with self.__cond:
+                self.__walking = False
+                self.__cond.notify_all()
+
+    def __read(self):
+        while True:
+            with self.__cond:
+                while not self.__unread and self.__walking and not self.__closed:
+                    self.__cond.wait()
+                if not self.__unread:
+                    return
+                rf = self.__unread.popleft()
+            try:
+                self.__read_file(rf)
+            finally:
+                with self.__cond:
+                    rf.done = True
+                    self.__cond.notify_all()
+
+    def __read_file(self, rf):
+        try:
+            f = open(rf.member.path, "rb")
+        except (IOError, OSError) as e:
+            DEBUG("send_tar: " + str(e))
+            self.changed = True
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if DigestCache.key(st) != DigestCache.key(rf.member.st):
+                self.changed = True
+            info = make_tarinfo(rf.member.name, st)
+            with self.__cond:
+                rf.info = info
+                self.__cond.notify_all()
+            left = info.size
+            while left > 0:
+                with self.__cond:
+                    while self.__buffered >= self.__read_ahead and not self.__closed \
+                            and self.__files and self.__files[0] is not rf:
+                        self.__cond.wait()
+                    if self.__closed:
+                        return
+                try:
+                    block = f.read(min(ARCHIVE_READ_BLOCK, left))
+                except (IOError, OSError) as e:
+                    DEBUG("send_tar: " + str(e))
+                    block = ""
+                if not block: # the size in the header is sent anyway
+                    DEBUG("send_tar: %s changed, padding it" % (rf.member.path))
+                    self.changed = True
+                    block = tarfile.NUL * min(ARCHIVE_READ_BLOCK, left)
+                left -= len(block)
+                with self.__cond:
+                    rf.blocks.append(block)
+                    self.__buffered += len(block)
+                    self.__cond.notify_all()
+
+class CachedArchive(VirtualArchive):
+    """ An archive of members sent from its copy in the ArchiveCache. The
+        tag names the copy, as another copy of the same files may differ;
+        copies are never changed in place, only replaced. """
+
+    def __init__(self, format, members, path, st):
+        VirtualArchive.__init__(self, format, members)
+        self.etag = '"%s-%x-%x"' % (suffix(path), st.st_ino, st.st_size)
+        self.add(ArchiveMember(suffix(path), path, st), st.st_size)
+
+class ArchiveCache:
+    """ Generated archives kept in a directory, so that a selection that is
+        downloaded again is sent from disk, with sendfile() and byte ranges,
+        instead of being compressed again. An archive is named by a key made
+        from the format and the paths, devices, inodes, sizes, mtimes, modes
+        and owners of its files, so that a file replaced by another with the
+        same size and mtime is not taken for it. When the cache is larger
+        than max_size bytes the least recently used are removed, except those
+        used within ARCHIVE_CACHE_GRACE seconds. The order of use is kept in
+        the access times of the files. """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict() # key: (size, last use), oldest first
+        self.__size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        found = []
+        for entry in scan_dir(directory):
+            if entry.name.endswith(".tmp"): # left by a download that was cut
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            elif entry.is_file:
+                found.append((entry.st.st_atime, entry.name, entry.size))
+        for atime, key, size in sorted(found):
+            self.__entries[key] = (size, 0)
+            self.__size += size
+        self.__evict()
+
+    @staticmethod
+    def accepts(members):
+        """ Whether an archive of members may be cached; see DigestCache.accepts(). """
+        return all(DigestCache.accepts(m.st) for m in members)
+
+    @staticmethod
+    def key(format, members, options=""):
+        """ Return the key of an archive of members. options are the other
+            settings the archive depends on. """
+        h = hashlib.sha1("%s\0%s\0" % (format, options))
+        for m in members:
+            h.update("%s\0%s\0%x-%x-%x-%x-%o-%d-%d\0" % (m.name, m.path,
+                                                         m.st.st_dev, m.st.st_ino, m.size,
+                                                         int(m.st.st_mtime * 1000000),
+                                                         m.st.st_mode, m.st.st_uid, m.st.st_gid))
+        return "%s-%s" % (format, h.hexdigest())
+
+    def get(self, key):
+        """ Return (path, stat result) of the cached archive of key, or None. """
+        path = os.path.join(self.directory, key)
+        with self.__lock:
+            if key not in self.__entries:
+                self.misses += 1
+                return None
+        try:
+            st = os.stat(path)
+            os.utime(path, (time.time(), st.st_mtime))
+        except OSError: # removed by hand
+            with self.__lock:
+                entry = self.__entries.pop(key, None)
+                if entry is not None:
+                    self.__size -= entry[0]
+                self.misses += 1
+            return None
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__entries[key] = (entry[0], time.time())
+            self.hits += 1
+        return path, st
+
+    def create_temp(self, key):
+        """ Return (path, file) of a new temporary file for the archive of key. """
+        path = os.path.join(self.directory, "%s.%s.tmp" % (key, uuid.uuid4().hex))
+        return path, open(path, "wb")
+
+    def add(self, key, temp_path):
+        """ Keep the complete archive temp_path as the archive of key. """
+        size = os.path.getsize(temp_path)
+        if size > self.max_size:
+            os.remove(temp_path)
+            return
+        replace_file(temp_path, os.path.join(self.directory, key))
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__size -= entry[0]
+            self.__entries[key] = (size, time.time())
+            self.__size += size
+        self.__evict()
+
+    def get_size(self):
+        with self.__lock:
+            return self.__size
+
+    def __evict(self):
+        now = time.time()
+        removed = []
+        with self.__lock:
+            while self.__size > self.max_size and self.__entries:
+                key, (size, last_use) = next(iter(self.__entries.items()))
+                if now - last_use < ARCHIVE_CACHE_GRACE:
+                    break # the others were used later
+                del self.__entries[key]
+                self.__size -= size
+                removed.append(key)
+        for key in removed:
+            DEBUG("Archive Cache: remove " + key)
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except OSError:
+                pass
+
+class ArchiveCacheWriter:
+    """ Pass an archive being generated to file and write a copy of it for
+        the ArchiveCache. The copy is given up if it grows larger than the
+        cache or can't be written. """
+
+    def __init__(self, file, cache, key):
+        self.__file = file
+        self.__cache = cache
+        self.__key = key
+        self.__length = 0
+        try:
+            self.__temp_path, self.__copy = cache.create_temp(key)
+        except (IOError, OSError) as e:
+            DEBUG("Archive Cache: " + str(e))
+            self.__temp_path, self.__copy = None, None
+
+    def write(self, data):
+        self.__file.write(data)
+        if self.__copy is None:
+            return
+        self.__length += len(data)
+        try:
+            if self.__length > self.__cache.max_size:
+                raise IOError("%s: larger than the archive cache" % (self.__key))
+            self.__copy.write(data)
+        except (IOError, OSError) as e:
+            DEBUG("Archive Cache: " + str(e))
+            self.discard()
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        """ Add the copy to the cache once the archive is complete. """
+        if self.__copy is None:
+            return
+        copy, temp_path = self.__copy, self.__temp_path
+        self.__copy = self.__temp_path = None
+        try:
+            copy.close()
+            self.__cache.add(self.__key, temp_path)
+        except (IOError, OSError) as e:
+            DEBUG("Archive Cache: " + str(e))
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def discard(self):
+        """ Drop the copy, for an archive that was not completed. """
+        if self.__copy is not None:
+            self.__copy.close()
+            self.__copy = None
+        if self.__temp_path is not None:
+            try:
+                os.remove(self.__temp_path)
+            except OSError:
+                pass
+            self.__temp_path = None
+
+def file_crc32(path, size):
+    """ Return the CRC-32 of the first size bytes of a file, as they are
+        sent in an archive: a file that got shorter is padded with zeros. """
+    crc = 0
+    left = size
+    try:
+        with open(path, "rb") as f:
+            while left > 0:
+                data = f.read(min(SENDFILE_CHUNK_SIZE, left))
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                left -= len(data)
+    except (IOError, OSError) as e:
+        DEBUG("file_crc32: " + str(e))
+    while left > 0:
+        count = min(SENDFILE_CHUNK_SIZE, left)
+        crc = zlib.crc32("\0" * count, crc)
+        left -= count
+    return crc & 0xffffffff
+
+class DownloadStore:
+    """ File lists posted for archive downloads, by download id. A list is
+        dropped ttl seconds after it was last used, by a timer running while
+        there are lists; the least recently used are dropped first when there
+        are more than max_entries lists or their paths take more than
+        DOWNLOAD_MAX_TOTAL_SIZE bytes. """
+
+    def __init__(self, ttl=DOWNLOAD_TTL, max_entries=DOWNLOAD_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.expired = 0 # dropped for the ttl or the limits
+        self.__entries = collections.OrderedDict() # id: (list, size, last use), oldest first
+        self.__size = 0
+        self.__lock = threading.Lock()
+        self.__timer = None
+
+    def push(self, id, fileList):
+        """ Keep fileList as the list of id. Returns False if it is too large. """
+        size = sum(len(path) for path in fileList)
+        if size > DOWNLOAD_MAX_ENTRY_SIZE:
+            return False
+        with self.__lock:
+            self.__remove(id)
+            self.__entries[id] = (fileList, size, time.time())
+            self.__size += size
+            while (len(self.__entries) > self.max_entries
+                   or self.__size > DOWNLOAD_MAX_TOTAL_SIZE):
+                self.__remove(next(iter(self.__entries)))
+                self.expired += 1
+            if self.__timer is None:
+                self.__start_timer()
+        return True
+
+    def peek(self, id):
+        """ Return the list of id, or [] if there is none, and keep it for
+            another ttl seconds. """
+        with self.__lock:
+            entry = self.__get(id)
+            if entry is None:
+                return []
+            del self.__entries[id]
+            self.__entries[id] = (entry[0], entry[1], time.time()) # most recently used
+            return entry[0]
+
+    def pop(self, id):
+        """ Return and remove the list of id, or [] if there is none. """
+        with self.__lock:
+            entry = self.__get(id)
+            if entry is None:
+                return []
+            self.__remove(id)
+            return entry[0]
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def expire(self):
+        """ Drop the lists not used for ttl seconds. """
+        now = time.time()
+        with self.__lock:
+            while self.__entries:
+                id, (fileList, size, last_use) = next(iter(self.__entries.items()))
+                if now - last_use < self.ttl:
+                    break # the others were used later
+                self.__remove(id)
+                self.expired += 1
+
+    def __get(self, id):
+        """ Return the entry of id, or None if there is none or it expired;
+            the caller holds the lock. """
+        entry = self.__entries.get(id)
+        if entry is None:
+            return None
+        if time.time() - entry[2] >= self.ttl:
+            self.__remove(id)
+            self.expired += 1
+            return None
+        return entry
+
+    def __remove(self, id):
+        entry = self.__entries.pop(id, None)
+        if entry is not None:
+            self.__size -= entry[1]
+
+    def __start_timer(self):
+        self.__timer = threading.Timer(min(self.ttl, DOWNLOAD_CLEANUP_INTERVAL), self.__cleanup)
+        self.__timer.daemon = True
+        self.__timer.start()
+
+    def __cleanup(self):
+        self.expire()
+        with self.__lock:
+            self.__timer = None
+            if self.__entries:
+                self.__start_timer()
+
+class MultipartError(ValueError):
+    pass
+
+# digest algorithms by their names in Repr-Digest (RFC 9530)
+DIGEST_ALGORITHMS = collections.OrderedDict([("sha-256", hashlib.sha256),
+                                             ("sha-512", hashlib.sha512)])
+if xxhash is not None:
+    DIGEST_ALGORITHMS["xxh64"] = xxhash.xxh64
+
+def parse_digest_header(value):
+    """ Parse a Repr-Digest header (sha-256=:base64:) or a legacy Digest
+        header (SHA-256=base64) into a dict mapping algorithm names to raw
+        digests. Unknown algorithms are left out; returns None if a digest
+        of a known one is malformed. """
+    digests = {}
+    for item in value.split(","):
+        name, sep, digest = item.partition("=")
+        name = name.strip().lower()
+        if not sep or name not in DIGEST_ALGORITHMS:
+            continue
+        digest = digest.split(";")[0].strip()
+        if len(digest) >= 2 and digest.startswith(":") and digest.endswith(":"):
+            digest = digest[1:-1]
+        try:
+            digests[name] = base64.b64decode(digest)
+        except (TypeError, ValueError):
+            return None
+        if len(digests[name]) != DIGEST_ALGORITHMS[name]().digest_size:
+            return None
+    return digests
+
+def get_expected_digests(headers):
+    """ Return the digests announced in the Repr-Digest or Digest header of
+        a request or of a multipart part: {} if there are none, None if they
+        are malformed. headers is looked up with lower case names. """
+    digests = {}
+    for name in ("digest", "repr-digest"):
+        value = headers.get(name)
+        if value:
+            parsed = parse_digest_header(value)
+            if parsed is None:
+                return None
+            digests.update(parsed)
+    return digests
+
+def format_digest_headers(algorithm, digest):
+    """ Return the Repr-Digest and legacy Digest headers of a base64 digest. """
+    return [("Repr-Digest", "%s=:%s:" % (algorithm, digest)),
+            ("Digest", "%s=%s" % (algorithm.upper(), digest))]
+
+class Digester:
+    """ Digests of a stream in several algorithms at once, computed while
+        the data passes by. """
+
+    def __init__(self, algorithms):
+        self.hashes = dict((name, DIGEST_ALGORITHMS[name]()) for name in algorithms)
+        self.offset = 0 # bytes digested so far
+
+    def update(self, data):
+        for h in self.hashes.values():
+            h.update(data)
+        self.offset += len(data)
+
+    def digest(self, algorithm):
+        """ Return the base64 digest of the data so far. """
+        return base64.b64encode(self.hashes[algorithm].digest())
+
+    def mismatches(self, expected):
+        """ Return the algorithms whose digest differs from the raw digests
+            in expected. """
+        return [name for name, digest in expected.items()
+                if self.hashes[name].digest() != digest]
+
+class DigestCache:
+    """ Digests of shared files, so that they are computed once, during the
+        first complete download. They are keyed on the device, inode, size
+        and mtime of a file, so that a changed file is digested again, and
+        kept in a JSON file that is saved at most DIGEST_CACHE_SAVE_INTERVAL
+        seconds after a change. The least recently used are dropped first. """
+
+    def __init__(self, max_records=DIGEST_CACHE_SIZE):
+        self.max_records = max_records
+        self.path = None # in memory only
+        self.__records = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__save_timer = None
+
+    def open(self, path):
+        """ Keep the digests in the file path, loading those saved there. """
+        self.path = path
+        try:
+            with open(path) as f:
+                records = json.load(f)
+        except (IOError, ValueError) as e:
+            DEBUG("Digest Cache: " + str(e))
+            return
+        with self.__lock:
+            for key, digests in records: # unicode from json on python 2
+                self.__records[str(key)] = dict((str(name), str(digest))
+                                                for name, digest in digests.items())
+
+    @staticmethod
+    def accepts(st):
+        """ Whether the digest of a file with stat result st may be cached.
+            A file modified within the last second may change again without
+            a different mtime, like a weak ETag in make_etag(). """
+        return time.time() - st.st_mtime >= 1
+
+    @staticmethod
+    def key(st):
+        return "%x-%x-%x-%x" % (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+
+    def get(self, st, algorithm):
+        """ Return the base64 digest of the file, or None if it is unknown. """
+        key = self.key(st)
+        with self.__lock:
+            digests = self.__records.get(key)
+            if digests is None or algorithm not in digests:
+                return None
+            del self.__records[key]
+            self.__records[key] = digests # most recently used
+            return digests[algorithm]
+
+    def put(self, st, algorithm, digest):
+        if not self.accepts(st):
+            return
+        key = self.key(st)
+        with self.__lock:
+            digests = self.__records.pop(key, {})
+            digests[algorithm] = digest
+            self.__records[key] = digests
+            while len(self.__records) > self.max_records:
+                self.__records.popitem(last=False)
+            if self.path and self.__save_timer is None:
+                self.__save_timer = threading.Timer(DIGEST_CACHE_SAVE_INTERVAL, self.save)
+                self.__save_timer.daemon = True
+                self.__save_timer.start()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__records)
+
+    def save(self):
+        """ Write the digests to the cache file through a temporary file. """
+        with self.__lock:
+            self.__save_timer = None
+            records = list(self.__records.items())
+        if not self.path:
+            return
+        temp_path = self.path + ".tmp"
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp_path, "w") as f:
+                json.dump(records, f)
+            replace_file(temp_path, self.path)
+        except (IOError, OSError) as e:
+            DEBUG("Digest Cache: " + str(e))
+
+def replace_file(source, target):
+    """ Rename source to target, replacing target if it exists. The rename
+        is atomic on posix systems; elsewhere target is removed first. """
+    try:
+        os.rename(source, target)
+    except OSError:
+        if os.name != "nt" or not os.path.exists(target):
+            raise
+        os.remove(target)
+        os.rename(source, target)
+
+def preallocate_file(f, length):
+    """ Make the file f length bytes long. With posix_fallocate the blocks
+        are reserved as well, so the file is not fragmented by pieces
+        arriving out of order and a full disk is noticed at once. """
+    if length <= 0:
+        return
+    if posix_fallocate is not None:
+        try:
+            posix_fallocate(f.fileno(), 0, length)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                raise
+    f.truncate(length)
+
+def make_readinto(rfile):
+    """ Return a function that reads from rfile into a writable buffer and
+        returns the number of bytes read. Files without readinto(), like the
+        socket files of python 2, are read and copied. """
+    if hasattr(rfile, "readinto"):
+        return rfile.readinto
+    def readinto(view):
+        data = rfile.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+    return readinto
+
+def make_member_readinto(f, size):
+    """ Like make_readinto() for a member of a tar stream of size bytes,
+        raising EOFError if the archive ends before the member does. """
+    left = [size]
+    def readinto(view):
+        if left[0] == 0:
+            return 0
+        data = f.read(min(len(view), left[0]))
+        if not data:
+            raise EOFError("unexpected end of archive")
+        view[:len(data)] = data
+        left[0] -= len(data)
+        return len(data)
+    return readinto
+
+class BufferPool:
+    """ Blocks of UPLOAD_BLOCK_SIZE bytes reused from one upload to the next. """
+
+    def __init__(self, size=UPLOAD_BLOCK_SIZE, max_free=UPLOAD_FREE_BUFFERS):
+        self.size = size
+        self.__max_free = max_free
+        self.__free = []
+        self.__lock = threading.Lock()
+
+    def get(self):
+        with self.__lock:
+            if self.__free:
+                return self.__free.pop()
+        return bytearray(self.size)
+
+    def put(self, buf):
+        with self.__lock:
+            if len(self.__free) < self.__max_free:
+                self.__free.append(buf)
+
+class BackgroundWriter:
+    """ Write blocks to a file on a thread of its own, so that writing one
+        block to disk overlaps with receiving the next. Two buffers take
+        turns: one is filled by the receiver while the other is written.
+        The thread is only started for a second block; smaller files are
+        written directly. """
+
+    def __init__(self, f, pool, digester=None):
+        """ @param digester a Digester that is given the data written """
+        self.__file = f
+        self.__pool = pool
+        self.__digester = digester
+        self.__free = Queue.Queue()
+        self.__blocks = Queue.Queue()
+        self.__buffers = []
+        self.__thread = None
+        self.error = None
+
+    def get_buffer(self):
+        """ Return an empty buffer, waiting until one has been written out
+            if both are in use. """
+        if len(self.__buffers) < 2:
+            buf = self.__pool.get()
+            self.__buffers.append(buf)
+            return buf
+        buf = self.__free.get()
+        if self.error is not None:
+            raise self.error
+        return buf
+
+    def write(self, buf, length, last=False):
+        """ Queue the first length bytes of buf to be written. """
+        if last and self.__thread is None:
+            self.__write(buf, length)
+            self.__free.put(buf)
+            return
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run)
+            self.__thread.daemon = True
+            self.__thread.start()
+        self.__blocks.put((buf, length))
+
+    def close(self):
+        """ Wait for the queued blocks to be written. A failed write is
+            left in self.error. """
+        if self.__thread is not None:
+            self.__blocks.put(None)
+            self.__thread.join()
+        for buf in self.__buffers:
+            self.__pool.put(buf)
+        self.__buffers = []
+
+    def __write(self, buf, length):
+        view = memoryview(buf)
+        written = 0
+        while written < length:
+            written += self.__file.write(view[written:length])
+        if self.__digester is not None:
+            self.__digester.update(view[:length])
+
+    def __run(self):
+        while True:
+            block = self.__blocks.get()
+            if block is None:
+                return
+            buf, length = block
+            if self.error is None:
+                try:
+                    self.__write(buf, length)
+                except (IOError, OSError) as e:
+                    self.error = e
+            self.__free.put(buf)
+
+def receive_into_file(f, readinto, throttle, pool, count=None, digester=None):
+    """ Copy data from readinto() to the unbuffered file f until it returns
+        0 or count bytes have been copied. Returns the number of bytes
+        copied; a failed write raises its error. The data written is also
+        given to digester, if there is one. """
+    writer = BackgroundWriter(f, pool, digester)
+    copied = 0
+    try:
+        while count is None or copied < count:
+            buf = writer.get_buffer()
+            view = memoryview(buf)
+            limit = len(buf) if count is None else min(len(buf), count - copied)
+            filled = 0
+            while filled < limit:
+                n = readinto(view[filled:min(limit, filled + throttle.quantum)])
+                if not n:
+                    break
+                throttle.wait(n)
+                filled += n
+            last = (filled < limit or copied + filled == count)
+            if filled:
+                writer.write(buf, filled, last)
+                copied += filled
+            if last:
+                break
+    finally:
+        writer.close()
+    if writer.error is not None:
+        raise writer.error
+    return copied
+
+class RequestBody:
+    """ A request body of Content-Length bytes as a file, read through a
+        Throttle. A body that ends early raises EOFError. """
+
+    def __init__(self, rfile, length, throttle):
+        self.__rfile = rfile
+        self.__left = length
+        self.__throttle = throttle
+
+    def read(self, size=-1):
+        if size < 0 or size > self.__left:
+            size = self.__left
+        if size == 0:
+            return ""
+        data = self.__rfile.read(min(size, self.__throttle.quantum))
+        if not data:
+            raise EOFError("unexpected end of request body")
+        self.__throttle.wait(len(data))
+        self.__left -= len(data)
+        return data
+
+    def finish(self):
+        """ Discard the rest of the body, like MultipartReader.finish(). """
+        if self.__left > MULTIPART_BLOCK_SIZE:
+            return False
+        while self.__left > 0:
+            self.read()
+        return True
+
+class MultipartReader:
+    """ Read the parts of a multipart/form-data body one after another
+        without keeping any part in memory. The body is read in blocks of
+        MULTIPART_BLOCK_SIZE, which are searched for the boundary. """
+
+    def __init__(self, rfile, boundary, length):
+        """ @param length the length of the body (Content-Length) """
+        self.__rfile = rfile
+        self.__left = length # bytes of the body not read from rfile yet
+        self.__delimiter = "\r\n--" + boundary
+        # The first boundary has no CRLF before it; with one in front, the
+        # preamble becomes a part of its own that is skipped.
+        self.__buffer = "\r\n"
+        self.__pos = 0
+        self.__match = None # position of the next delimiter, -1 if not buffered
+        self.__in_part = True
+        self.__done = False
+
+    def next_part(self):
+        """ Skip the rest of the current part and return the next one, or
+            None after the last one. """
+        while self.__in_part:
+            self.read_part(MULTIPART_BLOCK_SIZE)
+        if self.__done or self.__peek(2) == "--": # the closing delimiter
+            self.__done = True
+            return None
+        self.__readline() # the end of the boundary line
+
+        headers = {}
+        size = 0
+        while True:
+            line = self.__readline()
+            if line == "":
+                break
+            size += len(line)
+            name, sep, value = line.partition(":")
+            if not sep or size > MULTIPART_MAX_HEADER:
+                raise MultipartError("malformed part header")
+            headers[name.strip().lower()] = value.strip()
+        self.__in_part = True
+        return MultipartPart(self, headers)
+
+    def read_part(self, size):
+        """ Read at most size bytes of the current part; "" at its end. """
+        start, n = self.__next_data(size)
+        return self.__buffer[start:start + n]
+
+    def readinto_part(self, view):
+        """ Like read_part(), but copy the data into the writable buffer
+            view and return its length; 0 at the end of the part. """
+        start, n = self.__next_data(len(view))
+        if n:
+            view[:n] = memoryview(self.__buffer)[start:start + n]
+        return n
+
+    def __next_data(self, size):
+        """ Consume at most size bytes of the current part and return where
+            they are in the buffer as (start, length). """
+        while self.__in_part:
+            if self.__match is None:
+                self.__match = self.__buffer.find(self.__delimiter, self.__pos)
+            if self.__match >= 0:
+                end = self.__match
+            else: # keep what could be the start of a delimiter
+                end = len(self.__buffer) - len(self.__delimiter) + 1
+            if end > self.__pos:
+                start = self.__pos
+                n = min(end - start, size)
+                self.__pos += n
+                return start, n
+            if self.__match >= 0: # reached the delimiter
+                self.__pos += len(self.__delimiter)
+                self.__match = None
+                self.__in_part = False
+            elif not self.__fill():
+                raise MultipartError("unexpected end of body")
+        return 0, 0
+
+    def finish(self):
+        """ Discard the epilogue. Returns False if the body is too large to
+            be discarded, so that the connection must be closed. """
+        if self.__left > MULTIPART_BLOCK_SIZE:
+            return False
+        while self.__fill():
+            pass
+        return True
+
+    def __fill(self):
+        """ Read the next block of the body. Returns False at its end. """
+        if self.__left <= 0:
+            return False
+        data = self.__rfile.read(min(MULTIPART_BLOCK_SIZE, self.__left))
+        if not data:
+            self.__left = 0
+            return False
+        self.__left -= len(data)
+        self.__buffer = self.__buffer[self.__pos:] + data
+        self.__pos = 0
+        self.__match = None
+        return True
+
+    def __peek(self, n):
+        while len(self.__buffer) - self.__pos < n and self.__fill():
+            pass
+        return self.__buffer[self.__pos:self.__pos + n]
+
+    def __readline(self):
+        """ Read a line of a part header without its CRLF. """
+        while True:
+            index = self.__buffer.find("\r\n", self.__pos)
+            if index >= 0:
+                line = self.__buffer[self.__pos:index]
+                self.__pos = index + 2
+                self.__match = None
+                return line
+            if len(self.__buffer) - self.__pos > MULTIPART_MAX_HEADER:
+                raise MultipartError("part header too long")
+            if not self.__fill():
+                raise MultipartError("unexpected end of body")
+
+class MultipartPart:
+    """ A part of a multipart body, readable until the next part is requested. """
+
+    def __init__(self, reader, headers):
+        self.headers = headers
+        disposition, params = cgi.parse_header(headers.get("content-disposition", ""))
+        self.name = params.get("name")
+        self.filename = params.get("filename") # None for plain form fields
+        self.read = reader.read_part
+        self.readinto = reader.readinto_part
+
+def merge_ranges(ranges, start, end):
+    """ Add the half-open range [start, end) to a sorted list of disjoint
+        [start, end) pairs, joining it with the ranges it touches. """
+    merged = []
+    for first, last in ranges:
+        if last < start or first > end: # apart
+            merged.append([first, last])
+        else:
+            start, end = min(first, start), max(last, end)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+def format_ranges(ranges):
+    """ Format [start, end) pairs as the Upload-Ranges header, e.g.
+        "0-99,200-299" with inclusive ends like a Range header. """
+    return ",".join("%d-%d" % (first, last - 1) for first, last in ranges if last > first)
+
+# a claim on every byte of an upload session, see HttpFileServer.begin_upload()
+ALL_RANGES = (-1, float("inf"))
+# stands for a Digester in use, see HttpFileServer.take_upload_digester()
+UPLOAD_DIGESTER_TAKEN = object()
+
+class UploadSession:
+    """ A resumable upload. The data goes to <id>.part in the session
+        directory, next to <id>.json with the name and length of the file
+        and the ranges received so far, so an upload can continue after a
+        restart of the server. Pieces may arrive in any order and in
+        parallel; each is written at its place in the part file. """
+
+    def __init__(self, directory, id, filename, length, ranges=None, digests=None):
+        """ @param digests the base64 digests the file must have, by algorithm """
+        self.directory = directory
+        self.id = id
+        self.filename = filename
+        self.length = length
+        self.ranges = ranges or [] # received [start, end) pairs
+        self.digests = digests or {}
+        self.part_path = os.path.join(directory, id + ".part")
+        self.state_path = os.path.join(directory, id + ".json")
+
+    def get_offset(self):
+        """ Return the length of the data received without gaps from the start. """
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    def is_complete(self):
+        return self.get_offset() >= self.length
+
+    def add_range(self, start, end):
+        """ Record that bytes start to end have arrived. The state file is
+            read again first, since other requests may have added ranges;
+            the caller has to make sure no two calls run at the same time. """
+        state = self.load_state()
+        if state is not None:
+            self.ranges = state.get("ranges", [])
+        self.ranges = merge_ranges(self.ranges, start, end)
+        self.save()
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save(self):
+        """ Write the state file through a temporary file, so that it is
+            either the old or the new one after a crash. """
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"filename": self.filename, "length": self.length,
+                       "ranges": self.ranges, "digests": self.digests}, f)
+        replace_file(temp_path, self.state_path)
+
+    def write(self, offset, rfile, count, throttle, pool, digester=None):
+        """ Copy count bytes from rfile to the part file at offset, through a
+            file object of its own so that pieces can be written in parallel.
+            Returns the number of bytes written before rfile ended.
+            @param digester a Digester standing at offset """
+        with io.open(self.part_path, "r+b", buffering=0) as f:
+            f.seek(offset)
+            return receive_into_file(f, make_readinto(rfile), throttle, pool,
+                                     count, digester)
+
+    def update_digester(self, digester):
+        """ Give digester the data received without gaps after its offset.
+            Pieces that arrived out of order are read back from the part
+            file, while they are most likely still in the page cache. """
+        end = self.get_offset()
+        if digester.offset >= end:
+            return
+        with open(self.part_path, "rb") as f:
+            f.seek(digester.offset)
+            while digester.offset < end:
+                data = f.read(min(UPLOAD_BLOCK_SIZE, end - digester.offset))
+                if not data:
+                    raise IOError("%s: unexpected end of file" % (self.part_path))
+                digester.update(data)
+
+    def get_expected_digests(self):
+        """ Return the raw digests the file must have, by algorithm. """
+        return dict((name, base64.b64decode(digest)) for name, digest in self.digests.items())
+
+    def finalize(self, upload_path):
+        """ Move the complete file to upload_path and end the session.
+            Returns its path. """
+        fullpath = os.path.join(upload_path, self.filename)
+        replace_file(self.part_path, fullpath)
+        self.remove()
+        return fullpath
+
+    def remove(self):
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def get_upload_session_dir(upload_path):
+    """ Return the session directory of upload_path, creating it if needed.
+        It also holds the files of multipart uploads still being received. """
+    directory = os.path.join(upload_path, UPLOAD_SESSION_DIR)
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    return directory
+
+def create_upload_session(upload_path, filename, length, digests=None):
+    """ @param digests the raw digests the file must have, by algorithm """
+    directory = get_upload_session_dir(upload_path)
+    digests = dict((name, base64.b64encode(digest)) for name, digest in (digests or {}).items())
+    session = UploadSession(directory, uuid.uuid4().hex, filename, length, None, digests)
+    try:
+        with open(session.part_path, "wb") as f:
+            preallocate_file(f, length)
+        session.save()
+    except (IOError, OSError):
+        session.remove()
+        raise
+    return session
+
+def load_upload_session(upload_path, id):
+    """ Return the UploadSession id, or None if there isn't one. """
+    if not id or not re.match("^[0-9a-f]{32}$", id):
+        return None
+    directory = os.path.join(upload_path, UPLOAD_SESSION_DIR)
+    session = UploadSession(directory, id, None, 0)
+    state = session.load_state()
+    if state is None or "filename" not in state or "length" not in state:
+        return None
+    filename = state["filename"]
+    if not isinstance(filename, str): # unicode from json on python 2
+        filename = filename.encode("utf-8")
+    digests = dict((str(name), str(digest)) for name, digest in state.get("digests", {}).items()
+                   if name in DIGEST_ALGORITHMS)
+    return UploadSession(directory, id, filename, state["length"], state.get("ranges"), digests)
+
+def expire_upload_sessions(directory):
+    """ Remove the files of sessions untouched for UPLOAD_SESSION_TTL seconds.
+        Returns the ids of the sessions removed. """
+    deadline = time.time() - UPLOAD_SESSION_TTL
+    expired = set()
+    for entry in scan_dir(directory):
+        if entry.is_file and entry.mtime < deadline:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            expired.add(entry.name.split(".")[0])
+    return expired
+
+class ObjectStore:
+    """ Content-addressed store of uploaded files. Every distinct content
+        is kept once in UPLOAD_OBJECT_DIR, named by its digest, and the
+        uploaded files are hard links to it, so an upload of a file the
+        store already has takes no space, or no transfer at all if the
+        client gives the digest before sending it. """
+
+    def __init__(self, upload_path):
+        self.upload_path = upload_path
+        self.directory = os.path.join(upload_path, UPLOAD_OBJECT_DIR)
+        self.hits = 0 # uploads that found their content in the store
+        self.__lock = threading.Lock()
+        self.__last_sweep = 0
+        # held while an object is linked to, or removed by a sweep, so that
+        # a sweep never removes an object a new link is being made to
+        self.__link_lock = threading.Lock()
+
+    def get_path(self, digest):
+        """ Return the path of the object with the raw digest. """
+        name = binascii.hexlify(digest).decode("ascii")
+        return os.path.join(self.directory, name[:2], name)
+
+    def link_stored(self, digest, length, target):
+        """ Make target a link to the object with the raw digest if the
+            store has it and it is length bytes long. Returns False if not. """
+        path = self.get_path(digest)
+        try:
+            with self.__link_lock:
+                if os.stat(path).st_size != length:
+                    return False
+                link_path = self.new_link(path)
+            self.install_link(link_path, target)
+        except OSError: # not stored
+            return False
+        with self.__lock:
+            self.hits += 1
+        return True
+
+    def add(self, temp_path, digest, target):
+        """ Store the complete file temp_path, whose raw digest is given, and
+            make target a link to it. If the store has the content already,
+            temp_path is dropped once the link to it is made. """
+        path = self.get_path(digest)
+        with self.__link_lock:
+            try:
+                link_path = self.new_link(path)
+                stored = True
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                directory = os.path.dirname(path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                os.rename(temp_path, path)
+                link_path = self.new_link(path)
+                stored = False
+        if stored:
+            os.remove(temp_path)
+            with self.__lock:
+                self.hits += 1
+        self.install_link(link_path, target)
+
+    def new_link(self, path):
+        """ Return a new temporary hard link to the object path; the caller
+            holds the link lock. """
+        link_path = os.path.join(get_upload_session_dir(self.upload_path),
+                                 uuid.uuid4().hex + ".link")
+        os.link(path, link_path)
+        return link_path
+
+    def install_link(self, link_path, target):
+        """ Move the temporary link link_path to target, replacing the file
+            target atomically if it exists. """
+        try:
+            replace_file(link_path, target)
+        except OSError:
+            os.remove(link_path)
+            raise
+        self.sweep()
+
+    def sweep(self):
+        """ Remove the objects no uploaded file links to any more, at most
+            once every UPLOAD_OBJECT_SWEEP_INTERVAL seconds. """
+        now = time.time()
+        with self.__lock:
+            if now - self.__last_sweep < UPLOAD_OBJECT_SWEEP_INTERVAL:
+                return
+            self.__last_sweep = now
+        if not os.path.isdir(self.directory):
+            return
+        for entry in scan_dir(self.directory):
+            if not entry.is_dir:
+                continue
+            for name in os.listdir(entry.path):
+                path = os.path.join(entry.path, name)
+                try:
+                    with self.__link_lock:
+                        st = os.stat(path)
+                        if st.st_nlink == 1 and st.st_mtime < now - UPLOAD_OBJECT_GRACE:
+                            os.remove(path)
+                except OSError:
+                    pass
+
+class WorkerPool:
+    """ A fixed number of threads running jobs from a queue. """
+
+    def __init__(self, workers, queue_size=0):
+        """ @param queue_size the most jobs waiting for a thread; 0 means no limit """
+        self.__queue = Queue.Queue(queue_size)
+        self.__lock = threading.Lock()
+        self.__releasing = 0 # idle jobs told to end for the queued ones
+        for i in range(workers):
+            t = threading.Thread(target=self.__run)
+            t.daemon = True
+            t.start()
+
+    def submit(self, func, *args):
+        """ Queue func(*args). Returns False if the queue is full. """
+        try:
+            self.__queue.put_nowait((func, args))
+            return True
+        except Queue.Full:
+            return False
+
+    def claim_release(self):
+        """ Whether a job that is only waiting (for the next request of an
+            idle connection) should end to free its thread for a queued job.
+            Returns True for at most one waiting job per queued job. """
+        with self.__lock:
+            if self.__queue.qsize() > self.__releasing:
+                self.__releasing += 1
+                return True
+            return False
+
+    def __run(self):
+        while True:
+            func, args = self.__queue.get()
+            with self.__lock:
+                if self.__releasing > 0:
+                    self.__releasing -= 1
+            try:
+                func(*args)
+            except Exception:
+                DEBUG(traceback.format_exc())
+
+class ListingCache:
+    """ A bounded LRU cache of directory listings: entry lists and rendered
+        pages, each stored under a key with the local directory it was built
+        from and a validator of its state (see
+        MyServiceHandler.get_listing_validator). A record is used only while
+        the validator is unchanged. With pyinotify the cached directories are
+        watched and dropped as soon as anything in them changes; without it
+        records also expire after LISTING_CACHE_MAX_AGE seconds. """
+
+    def __init__(self, max_records=LISTING_CACHE_SIZE):
+        self.max_records = max_records # 0 disables the cache
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.__records = collections.OrderedDict() # key -> (localpath, validator, value, time)
+        self.__lock = threading.Lock()
+        self.__watcher = None
+        self.__watcher_failed = False
+
+    def get(self, key, validator):
+        """ Return the value cached under key, or None. """
+        if not self.max_records or validator is None:
+            return None
+        with self.__lock:
+            record = self.__records.pop(key, None)
+            if record is not None and record[1] == validator and \
+                    (time.time() - record[3] < LISTING_CACHE_MAX_AGE or
+                     (self.__watcher and self.__watcher.is_watching(record[0]))):
+                self.__records[key] = record # most recently used goes last
+                self.hits += 1
+                return record[2]
+            self.misses += 1
+            if record is not None:
+                self.__unwatch_if_unused(record[0])
+            return None
+
+    def put(self, key, localpath, validator, value):
+        if not self.max_records or validator is None:
+            return
+        watcher = self.__get_watcher()
+        with self.__lock:
+            self.__records.pop(key, None)
+            self.__records[key] = (localpath, validator, value, time.time())
+            while len(self.__records) > self.max_records:
+                oldest_key, oldest = self.__records.popitem(last=False)
+                self.__unwatch_if_unused(oldest[0])
+        if watcher and localpath:
+            watcher.watch(localpath)
+
+    def invalidate(self, localpath):
+        """ Drop every record built from localpath. """
+        with self.__lock:
+            keys = [key for key, record in self.__records.items() if record[0] == localpath]
+            for key in keys:
+                del self.__records[key]
+            if keys:
+                self.invalidations += 1
+                DEBUG("Listing cache: invalidated " + localpath)
+            if self.__watcher:
+                self.__watcher.unwatch(localpath)
+
+    def __unwatch_if_unused(self, localpath):
+        """ Stop watching localpath if no record needs it. Called with the lock held. """
+        if self.__watcher and localpath and \
+                not any(record[0] == localpath for record in self.__records.values()):
+            self.__watcher.unwatch(localpath)
+
+    def __get_watcher(self):
+        """ Start the inotify watcher on first use, if pyinotify is available. """
+        with self.__lock:
+            if self.__watcher is None and pyinotify is not None and not self.__watcher_failed:
+                try:
+                    self.__watcher = DirectoryWatcher(self.invalidate)
+                except Exception as e:
+                    self.__watcher_failed = True
+                    DEBUG("inotify is not available: " + str(e))
+            return self.__watcher
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__records)
+
+class DirectoryWatcher:
+    """ Calls on_change(path) from a background thread whenever an entry of
+        a watched directory is created, removed, renamed or modified.
+        Requires pyinotify. """
+
+    MASK = 0 if pyinotify is None else (
+        pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+        pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB |
+        pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF)
+
+    def __init__(self, on_change):
+        self.__on_change = on_change
+        self.__watches = {} # path -> watch descriptor
+        self.__lock = threading.Lock()
+        self.__manager = pyinotify.WatchManager()
+        self.__notifier = pyinotify.ThreadedNotifier(self.__manager, self.__handle_event)
+        self.__notifier.daemon = True
+        self.__notifier.start()
+
+    def watch(self, path):
+        with self.__lock:
+            if path in self.__watches:
+                return
+            wd = self.__manager.add_watch(path, self.MASK, quiet=True).get(path, -1)
+            if wd >= 0:
+                self.__watches[path] = wd
+
+    def is_watching(self, path):
+        with self.__lock:
+            return path in self.__watches
+
+    def unwatch(self, path):
+        with self.__lock:
+            wd = self.__watches.pop(path, None)
+            if wd is not None:
+                self.__manager.rm_watch(wd, quiet=True)
+
+    def __handle_event(self, event):
+        if event.mask & pyinotify.IN_IGNORED: # the directory is gone
+            with self.__lock:
+                self.__watches.pop(event.path, None)
+        self.__on_change(event.path)
 
 __system_encoding = locale.getdefaultlocale()[1]
 def get_system_encoding():
@@ -248,6 +2676,11 @@ def generate_folder_listing_html(body):
     return FOLDER_LISTING_TEMPLATE % {"BODY": body, \
                 "TITLE": _("HTTP File Share")}
 
+def generate_folder_listing_html_parts():
+    """ Return the parts of the listing page before and after the body. """
+    head, tail = FOLDER_LISTING_TEMPLATE.split("%(BODY)s")
+    return head % {"TITLE": _("HTTP File Share")}, tail
+
 REDIRECT_TEMPLATE = """
 <html class="html">
     <head>
@@ -277,6 +2710,26 @@ def generate_file_not_found_html(file):
             "TITLE": _("%s: file not found") % (file), \
             "MESSAGE": _("%s doesn't exist on the server.") % (file) }
 
+def generate_too_many_files_html():
+    return FILE_NOT_FOUND_TEMPLATE % { \
+            "TITLE": _("Too many files"), \
+            "MESSAGE": _("Too many files were selected to be downloaded at once.") }
+
+SERVICE_UNAVAILABLE_TEMPLATE = """HTTP/1.0 503 Service Unavailable\r
+Content-Type: text/html\r
+Content-Length: %(LENGTH)d\r
+Retry-After: %(RETRY_AFTER)d\r
+Connection: close\r
+\r
+%(BODY)s"""
+def generate_service_unavailable_response(message):
+    """ A complete 503 response for connections that are turned away
+        before a handler is created for them. """
+    body = FILE_NOT_FOUND_TEMPLATE % { \
+            "TITLE": _("Service Unavailable"), "MESSAGE": cgi.escape(message) }
+    return SERVICE_UNAVAILABLE_TEMPLATE % { \
+            "LENGTH": len(body), "RETRY_AFTER": RETRY_AFTER, "BODY": body }
+
 CSS_UPLOAD = """
 body { font: 0.8em/1em "trebuchet MS", arial, sans-serif; color: #777; }
 h1 { font-size: 1.6em; margin: 30px 0; padding: 0; }
@@ -318,6 +2771,7 @@ function FileAPI (t, d, f) {
     var STATUS_TRANSFERRING = "tr", STATUS_QUEUE = "qu", STATUS_FINISHED = "fi";
     var id_count = 0;
     this.init = function () {
+        setInterval(updateTotalStatus, 1000);
         fileField.onchange = this.addFiles;
         dropZone.addEventListener("dragenter",  this.stopProp, false);
         dropZone.addEventListener("dragleave",  this.dragExit, false);
@@ -385,13 +2839,15 @@ function FileAPI (t, d, f) {
         document.getElementById(name).style["display"] = "none";
     }
     var triggerUpload = function() {
+        var running = 0;
         for (var i=0; i<fileList.childNodes.length; i++) {
             node = fileList.childNodes[i];
             if (itemGetStatus(node) == STATUS_TRANSFERRING)
-                return; // Only upload one file at a time.
+                running++;
         }
-        var item = fileQueue.shift();
-        if (item != null) {
+        // Upload upload_concurrency files at a time.
+        for (; running < upload_concurrency && fileQueue.length > 0; running++) {
+            var item = fileQueue.shift();
             var p = document.createElement("p");
             p.className = "loader";
             var pText = document.createTextNode("Uploading...");
@@ -399,6 +2855,7 @@ function FileAPI (t, d, f) {
             item.li.appendChild(p);
             uploadFile(item.file, item.li);
         }
+        updateTotalStatus();
     }
     var size2str = function (nsize) {
         var KILO = 1024, MEGA = KILO * 1024, GIGA = MEGA * 1024;
@@ -430,6 +2887,7 @@ function FileAPI (t, d, f) {
     }
     var itemRemove = function(li) {
         var id = itemGetID(li);
+        delete transfers[id];
         fileList.removeChild(li);
         for (var index in fileQueue)
             if (fileQueue[index].id == id)
@@ -464,7 +2922,29 @@ function FileAPI (t, d, f) {
             fileQueue.push({file : file, li : li, id : id});
         }
     }
+    // Bytes sent and total size of every file in the list, by item id, for
+    // the status line of all uploads.
+    var transfers = {}, total_prev_loaded = 0, total_prev_time = (new Date()).getTime();
+    var updateTotalStatus = function () {
+        var loaded = 0, total = 0, running = 0;
+        for (var id in transfers) {
+            loaded += transfers[id].loaded;
+            total += transfers[id].total;
+        }
+        for (var i = 0; i < fileList.childNodes.length; i++)
+            if (itemGetStatus(fileList.childNodes[i]) == STATUS_TRANSFERRING)
+                running++;
+        var date = new Date(), interval = date.getTime() - total_prev_time;
+        var text = size2str(loaded) + "/" + size2str(total);
+        if (running > 0 && interval > 0) {
+            var rate = Math.max(loaded - total_prev_loaded, 0) / interval * 1000;
+            text = "Uploading " + running + " file(s): " + text + " (" + size2str(rate) + "/s)";
+        }
+        total_prev_loaded = loaded; total_prev_time = date.getTime();
+        document.getElementById("uploadStatus").textContent = (total > 0) ? text : "";
+    }
     var updateStatus = function (li, loaded, total, prev_loaded, interval) {
+        transfers[itemGetID(li)] = {loaded: loaded, total: total};
         var loader = li.getElementsByTagName("div")[0];
         var status = li.getElementsByTagName("p")[0];
         var upload_rate = (interval == 0) ? 0 : (loaded - prev_loaded) / interval * 1000;
@@ -475,53 +2955,244 @@ function FileAPI (t, d, f) {
         loader.style["width"] = (loaded / total) * 100 + "%";
         status.textContent = text;
     }
+    var markComplete = function (li, total) {
+        var ps = li.getElementsByTagName("p");
+        var div = li.getElementsByTagName("div")[0];
+        div.style["width"] = "100%";
+        div.style["backgroundColor"] = "#0f0";
+        for (var i = 0; i < ps.length; i++) {
+            if (ps[i].className == "loader") {
+                ps[i].textContent = "Upload complete";
+                ps[i].style["color"] = "#3DD13F";
+                break;
+            }
+        }
+        if (total != null) {
+            updateStatus(li, total, total, 0, 0);
+        }
+        itemSetStatus(li, STATUS_FINISHED);
+        triggerUpload();
+    }
+    var markFailed = function (li) {
+        var ps = li.getElementsByTagName("p");
+        for (var i = 0; i < ps.length; i++) {
+            if (ps[i].className == "loader") {
+                ps[i].textContent = "Upload failed";
+                ps[i].style["color"] = "red";
+                break;
+            }
+        }
+        itemSetStatus(li, STATUS_FINISHED);
+        triggerUpload();
+    }
     var uploadFile = function (file, li) {
         if (li && file) {
-            var prev_loaded = 0, prev_time = (new Date()).getTime();
-            var xhr = new XMLHttpRequest(),
-                upload = xhr.upload;
-            upload.addEventListener("progress", function (ev) {
-                var date = new Date(), interval = date.getTime() - prev_time;
-                if (ev.lengthComputable && interval >= 150) {
-                    updateStatus(li, ev.loaded, ev.total, prev_loaded, interval);
-                    prev_loaded = ev.loaded; prev_time = date.getTime();
-                }
-            }, false);
-            upload.addEventListener("load", function (ev) {
-                var ps = li.getElementsByTagName("p");
-                var div = li.getElementsByTagName("div")[0];
-                div.style["width"] = "100%";
-                div.style["backgroundColor"] = "#0f0";
-                for (var i = 0; i < ps.length; i++) {
-                    if (ps[i].className == "loader") {
-                        ps[i].textContent = "Upload complete";
-                        ps[i].style["color"] = "#3DD13F";
-                        break;
+            if (file.slice && window.JSON) {
+                uploadResumable(file, li);
+            } else {
+                uploadForm(file, li);
+            }
+            itemSetStatus(li, STATUS_TRANSFERRING);
+        }
+    }
+    var getStorage = function () {
+        try {
+            return window.localStorage || null;
+        } catch (e) {
+            return null;
+        }
+    }
+    // Upload the file to a resumable upload session in pieces, up to
+    // upload_streams of them at a time. A piece that fails is sent again
+    // later; the session is remembered in localStorage, so adding the same
+    // file again after a reload sends only the pieces the server lacks.
+    var uploadResumable = function (file, li) {
+        var key = "hfs-upload:" + file.name + ":" + file.size + ":" + file.lastModified;
+        var storage = getStorage();
+        var session = storage ? storage.getItem(key) : null;
+        var requests = [], cancelled = false, failures = 0;
+        var chunk_count = Math.max(Math.ceil(file.size / upload_chunk_size), 1);
+        var pending = [], running = 0, done_bytes = 0, progress = {};
+        var prev_loaded = 0, prev_time = (new Date()).getTime();
+        var request = function (method, url, headers, body, onload, onerror, onprogress) {
+            var xhr = new XMLHttpRequest();
+            requests.push(xhr);
+            var forget = function () { requests.splice(requests.indexOf(xhr), 1); };
+            xhr.open(method, url, true);
+            xhr.setRequestHeader("X-Requested-With", "XMLHttpRequest");
+            for (var name in headers)
+                xhr.setRequestHeader(name, headers[name]);
+            xhr.onload = function () { forget(); if (!cancelled) onload(xhr); };
+            xhr.onerror = function () { forget(); if (!cancelled) onerror(); };
+            if (onprogress)
+                xhr.upload.addEventListener("progress", onprogress, false);
+            xhr.send(body);
+        }
+        var retry = function (action) {
+            if (++failures > upload_max_retries) {
+                cancelled = true;
+                for (var i = 0; i < requests.length; i++)
+                    requests[i].abort();
+                markFailed(li);
+                return;
+            }
+            setTimeout(action, Math.min(1000 * failures, 30000));
+        }
+        var create = function () {
+            request("POST", upload_post_url + "?resumable=1",
+                {"Upload-Length": file.size.toString(),
+                 "X-File-Name": encodeURIComponent(file.name)}, null,
+                function (xhr) {
+                    if (xhr.status != 201) return retry(create);
+                    session = xhr.getResponseHeader("Location");
+                    if (storage) storage.setItem(key, session);
+                    start("");
+                },
+                function () { retry(create); });
+        }
+        var resume = function () {
+            if (session == null) return create();
+            request("HEAD", session, {"Cache-Control": "no-cache"}, null,
+                function (xhr) {
+                    if (xhr.status == 404) { // expired or finished
+                        session = null;
+                        return create();
                     }
+                    if (xhr.status != 200) return retry(resume);
+                    start(xhr.getResponseHeader("Upload-Ranges") || "");
+                },
+                function () { retry(resume); });
+        }
+        var received = function (ranges, first, last) {
+            if (first >= last) return true;
+            var list = ranges.split(",");
+            for (var i = 0; i < list.length; i++) {
+                var range = list[i].split("-");
+                if (parseInt(range[0]) <= first && parseInt(range[1]) >= last - 1)
+                    return true;
+            }
+            return false;
+        }
+        var start = function (ranges) {
+            pending = []; done_bytes = 0;
+            for (var i = 0; i < chunk_count; i++) {
+                var first = i * upload_chunk_size;
+                var last = Math.min(first + upload_chunk_size, file.size);
+                if (received(ranges, first, last))
+                    done_bytes += last - first;
+                else
+                    pending.push(i);
+            }
+            pump();
+        }
+        var pump = function () {
+            while (!cancelled && running < upload_streams && pending.length > 0)
+                send(pending.shift());
+            if (!cancelled && running == 0 && pending.length == 0)
+                finish();
+        }
+        var showProgress = function () {
+            var date = new Date(), interval = date.getTime() - prev_time;
+            var loaded = done_bytes;
+            for (var i in progress)
+                loaded += progress[i];
+            if (interval >= 150) {
+                updateStatus(li, loaded, file.size, prev_loaded, interval);
+                prev_loaded = loaded; prev_time = date.getTime();
+            }
+        }
+        var send = function (i) {
+            var first = i * upload_chunk_size;
+            var last = Math.min(first + upload_chunk_size, file.size);
+            var failed = function () {
+                running--;
+                delete progress[i];
+                pending.push(i);
+                retry(pump);
+            }
+            running++;
+            progress[i] = 0;
+            request("PATCH", session,
+                {"Upload-Offset": first.toString(),
+                 "Content-Type": "application/offset+octet-stream"},
+                file.slice(first, last),
+                function (xhr) {
+                    if (xhr.status != 204) return failed();
+                    running--;
+                    delete progress[i];
+                    failures = 0;
+                    done_bytes += last - first;
+                    showProgress();
+                    pump();
+                },
+                failed,
+                function (ev) {
+                    progress[i] = ev.loaded;
+                    showProgress();
+                });
+        }
+        var finish = function () {
+            running++; // no more pieces while finishing
+            request("POST", session, {}, null,
+                function (xhr) {
+                    running--;
+                    if (xhr.status != 200) return retry(resume);
+                    if (storage) storage.removeItem(key);
+                    markComplete(li, file.size);
+                },
+                function () { running--; retry(resume); });
+        }
+        li.getElementsByTagName("a")[0].onclick = function(ev) { // "remove" button
+            var msg = "Removing this item will cancel the upload. Continue?";
+            if (itemGetStatus(li) != STATUS_TRANSFERRING || confirm(msg)) {
+                if (itemGetStatus(li) == STATUS_TRANSFERRING) {
+                    cancelled = true;
+                    while (requests.length > 0)
+                        requests.pop().abort();
+                    if (session) {
+                        var cancel = new XMLHttpRequest();
+                        cancel.open("DELETE", session, true);
+                        cancel.send(null);
+                    }
+                    if (storage) storage.removeItem(key);
                 }
-                if (ev.lengthComputable) {
-                    updateStatus(li, ev.loaded, ev.total, 0, 0);
-                }
-                itemSetStatus(li, STATUS_FINISHED);
+                itemRemove(li);
+                triggerUpload();
+            }
+        }
+        resume();
+    }
+    // Upload the whole file in a single form post, for browsers without
+    // Blob.slice.
+    var uploadForm = function (file, li) {
+        var prev_loaded = 0, prev_time = (new Date()).getTime();
+        var xhr = new XMLHttpRequest(),
+            upload = xhr.upload;
+        upload.addEventListener("progress", function (ev) {
+            var date = new Date(), interval = date.getTime() - prev_time;
+            if (ev.lengthComputable && interval >= 150) {
+                updateStatus(li, ev.loaded, ev.total, prev_loaded, interval);
+                prev_loaded = ev.loaded; prev_time = date.getTime();
+            }
+        }, false);
+        upload.addEventListener("load", function (ev) {
+            markComplete(li, ev.lengthComputable ? ev.total : null);
+        }, false);
+        var data = new FormData();
+        data.append("filename", file);
+        upload.addEventListener("error", function (ev) {console.log(ev);}, false);
+        xhr.open("POST", upload_post_url, true);
+        xhr.setRequestHeader("Cache-Control", "no-cache");
+        xhr.setRequestHeader("X-Requested-With", "XMLHttpRequest");
+        xhr.setRequestHeader("X-File-Name", escape(file.name));
+        xhr.send(data);
+        li.getElementsByTagName("a")[0].onclick = function(ev) { // "remove" button
+            var msg = "Removing this item will cancel the upload. Continue?";
+            if (itemGetStatus(li) != STATUS_TRANSFERRING || confirm(msg)) {
+                xhr.abort();
+                itemRemove(li);
                 triggerUpload();
-            }, false);
-            var data = new FormData();
-            data.append("filename", file);
-            upload.addEventListener("error", function (ev) {console.log(ev);}, false);
-            xhr.open("POST", upload_post_url, true);
-            xhr.setRequestHeader("Cache-Control", "no-cache");
-            xhr.setRequestHeader("X-Requested-With", "XMLHttpRequest");
-            xhr.setRequestHeader("X-File-Name", escape(file.name));
-            xhr.send(data);
-            li.getElementsByTagName("a")[0].onclick = function(ev) { // "remove" button
-                var msg = "Removing this item will cancel the upload. Continue?";
-                if (itemGetStatus(li) != STATUS_TRANSFERRING || confirm(msg)) {
-                    xhr.abort();
-                    itemRemove(li);
-                    triggerUpload();
-                }
             }
-            itemSetStatus(li, STATUS_TRANSFERRING);
         }
     }
 }
@@ -571,6 +3242,7 @@ UPLOAD_TEMPLATE = """
             <div id="files">
                 <h2>File list</h2>
                 <a id="remove_completed" href="#" title="Remove completed items from list">Remove completed uploads</a>
+                <p id="uploadStatus"></p>
                 <ul id="fileList"></ul>
                 <a id="upload" href="#" title="Start uploading files in list">Start uploading</a>
             </div>
@@ -578,25 +3250,41 @@ UPLOAD_TEMPLATE = """
 
         <script language="javascript">
             var upload_post_url = "%(UPLOAD_URL)s";
+            var upload_chunk_size = %(CHUNK_SIZE)d;
+            var upload_max_retries = %(MAX_RETRIES)d;
+            var upload_concurrency = %(CONCURRENCY)d;
+            var upload_streams = %(STREAMS)d;
             %(JS_FILEAPI)s
         </script>
     </body>
 </html>
 """
-def generate_upload_html():
+def generate_upload_html(concurrency=UPLOAD_CONCURRENCY, streams=UPLOAD_STREAMS):
     return UPLOAD_TEMPLATE % \
         {"UPLOAD_URL": UPLOAD_PREFIX, "CSS_UPLOAD": CSS_UPLOAD \
-         , "JS_FILEAPI": JS_FILEAPI, "ROOT": PREFIX};
+         , "JS_FILEAPI": JS_FILEAPI, "ROOT": PREFIX \
+         , "CHUNK_SIZE": UPLOAD_CHUNK_SIZE, "MAX_RETRIES": UPLOAD_MAX_RETRIES \
+         , "CONCURRENCY": max(concurrency, 1), "STREAMS": max(streams, 1)};
 
 
 # HTTP Reply
 HTTP_OK = 200
+HTTP_CREATED = 201
 HTTP_NOCONTENT = 204
+HTTP_PARTIAL_CONTENT = 206
+HTTP_NOT_MODIFIED = 304
+HTTP_BAD_REQUEST = 400
 HTTP_NOTFOUND = 404
+HTTP_CONFLICT = 409
+HTTP_ENTITY_TOO_LARGE = 413
 HTTP_MOVED_PERMANENTLY = 301
+HTTP_RANGE_NOT_SATISFIABLE = 416
 
 class HttpFileServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
 
+    # backlog of the listening socket
+    request_queue_size = 64
+
     def __init__(self, server_address):
         BaseHTTPServer.HTTPServer.__init__(self, server_address, MyServiceHandler)
         ###### Options and default values ######
@@ -613,9 +3301,32 @@ class HttpFileServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
         # upload speed limit in bytes/sec
         self.OPT_UPLOAD_RATE_LIMIT = 1024 * 1024 * 10
 
+        # server-wide and per-client bandwidth caps, see BandwidthShaper.set_rates()
+        self.DOWNLOAD_SHAPER = BandwidthShaper()
+        self.UPLOAD_SHAPER = BandwidthShaper()
+
         # always save the file instead of opening in browser (client side)
         self.OPT_FORCE_SAVE = False
 
+        # Cache-Control header sent for each of CACHE_ROUTES
+        self.OPT_CACHE_CONTROL = dict(DEFAULT_CACHE_CONTROL)
+
+        # Number of worker threads serving connections; 0 starts a thread
+        # for every connection instead.
+        self.OPT_WORKERS = 32
+
+        # Connections waiting for a worker; more are answered with 503.
+        self.OPT_ACCEPT_QUEUE = 64
+
+        # Open connections allowed per client address (0: no limit)
+        self.OPT_MAX_CLIENT_CONNECTIONS = 0
+
+        # Seconds a persistent connection may wait for its next request
+        self.OPT_KEEPALIVE_TIMEOUT = 15
+
+        # Requests served on a connection before it is closed (0: no limit)
+        self.OPT_MAX_KEEPALIVE_REQUESTS = 100
+
         # The list of files appearing in the root of the virtual filesystem.
         self.SHARED_FILES = {}
         self.SHARED_FILES_LOCK = threading.Lock()
@@ -624,9 +3335,66 @@ class HttpFileServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
         # If the upload path is None, uploading will be disabled.
         self.UPLOAD_PATH = None
 
-        self.DOWNLOAD_UUID = {} # map uuid to filelist
-        self.DOWNLOAD_UUID_LOCK = threading.Lock()
+        # file lists posted for archive downloads, by download id; see
+        # DownloadStore. With reusable downloads a tar.gz download doesn't
+        # remove its list, so that it can be fetched again until it expires
+        self.DOWNLOADS = DownloadStore()
+        self.OPT_REUSABLE_DOWNLOADS = False
+
+        # files the upload page sends at the same time, and pieces of a file
+        # it sends in parallel
+        self.OPT_UPLOAD_CONCURRENCY = UPLOAD_CONCURRENCY
+        self.OPT_UPLOAD_STREAMS = UPLOAD_STREAMS
+
+        # Rendered directory listings; see ListingCache
+        self.LISTING_CACHE = ListingCache()
+
+        # Entries shown on one listing page (0: no limit)
+        self.OPT_LISTING_PAGE_SIZE = LISTING_PAGE_SIZE
+
+        # whether STATUS_PREFIX shows the server's counters
+        self.OPT_ENABLE_STATUS = False
+
+        # threads gzipping tar downloads (0: the request thread compresses
+        # them), their compression level, whether the level is adapted to
+        # each download (see AdaptiveGzipLevel), and the levels used
+        self.OPT_GZIP_WORKERS = GZIP_WORKERS
+        self.OPT_GZIP_LEVEL = GZIP_LEVEL
+        self.OPT_ADAPTIVE_GZIP = False
+        self.GZIP_STATS = GzipStats()
 
+        # map the id of an upload session to the [start, end) ranges being
+        # written to it; ALL_RANGES stands for the whole session
+        self.ACTIVE_UPLOADS = {}
+        self.ACTIVE_UPLOADS_LOCK = threading.Lock()
+
+        # map the id of an upload session being written to to the lock
+        # serializing the updates of its state file
+        self.UPLOAD_STATE_LOCKS = {}
+
+        # blocks in which uploads are received; see receive_into_file()
+        self.UPLOAD_BUFFERS = BufferPool()
+
+        # map the id of an upload session with digests to verify to the
+        # Digester of the data received so far without gaps
+        self.UPLOAD_DIGESTERS = {}
+
+        # algorithm of the digest sent with downloads (None: no digests),
+        # and the digests of shared files; see DigestCache
+        self.OPT_DIGEST = DIGEST_ALGORITHM
+        self.DIGEST_CACHE = DigestCache()
+
+        # where uploads are stored with --dedup; see ObjectStore
+        self.OBJECT_STORE = None
+
+        # generated tar.gz downloads kept with --archive-cache; see ArchiveCache
+        self.ARCHIVE_CACHE = None
+
+        self.CLIENT_CONNECTIONS = {} # map client address to open connections
+        self.CLIENT_CONNECTIONS_LOCK = threading.Lock()
+
+        self._worker_pool = None
+        self._gzip_pool = None
         self._running = False
         self._state_lock = threading.Lock()
 
@@ -659,17 +3427,193 @@ class HttpFileServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
             return self.SHARED_FILES.keys()
 
     def push_download(self, fileList, uuid):
-        with self.DOWNLOAD_UUID_LOCK:
-            self.DOWNLOAD_UUID[uuid] = fileList
+        """ Returns False if fileList is too large to be kept. """
+        return self.DOWNLOADS.push(uuid, fileList)
+
+    def peek_download(self, uuid):
+        return self.DOWNLOADS.peek(uuid)
 
     def pop_download(self, uuid):
-        with self.DOWNLOAD_UUID_LOCK:
-            if uuid in self.DOWNLOAD_UUID: # return and remove the download request
-                fileList = self.DOWNLOAD_UUID[uuid]
-                self.DOWNLOAD_UUID.pop(uuid)
-                return fileList
+        return self.DOWNLOADS.pop(uuid)
+
+    def begin_upload(self, id, claim=ALL_RANGES):
+        """ Mark a range of an upload session as being written to. Returns
+            False if a request is writing to an overlapping range already. """
+        with self.ACTIVE_UPLOADS_LOCK:
+            active = self.ACTIVE_UPLOADS.setdefault(id, [])
+            for first, last in active:
+                if first < claim[1] and claim[0] < last:
+                    return False
+            active.append(claim)
+            self.UPLOAD_STATE_LOCKS.setdefault(id, threading.Lock())
+            return True
+
+    def end_upload(self, id, claim=ALL_RANGES):
+        with self.ACTIVE_UPLOADS_LOCK:
+            active = self.ACTIVE_UPLOADS.get(id, [])
+            active.remove(claim)
+            if not active:
+                del self.ACTIVE_UPLOADS[id]
+                del self.UPLOAD_STATE_LOCKS[id]
+
+    def record_upload(self, session, start, end):
+        """ Add a received range to the state of an upload session, which
+            the caller is writing to (see begin_upload()). The state file is
+            rewritten under the lock of the session only, so that other
+            sessions are not held up. """
+        with self.ACTIVE_UPLOADS_LOCK:
+            lock = self.UPLOAD_STATE_LOCKS[session.id]
+        with lock:
+            session.add_range(start, end)
+
+    def take_upload_digester(self, session, offset=None):
+        """ Take the Digester of an upload session that has digests to
+            verify, so that the caller can advance it. Returns None if the
+            session has none, another request has taken it, or it doesn't
+            stand at offset. It is given back with put_upload_digester(). """
+        algorithms = set(session.digests)
+        if self.OBJECT_STORE is not None:
+            algorithms.add(UPLOAD_OBJECT_DIGEST)
+        if not algorithms:
+            return None
+        with self.ACTIVE_UPLOADS_LOCK:
+            digester = self.UPLOAD_DIGESTERS.get(session.id)
+            if digester is None: # new session, or the server was restarted
+                digester = Digester(algorithms)
+            elif digester is UPLOAD_DIGESTER_TAKEN:
+                return None
+            if offset is not None and digester.offset != offset:
+                self.UPLOAD_DIGESTERS[session.id] = digester
+                return None
+            self.UPLOAD_DIGESTERS[session.id] = UPLOAD_DIGESTER_TAKEN
+            return digester
+
+    def put_upload_digester(self, session, digester):
+        with self.ACTIVE_UPLOADS_LOCK:
+            self.UPLOAD_DIGESTERS[session.id] = digester
+
+    def forget_upload_digester(self, session):
+        with self.ACTIVE_UPLOADS_LOCK:
+            self.UPLOAD_DIGESTERS.pop(session.id, None)
+
+    def expire_upload_sessions(self):
+        """ Remove the abandoned upload sessions, and their digesters. """
+        expired = expire_upload_sessions(get_upload_session_dir(self.UPLOAD_PATH))
+        with self.ACTIVE_UPLOADS_LOCK:
+            for id in expired:
+                self.UPLOAD_DIGESTERS.pop(id, None)
+
+    def get_gzip_pool(self):
+        """ Create the pool compressing tar downloads on first use. """
+        with self._state_lock:
+            if self._gzip_pool is None:
+                self._gzip_pool = WorkerPool(self.OPT_GZIP_WORKERS)
+            return self._gzip_pool
+
+    def get_file_crc(self, member):
+        """ Return the CRC-32 of an ArchiveMember, computing it only if it is
+            not in the digest cache. """
+        crc = self.DIGEST_CACHE.get(member.st, "crc32")
+        if crc is not None:
+            return int(crc, 16)
+        crc = file_crc32(member.path, member.size)
+        try:
+            unchanged = DigestCache.key(os.stat(member.path)) == DigestCache.key(member.st)
+        except OSError:
+            unchanged = False
+        if unchanged:
+            self.DIGEST_CACHE.put(member.st, "crc32", "%08x" % (crc))
+        return crc
+
+    def get_worker_pool(self):
+        """ Create the worker pool on first use, after the options are set. """
+        with self._state_lock:
+            if self._worker_pool is None:
+                self._worker_pool = WorkerPool(self.OPT_WORKERS or ASYNC_WORKERS,
+                                               self.OPT_ACCEPT_QUEUE)
+            return self._worker_pool
+
+    def acquire_client_slot(self, client):
+        """ Count a new connection from client.
+            Returns False if the client has too many connections already. """
+        with self.CLIENT_CONNECTIONS_LOCK:
+            count = self.CLIENT_CONNECTIONS.get(client, 0)
+            if self.OPT_MAX_CLIENT_CONNECTIONS and count >= self.OPT_MAX_CLIENT_CONNECTIONS:
+                return False
+            self.CLIENT_CONNECTIONS[client] = count + 1
+            return True
+
+    def release_client_slot(self, client):
+        with self.CLIENT_CONNECTIONS_LOCK:
+            count = self.CLIENT_CONNECTIONS.get(client, 0) - 1
+            if count > 0:
+                self.CLIENT_CONNECTIONS[client] = count
             else:
-                return []
+                self.CLIENT_CONNECTIONS.pop(client, None)
+
+    def process_request(self, request, client_address):
+        """ Hand the connection to a worker, or turn it away with 503
+            if the client has too many connections or the queue is full. """
+        client = client_address[0]
+        if not self.acquire_client_slot(client):
+            WRITE_LOG(_("Too many connections, request rejected"), client)
+            self.reject_request(request, _("Too many connections from your address."))
+        elif self.OPT_WORKERS == 0:
+            ThreadingMixIn.process_request(self, request, client_address)
+        elif not self.get_worker_pool().submit(self.process_pooled_request,
+                                               request, client_address):
+            self.release_client_slot(client)
+            WRITE_LOG(_("Server busy, request rejected"), client)
+            self.reject_request(request, _("The server is busy. Please try again later."))
+
+    def process_request_thread(self, request, client_address):
+        """ Thread-per-connection mode (OPT_WORKERS == 0) """
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.release_client_slot(client_address[0])
+
+    def process_pooled_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.release_client_slot(client_address[0])
+
+    def reject_request(self, request, message):
+        """ Answer 503 on the accepting thread without reading the request. """
+        try:
+            request.settimeout(1)
+            request.sendall(generate_service_unavailable_response(message))
+            request.setblocking(False)
+            request.recv(LOOP_MAX_HEAD_SIZE) # avoid a reset that could eat the reply
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def get_status(self):
+        """ Return the counters shown at STATUS_PREFIX as (name, value) pairs. """
+        cache = self.LISTING_CACHE
+        with self.CLIENT_CONNECTIONS_LOCK:
+            connections = sum(self.CLIENT_CONNECTIONS.values())
+        return [("connections", connections),
+                ("listing_cache_records", len(cache)),
+                ("listing_cache_hits", cache.hits),
+                ("listing_cache_misses", cache.misses),
+                ("listing_cache_invalidations", cache.invalidations),
+                ("digest_cache_records", len(self.DIGEST_CACHE)),
+                ("downloads_pending", len(self.DOWNLOADS)),
+                ("downloads_expired", self.DOWNLOADS.expired),
+                ("dedup_hits", self.OBJECT_STORE.hits if self.OBJECT_STORE else 0),
+                ("archive_cache_hits", self.ARCHIVE_CACHE.hits if self.ARCHIVE_CACHE else 0),
+                ("archive_cache_misses", self.ARCHIVE_CACHE.misses if self.ARCHIVE_CACHE else 0),
+                ("archive_cache_bytes", self.ARCHIVE_CACHE.get_size() if self.ARCHIVE_CACHE else 0),
+                ("gzip_level", self.GZIP_STATS.level if self.GZIP_STATS.level is not None
+                               else self.OPT_GZIP_LEVEL)] \
+            + [("gzip_blocks_level_%d" % (level), blocks)
+               for level, blocks in self.GZIP_STATS.get_blocks()]
 
     def start(self):
         with self._state_lock:
@@ -691,16 +3635,107 @@ class HttpFileServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
 class MyServiceHandler(SimpleHTTPRequestHandler):
     """ This class provides HTTP service to the client """
 
+    # persistent connections; every response carries a Content-Length,
+    # is chunked, or closes the connection
+    protocol_version = "HTTP/1.1"
+
+    # True while answering a HEAD request: headers are sent, bodies are not.
+    head_only = False
+
+    # number of requests already served on this connection
+    requests_served = 0
+
+    # True while the socket timeout is the keep-alive idle timeout
+    waiting_idle = False
+
     def __init__(self, request, client_address, server):
         try:
             SimpleHTTPRequestHandler.__init__(self, request, client_address, server)
         except Exception as e:
+            self.close_connection = 1
             DEBUG("Request from client %s has failed." % (client_address[0]))
             DEBUG(str(e))
 
     def log_message(self, format, *args):
         DEBUG("HTTP Server: " + (format % args))
 
+    def handle(self):
+        """ Serve requests until the client closes the connection, stays idle
+            for OPT_KEEPALIVE_TIMEOUT seconds, OPT_MAX_KEEPALIVE_REQUESTS
+            requests have been served, or the worker it holds is needed for a
+            queued connection while it is idle. """
+        self.close_connection = 1
+        self.serve_one_request()
+        while not self.close_connection:
+            self.serve_one_request()
+
+    def serve_one_request(self):
+        if self.server.OPT_WORKERS and not self.wait_for_request():
+            self.close_connection = 1
+            return
+        self.connection.settimeout(self.server.OPT_KEEPALIVE_TIMEOUT or None)
+        self.waiting_idle = True
+        self.handle_one_request()
+        self.requests_served += 1
+
+    def wait_for_request(self):
+        """ Wait for the next request without reading it, so that the
+            connection can be closed cleanly while it is idle. Returns False
+            after OPT_KEEPALIVE_TIMEOUT seconds, or as soon as connections are
+            queued for a worker of the pool. """
+        buffered = getattr(self.rfile, "_rbuf", None)
+        if buffered is not None and buffered.getvalue(): # a pipelined request
+            return True
+        pool = self.server.get_worker_pool()
+        timeout = self.server.OPT_KEEPALIVE_TIMEOUT
+        deadline = (time.time() + timeout if timeout else None)
+        while True:
+            wait = KEEPALIVE_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return False
+            if select.select([self.connection], [], [], wait)[0]:
+                return True
+            if pool.claim_release():
+                DEBUG("Idle connection from %s closed for a queued one"
+                      % (self.client_address[0]))
+                return False
+
+    def parse_request(self):
+        if self.waiting_idle: # the request has arrived; no timeout for transfers
+            self.connection.settimeout(None)
+            self.waiting_idle = False
+        return SimpleHTTPRequestHandler.parse_request(self)
+
+    def send_response(self, code, message=None):
+        SimpleHTTPRequestHandler.send_response(self, code, message)
+        limit = self.server.OPT_MAX_KEEPALIVE_REQUESTS
+        if limit and self.requests_served + 1 >= limit:
+            self.send_header("Connection", "close")
+        elif self.request_version == "HTTP/1.0" and not self.close_connection:
+            self.send_header("Connection", "keep-alive")
+
+    def start_chunked_body(self):
+        """ Start a body of unknown length after the other headers have been
+            sent. Returns a writer whose close() ends the body; clients older
+            than HTTP/1.1 get a plain body ended by closing the connection. """
+        if self.request_version >= "HTTP/1.1":
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            return ChunkedWriter(self.wfile)
+        self.send_header("Connection", "close")
+        self.end_headers()
+        return UnframedWriter(self.wfile)
+
+    def do_HEAD(self):
+        """ Handle http HEAD request: the same as GET without the body. """
+        self.head_only = True
+        try:
+            self.do_GET()
+        finally:
+            self.head_only = False
+
     def do_GET(self):
         """ Handle http GET request from client. """
         path = urllib.unquote(self.path)
@@ -724,8 +3759,15 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
                 """ Handle directory listing. """
                 DEBUG("List Dir: " + localpath)
                 is_download_mode = self.server.OPT_ALLOW_DOWNLOAD_TAR and (self.get_param("dlmode") == "1")
-                content = self.generate_folder_listing(path, localpath, is_download_mode)
-                self.send_html(content)
+                format = self.get_param("format")
+                if format not in LISTING_FORMATS:
+                    format = "html"
+                if format == "ndjson" and self.get_param("recursive") == "1":
+                    self.send_stream(self.iter_manifest(path, localpath),
+                                     LISTING_FORMATS[format], route=CACHE_LISTING)
+                else:
+                    self.send_folder_listing(path, localpath, is_download_mode,
+                                             self.get_listing_view(), format)
 
             elif is_file(localpath):
                 """ Handle file downloading. """
@@ -738,6 +3780,7 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
                     t0 = time.time()
                     size = self.send_file(localpath
                                           , RateLimit=self.server.OPT_RATE_LIMIT
+                                          , AllowCache=True
                                           , AsAttchment = self.server.OPT_FORCE_SAVE)
                     seconds = time.time() - t0
 
@@ -750,6 +3793,7 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
                     WRITE_LOG((_("Fully Downloaded %s")  + " - %s @ %d sec %s")
                         % (path, hrs(size), seconds, download_rate), client)
                 except Exception as e:
+                    self.close_connection = 1 # the body may have been cut short
                     WRITE_LOG(_("Downloading Failed: %s") % (path), client)
                     DEBUG("Downloading Failed: " + localpath + " (" + e.message + ")")
 
@@ -760,11 +3804,17 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
         elif path == "/": # redirect '/' to /PREFIX
             self.send_html(generate_redirect_html(PREFIX))
         elif self.server.OPT_ALLOW_DOWNLOAD_TAR and path == DOWNLOAD_TAR_PREFIX:
-            self.send_tar_download(self.get_param("id"))
+            self.send_tar_download(self.get_param("id"), self.get_param("format"))
+        elif self.server.UPLOAD_PATH and path == UPLOAD_PREFIX and self.get_param("session"):
+            self.send_upload_status(self.get_param("session"))
         elif self.server.UPLOAD_PATH and path == UPLOAD_PREFIX:
-            self.send_html(generate_upload_html())
+            self.send_html(generate_upload_html(self.server.OPT_UPLOAD_CONCURRENCY,
+                                                self.server.OPT_UPLOAD_STREAMS))
+        elif self.server.OPT_ENABLE_STATUS and path == STATUS_PREFIX:
+            self.send_text("".join("%s %s\n" % (name, value)
+                                   for name, value in self.server.get_status()))
         else: # data file
-            self.send_response(HTTP_NOTFOUND, "Not Found")
+            self.send_html(generate_file_not_found_html(path), HTTP_NOTFOUND)
 
     def do_POST(self):
         path = urllib.unquote(self.path)
@@ -777,9 +3827,14 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
         if self.server.OPT_ALLOW_DOWNLOAD_TAR and path == DOWNLOAD_TAR_PREFIX:
             """ handle client downloading tar archive """
             clength = int(self.headers.dict['content-length'])
+            if clength > DOWNLOAD_MAX_REQUEST:
+                self.close_connection = 1 # the request body is not read
+                self.send_html(generate_too_many_files_html(), HTTP_ENTITY_TOO_LARGE)
+                return
             content = urllib.unquote_plus(self.rfile.read(clength))
             virtualpath = self.get_param("r")
             fileList = []
+            format = ARCHIVE_TGZ
 
             for pair in content.split("&"):
                 try:
@@ -788,6 +3843,8 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
                     key, value = (pair, "")
                 if key == "chkfiles[]":
                     fileList.append(value)
+                elif key == "format" and value in ARCHIVE_FORMATS:
+                    format = value
 
             if virtualpath != None:
                 redirect_html_body = """
@@ -813,80 +3870,458 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
 
             if len(fileList) != 0:
                 retrieve_code = str(uuid.uuid4())
-                self.server.push_download(fileList, retrieve_code)
+                if not self.server.push_download(fileList, retrieve_code):
+                    WRITE_LOG(_("Download of %d files refused: the list is too long")
+                              % (len(fileList)), self.client_address[0])
+                    self.send_html(generate_too_many_files_html(), HTTP_ENTITY_TOO_LARGE)
+                    return
                 self.send_html(
                     generate_redirect_html(DOWNLOAD_TAR_PREFIX + "?id=" + retrieve_code
-                                           , body=redirect_html_body))
+                                           + "&format=" + format, body=redirect_html_body))
             else:
                 self.send_html(generate_redirect_html(virtualpath))
+        elif self.server.UPLOAD_PATH and path == UPLOAD_PREFIX and self.get_param("session"):
+            self.finalize_upload(self.get_param("session"))
+        elif self.server.UPLOAD_PATH and path == UPLOAD_PREFIX and self.get_param("resumable") == "1":
+            self.create_upload()
+        elif self.server.UPLOAD_PATH and path == UPLOAD_PREFIX and self.get_param("extract") == "1":
+            self.receive_tar_upload()
         elif self.server.UPLOAD_PATH and path == UPLOAD_PREFIX: # new upload
             """ handle client uploading file """
             self.receive_post_multipart_file()
+        else:
+            self.close_connection = 1 # the request body is not read
+            self.send_html(generate_file_not_found_html(path), HTTP_NOTFOUND)
+
+    def do_PATCH(self):
+        """ Handle http PATCH request: a piece of a resumable upload. """
+        path = urllib.unquote(self.path)
+        DEBUG("HTTP PATCH Request: " + path)
+        self.parse_params()
+        path = path.split("?")[0]
+        if self.server.UPLOAD_PATH and path == UPLOAD_PREFIX and self.get_param("session"):
+            self.receive_upload_chunk(self.get_param("session"))
+        else:
+            self.close_connection = 1
+            self.send_html(generate_file_not_found_html(path), HTTP_NOTFOUND)
+
+    def do_DELETE(self):
+        """ Handle http DELETE request: cancel a resumable upload. """
+        path = urllib.unquote(self.path)
+        DEBUG("HTTP DELETE Request: " + path)
+        self.parse_params()
+        path = path.split("?")[0]
+        session = None
+        if self.server.UPLOAD_PATH and path == UPLOAD_PREFIX:
+            session = load_upload_session(self.server.UPLOAD_PATH, self.get_param("session"))
+        if session is None:
+            self.send_html(generate_file_not_found_html(path), HTTP_NOTFOUND)
+        elif not self.server.begin_upload(session.id):
+            self.send_upload_state(session, HTTP_CONFLICT)
+        else:
+            try:
+                session.remove()
+                self.server.forget_upload_digester(session)
+            finally:
+                self.server.end_upload(session.id)
+            WRITE_LOG(_("Upload cancelled: %s") % (session.filename), self.client_address[0])
+            self.send_response(HTTP_NOCONTENT)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
 
     def receive_post_multipart_file(self):
-        blength = multipart_boundary_length(self.headers.dict["content-type"])
-        if blength == 0: # incorrect header
+        """ Save every file in a multipart/form-data upload to UPLOAD_PATH and
+            answer with the result of each, in HTML or, with format=json, as
+            a JSON object. Form fields without a file are ignored. """
+        ctype, params = cgi.parse_header(self.headers.get("content-type", ""))
+        length = self.headers.get("content-length", "")
+        if ctype != "multipart/form-data" or not params.get("boundary") or not length.isdigit():
+            self.close_connection = 1 # incorrect header
+            self.send_html("<html><body>Bad upload request</body></html>", HTTP_BAD_REQUEST)
             return
-        blength += 8
-        flength = int(self.headers.dict["content-length"])
-        filename = "received-" + str(datetime.now())
-        while 1: # skip header
-            line = self.rfile.readline()
-            flength -= len(line)
-            if line.upper().startswith("CONTENT-DISPOSITION:"):
-                match = re.search("filename=\"([^\"]*)\"", line, re.I)
-                if match:
-                    filename = match.group(1)
-            if line == "\r\n":
-                break
-
-        flength -= blength
 
         client_addr = self.client_address[0]
+        reader = MultipartReader(self.rfile, params["boundary"], int(length))
+        results = [] # (filename, size or None if failed)
+        response = HTTP_OK
+        try:
+            with self.server.UPLOAD_SHAPER.transfer(client_addr,
+                    self.server.OPT_UPLOAD_RATE_LIMIT) as throttle:
+                part = reader.next_part()
+                while part is not None:
+                    if part.filename:
+                        filename = safe_filename(part.filename) or \
+                            "received-" + str(datetime.now())
+                        expected = get_expected_digests(part.headers)
+                        if expected is None:
+                            WRITE_LOG(_("Failed to receive file: %s") % (filename), client_addr)
+                            size = None
+                        else:
+                            size = self.save_received_file(filename, part.readinto, throttle,
+                                                           expected, MultipartError)
+                        results.append((filename, size))
+                    part = reader.next_part()
+            if not reader.finish():
+                self.close_connection = 1
+        except MultipartError as e:
+            DEBUG("Upload Exception: " + str(e))
+            self.close_connection = 1 # the body may have been left half read
+            response = HTTP_BAD_REQUEST
+
+        if not results or None in [size for filename, size in results]:
+            self.close_connection = 1
+            if response == HTTP_OK:
+                response = HTTP_NOTFOUND
+        if self.get_param("format") == "json":
+            files = [{"name": filename, "size": size, "status": "error" if size is None else "ok"}
+                     for filename, size in results]
+            self.send_data(json.dumps({"files": files}), "application/json", response)
+            return
+        body = "".join(("<p>Successfully uploaded %s</p>" if size is not None else
+                        "<p>Failed to upload %s</p>") % (cgi.escape(filename))
+                       for filename, size in results)
+        self.send_html("<html><body>%s</body></html>" % (body or "Nothing uploaded"), response)
+
+    def receive_tar_upload(self):
+        """ Extract a tar archive, plain or compressed, sent as the body of a
+            POST into UPLOAD_PATH while it arrives, so that the archive is
+            never stored. Members that would leave UPLOAD_PATH, links and
+            special files are skipped. Answers with the number of files
+            extracted and the members skipped or failed, in HTML or, with
+            format=json, as a JSON object. """
+        length = self.get_digit_header("Content-Length")
+        if length is None:
+            self.close_connection = 1 # the request body is not read
+            self.send_html("<html><body>Bad upload request</body></html>", HTTP_BAD_REQUEST)
+            return
 
-        WRITE_LOG(_("Start receiving file: %(FILE)s (%(SIZE)s)") \
-                  % {"FILE": filename, "SIZE": human_readable_size(flength)}, client_addr)
-
-        t0 = time.time()
+        client_addr = self.client_address[0]
+        WRITE_LOG(_("Start extracting archive (%s)") % (human_readable_size(length)), client_addr)
+        source_errors = (tarfile.TarError, EOFError, zlib.error)
+        extracted = 0
+        total = 0
+        skipped = []
+        failed = []
+        response = HTTP_OK
+        try:
+            with self.server.UPLOAD_SHAPER.transfer(client_addr,
+                    self.server.OPT_UPLOAD_RATE_LIMIT) as throttle:
+                body = RequestBody(self.rfile, length, throttle)
+                with tarfile.open(fileobj=body, mode="r|*", bufsize=MULTIPART_BLOCK_SIZE) as tar:
+                    for member in tar:
+                        path = safe_member_path(member.name)
+                        if path is None or not (member.isfile() or member.isdir()):
+                            DEBUG("receive_tar_upload: skip " + member.name)
+                            skipped.append(member.name)
+                        elif member.isdir():
+                            if not self.make_upload_dir(path):
+                                failed.append(member.name)
+                        elif not self.make_upload_dir(os.path.dirname(path)):
+                            failed.append(member.name)
+                        else:
+                            readinto = make_member_readinto(tar.extractfile(member), member.size)
+                            # the body is throttled already
+                            size = self.save_received_file(path, readinto, Throttle([]), {},
+                                                           source_errors)
+                            if size is None:
+                                failed.append(member.name)
+                            else:
+                                extracted += 1
+                                total += size
+            if not body.finish():
+                self.close_connection = 1
+        except source_errors as e:
+            DEBUG("Extract Exception: " + str(e))
+            self.close_connection = 1 # the body may have been left half read
+            response = HTTP_BAD_REQUEST
+        WRITE_LOG(_("Extracted %(COUNT)d files (%(SIZE)s) from archive") %
+                  {"COUNT": extracted, "SIZE": human_readable_size(total)}, client_addr)
+
+        if failed and response == HTTP_OK:
+            response = HTTP_NOTFOUND
+        if self.get_param("format") == "json":
+            self.send_data(json.dumps({"extracted": extracted, "size": total,
+                                       "skipped": skipped, "failed": failed,
+                                       "status": "ok" if response == HTTP_OK else "error"}),
+                           "application/json", response)
+            return
+        html = "<p>Extracted %d files (%s)</p>" % (extracted, human_readable_size(total))
+        if response == HTTP_BAD_REQUEST:
+            html += "<p>The archive is damaged or incomplete</p>"
+        html += "".join("<p>Skipped %s</p>" % (cgi.escape(name)) for name in skipped)
+        html += "".join("<p>Failed to extract %s</p>" % (cgi.escape(name)) for name in failed)
+        self.send_html("<html><body>%s</body></html>" % (html), response)
+
+    def make_upload_dir(self, path):
+        """ Create the directory path, relative to UPLOAD_PATH, with its
+            parents. Returns False if that fails or a symbolic link would
+            take it outside of UPLOAD_PATH. """
+        upload_path = os.path.realpath(self.server.UPLOAD_PATH)
+        fullpath = os.path.realpath(os.path.join(upload_path, path))
+        if fullpath != upload_path and not fullpath.startswith(os.path.join(upload_path, "")):
+            return False
+        try:
+            if not os.path.isdir(fullpath):
+                os.makedirs(fullpath)
+        except OSError as e:
+            DEBUG("Upload Directory Exception: " + str(e))
+            return False
+        return True
+
+    def get_digit_header(self, name):
+        """ Return the value of a header holding a non-negative integer,
+            or None if it is missing or malformed. """
+        value = self.headers.get(name, "").strip()
+        return int(value) if value.isdigit() else None
+
+    def create_upload(self):
+        """ Start a resumable upload of a file of Upload-Length bytes named
+            by X-File-Name. The upload is written with PATCH requests to the
+            address in the Location header and completed with a POST there,
+            which fails if the file doesn't have the digest given in a
+            Repr-Digest or Digest header. """
+        length = self.get_digit_header("Upload-Length")
+        filename = safe_filename(urllib.unquote(self.headers.get("X-File-Name", "")))
+        digests = get_expected_digests(self.headers)
+        self.discard_request_body()
+        if length is None or filename is None or digests is None:
+            self.send_html("<html><body>Bad upload request</body></html>", HTTP_BAD_REQUEST)
+            return
+        if self.link_stored_upload(filename, length, digests):
+            return
+        try:
+            self.server.expire_upload_sessions()
+            session = create_upload_session(self.server.UPLOAD_PATH, filename, length, digests)
+        except (IOError, OSError) as e:
+            DEBUG("Upload Session Exception: " + str(e))
+            self.send_html("<html><body>Failed to upload %s</body></html>"
+                           % (cgi.escape(filename)), HTTP_NOTFOUND)
+            return
+        WRITE_LOG(_("Start receiving file: %(FILE)s (%(SIZE)s)")
+                  % {"FILE": filename, "SIZE": human_readable_size(length)},
+                  self.client_address[0])
+        self.send_upload_state(session, HTTP_CREATED)
+
+    def link_stored_upload(self, filename, length, digests):
+        """ With --dedup, complete an upload at once if the object store has
+            a file of that length and digest, answering 200 instead of 201.
+            Returns False if the data has to be sent. """
+        store = self.server.OBJECT_STORE
+        digest = digests.get(UPLOAD_OBJECT_DIGEST)
+        if store is None or digest is None or not store.link_stored(
+                digest, length, os.path.join(self.server.UPLOAD_PATH, filename)):
+            return False
+        WRITE_LOG(_("Received file from the object store: %(FILE)s (%(SIZE)s)")
+                  % {"FILE": filename, "SIZE": human_readable_size(length)},
+                  self.client_address[0])
+        self.send_data(json.dumps({"name": filename, "size": length, "stored": True}),
+                       "application/json")
+        return True
+
+    def send_upload_status(self, id):
+        """ Answer GET and HEAD on a resumable upload with its offset. """
+        session = load_upload_session(self.server.UPLOAD_PATH, id)
+        if session is None:
+            self.send_html(generate_file_not_found_html(UPLOAD_PREFIX), HTTP_NOTFOUND)
+        else:
+            self.send_upload_state(session)
 
-        if self.save_received_file(filename, self.rfile, flength):
-            seconds = time.time() - t0
-            if seconds > 0:
-                rate_str = "@ " + human_readable_size(flength / seconds) + "/s"
+    def send_upload_state(self, session, response=HTTP_OK):
+        offset = session.get_offset()
+        content = json.dumps({"session": session.id, "name": session.filename,
+                              "offset": offset, "length": session.length,
+                              "ranges": session.ranges})
+        self.send_response(response)
+        self.send_header("Location", UPLOAD_PREFIX + "?session=" + session.id)
+        self.send_header("Upload-Offset", str(offset))
+        self.send_header("Upload-Ranges", format_ranges(session.ranges))
+        self.send_header("Upload-Length", str(session.length))
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if not self.head_only:
+            self.wfile.write(content)
+
+    def receive_upload_chunk(self, id):
+        """ Write the body of a PATCH request to a resumable upload at the
+            offset given in Upload-Offset. Pieces may come in any order and
+            over parallel connections, but a piece overlapping one that is
+            still being written is answered with 409. """
+        session = load_upload_session(self.server.UPLOAD_PATH, id)
+        offset = self.get_digit_header("Upload-Offset")
+        count = self.get_digit_header("Content-Length")
+        if session is None or offset is None or count is None:
+            self.close_connection = 1 # the request body is not read
+            if session is None:
+                self.send_html(generate_file_not_found_html(UPLOAD_PREFIX), HTTP_NOTFOUND)
             else:
-                rate_str = ""
-            WRITE_LOG(_("Successfully received file: %(FILE)s (%(SIZE)s) %(RATE)s") % \
-                      {"FILE": filename, "SIZE": human_readable_size(flength), "RATE": rate_str}, \
-                      client_addr)
-            self.send_html("<html><body>Successfully uploaded %s</body></html>" \
-                           % (filename), HTTP_OK)
-        else:
-            WRITE_LOG(_("Failed to receive file: %s") % (filename), client_addr)
-            self.send_html("<html><body>Failed to upload %s</body></html>" \
-                           % (filename), HTTP_NOTFOUND)
+                self.send_html("<html><body>Bad upload request</body></html>", HTTP_BAD_REQUEST)
+            return
+        claim = (offset, offset + count)
+        if offset + count > session.length or not self.server.begin_upload(session.id, claim):
+            self.close_connection = 1
+            self.send_upload_state(session, HTTP_CONFLICT)
+            return
 
-        self.rfile.read(blength) # discard the remaining contents
+        # The piece right after the data digested so far is digested while
+        # it is received; the others are read back later by update_digest().
+        digester = self.server.take_upload_digester(session, offset)
+        try:
+            with self.server.UPLOAD_SHAPER.transfer(self.client_address[0],
+                    self.server.OPT_UPLOAD_RATE_LIMIT) as throttle:
+                written = session.write(offset, self.rfile, count, throttle,
+                                        self.server.UPLOAD_BUFFERS, digester)
+            if written > 0:
+                self.server.record_upload(session, offset, offset + written)
+            if digester is not None:
+                self.server.put_upload_digester(session, digester)
+                digester = None
+            self.update_digest(session)
+        except (IOError, OSError) as e:
+            DEBUG("Upload Chunk Exception: " + str(e))
+            self.close_connection = 1
+            self.send_upload_state(session, HTTP_NOTFOUND)
+            return
+        finally:
+            if digester is not None:
+                self.server.put_upload_digester(session, digester)
+            self.server.end_upload(session.id, claim)
+
+        if written < count: # the client is most likely gone
+            self.close_connection = 1
+        self.send_response(HTTP_NOCONTENT)
+        self.send_header("Upload-Offset", str(session.get_offset()))
+        self.send_header("Upload-Ranges", format_ranges(session.ranges))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
-    def save_received_file(self, filename, rfile, length):
+    def finalize_upload(self, id):
+        """ Complete a resumable upload whose data has all arrived. """
+        self.discard_request_body()
+        session = load_upload_session(self.server.UPLOAD_PATH, id)
+        if session is None:
+            self.send_html(generate_file_not_found_html(UPLOAD_PREFIX), HTTP_NOTFOUND)
+            return
+        if not self.server.begin_upload(session.id):
+            self.send_upload_state(session, HTTP_CONFLICT)
+            return
+        try:
+            session = load_upload_session(self.server.UPLOAD_PATH, id) or session
+            if not session.is_complete():
+                self.send_upload_state(session, HTTP_CONFLICT)
+                return
+            digester = self.update_digest(session)
+            if digester is not None and digester.mismatches(session.get_expected_digests()):
+                session.remove()
+                self.server.forget_upload_digester(session)
+                WRITE_LOG(_("Digest mismatch, file discarded: %s") % (session.filename),
+                          self.client_address[0])
+                self.send_data(json.dumps({"name": session.filename, "error": "digest mismatch"}),
+                               "application/json", HTTP_BAD_REQUEST)
+                return
+            store = self.server.OBJECT_STORE
+            if store is not None and digester is not None:
+                store.add(session.part_path, digester.hashes[UPLOAD_OBJECT_DIGEST].digest(),
+                          os.path.join(self.server.UPLOAD_PATH, session.filename))
+                session.remove()
+            else:
+                session.finalize(self.server.UPLOAD_PATH)
+            self.server.forget_upload_digester(session)
+        except (IOError, OSError) as e:
+            DEBUG("Upload Finalize Exception: " + str(e))
+            WRITE_LOG(_("Failed to receive file: %s") % (session.filename), self.client_address[0])
+            self.send_upload_state(session, HTTP_NOTFOUND)
+            return
+        finally:
+            self.server.end_upload(session.id)
+        WRITE_LOG(_("Successfully received file: %(FILE)s (%(SIZE)s) %(RATE)s") % \
+                  {"FILE": session.filename, "SIZE": human_readable_size(session.length),
+                   "RATE": ""}, self.client_address[0])
+        self.send_data(json.dumps({"name": session.filename, "size": session.length}),
+                       "application/json")
+
+    def update_digest(self, session):
+        """ Bring the Digester of an upload session up to the data received
+            without gaps, unless another request is using it. Returns it, or
+            None if the session has no digests to verify or it is in use. """
+        digester = self.server.take_upload_digester(session)
+        if digester is None:
+            return None
+        try:
+            session.update_digester(digester)
+        finally:
+            self.server.put_upload_digester(session, digester)
+        return digester
+
+    def discard_request_body(self):
+        """ Read and drop a small request body, so the connection can be
+            reused; close it after the response if the body is large. """
+        length = self.get_digit_header("Content-Length") or 0
+        if length > MULTIPART_BLOCK_SIZE:
+            self.close_connection = 1
+        elif length:
+            self.rfile.read(length)
+
+    def save_received_file(self, filename, readinto, throttle, expected, source_errors):
+        """ Save the data read by readinto() to UPLOAD_PATH/filename.
+            The data is written to a temporary file that is renamed when it
+            is complete, so that nobody sees a partly received file. The
+            file is only kept if its data has the expected digests.
+            Returns the size of the file, or None if it failed.
+            @param source_errors exceptions of a broken request body, which
+            are passed on since nothing more can be read from it """
+        client_addr = self.client_address[0]
         fullpath = os.path.join(self.server.UPLOAD_PATH, filename)
+        store = self.server.OBJECT_STORE
+        algorithms = set(expected)
+        if store is not None:
+            algorithms.add(UPLOAD_OBJECT_DIGEST)
+        digester = (Digester(algorithms) if algorithms else None)
+        WRITE_LOG(_("Start receiving file: %s") % (filename), client_addr)
+        t0 = time.time()
+        temp_path = None
         try:
-            with open(fullpath, "wb") as f:
-                left = length
-                rate_limit = self.server.OPT_UPLOAD_RATE_LIMIT / RECEIVE_CHUNK_SIZE
-                writer = RateLimitingWriter(f, rate_limit)
-                while left > 0:
-                    size = min(RECEIVE_CHUNK_SIZE, left)
-                    writer.write(rfile.read(size))
-                    left -= size
+            temp_path = os.path.join(get_upload_session_dir(self.server.UPLOAD_PATH),
+                                     uuid.uuid4().hex + ".upload")
+            with io.open(temp_path, "wb", buffering=0) as f:
+                size = receive_into_file(f, readinto, throttle,
+                                         self.server.UPLOAD_BUFFERS, None, digester)
+            if digester is not None and digester.mismatches(expected):
+                self.remove_received_file(temp_path)
+                WRITE_LOG(_("Digest mismatch, file discarded: %s") % (filename), client_addr)
+                return None
+            if store is not None:
+                store.add(temp_path, digester.hashes[UPLOAD_OBJECT_DIGEST].digest(), fullpath)
+            else:
+                replace_file(temp_path, fullpath)
+        except source_errors:
+            self.remove_received_file(temp_path)
+            WRITE_LOG(_("Failed to receive file: %s") % (filename), client_addr)
+            raise
         except Exception as e:
             DEBUG("Save File Exception: " + str(e))
+            self.remove_received_file(temp_path)
+            WRITE_LOG(_("Failed to receive file: %s") % (filename), client_addr)
+            return None
+
+        seconds = time.time() - t0
+        if seconds > 0:
+            rate_str = "@ " + human_readable_size(size / seconds) + "/s"
+        else:
+            rate_str = ""
+        WRITE_LOG(_("Successfully received file: %(FILE)s (%(SIZE)s) %(RATE)s") % \
+                  {"FILE": filename, "SIZE": human_readable_size(size), "RATE": rate_str}, \
+                  client_addr)
+        return size
+
+    def remove_received_file(self, fullpath):
+        if fullpath is None:
+            return
+        try:
+            os.remove(fullpath)
+        except OSError:
             pass
-        finally:
-            if os.path.getsize(fullpath) != length:
-                os.remove(fullpath)
-                return False
-            else:
-                return True
 
     def get_local_path(self, path):
         """ Translate a filename separated by "/" to the local file path. """
@@ -912,61 +4347,263 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
 
         return path
 
-    def send_text(self, content, format=None, response=HTTP_OK):
+    def send_text(self, content, format=None, response=HTTP_OK, route=CACHE_PAGE):
         if not format:
             format = "plain"
+        self.send_data(content, "text/%(FORMAT)s;charset=%(ENCODING)s"
+                       % {"FORMAT": format, "ENCODING": get_system_encoding()},
+                       response, route)
+
+    def send_html(self, content, response=HTTP_OK, route=CACHE_PAGE):
+        self.send_text(content, "html", response, route)
+
+    def send_xml(self, content, response=HTTP_OK, route=CACHE_PAGE):
+        self.send_text(content, "xml", response, route)
+
+    def send_data(self, content, content_type, response=HTTP_OK, route=CACHE_PAGE):
         self.send_response(response)
-        self.send_header("Content-Type", "text/%(FORMAT)s;charset=%(ENCODING)s"
-                    % {"FORMAT": format, "ENCODING": get_system_encoding()})
-        self.send_no_cache_header()
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_cache_header(route)
         self.end_headers()
-        self.wfile.write(content)
+        if not self.head_only:
+            self.wfile.write(content)
 
-    def send_html(self, content, response=HTTP_OK):
-        self.send_text(content, "html", response)
+    def send_text_stream(self, pieces, format=None, response=HTTP_OK, route=CACHE_PAGE):
+        if not format:
+            format = "plain"
+        self.send_stream(pieces, "text/%(FORMAT)s;charset=%(ENCODING)s"
+                         % {"FORMAT": format, "ENCODING": get_system_encoding()},
+                         response, route)
 
-    def send_xml(self, content, response=HTTP_OK):
-        self.send_text(content, "xml", response)
+    def send_stream(self, pieces, content_type, response=HTTP_OK, route=CACHE_PAGE):
+        """ Send the body produced by an iterable of strings with chunked
+            encoding, so it goes out while the rest is still being generated. """
+        self.send_response(response)
+        self.send_header("Content-Type", content_type)
+        self.send_cache_header(route)
+        body = self.start_chunked_body()
+        if self.head_only:
+            return
+        try:
+            buffered = []
+            size = 0
+            for piece in pieces:
+                buffered.append(piece)
+                size += len(piece)
+                if size >= STREAM_FLUSH_SIZE:
+                    body.write("".join(buffered))
+                    buffered = []
+                    size = 0
+            body.write("".join(buffered))
+        except Exception:
+            # the status line is gone already; cut the body short instead
+            self.close_connection = 1
+            raise
+        body.close()
 
     def send_file(self, filename, RateLimit=0, AllowCache=False, AsAttchment=False):
         """ Read the file and send it to the client.
-            If the function succeeds, it returns the file size in bytes.
+            If the function succeeds, it returns the number of body bytes sent.
+            Byte ranges requested by the client are answered with 206 Partial
+            Content (multipart/byteranges if more than one range is asked for).
+            AllowCache: send the CACHE_FILE policy and the validators, and
+            answer conditional requests with 304 Not Modified
             AsAttchment: prevent the file from being opened directly in the browser
+            The digest of the file is sent in Repr-Digest if it is in the
+            digest cache; otherwise it is computed while the whole file is
+            sent, for the following requests.
         """
-        self.send_response(HTTP_OK)
         type,encoding = mimetypes.guess_type(filename)
-        filesize = os.path.getsize(filename)
-        last_modified = self.date_time_string(int(os.path.getmtime(filename)))
-
-        self.send_header("Content-Type", "%(TYPE)s;charset=%(ENCODING)s" % \
-                         {"TYPE": type, "ENCODING": encoding})
-        self.send_header("Content-Length", str(filesize))
+        st = os.stat(filename)
+        filesize = st.st_size
+        last_modified = self.date_time_string(int(st.st_mtime))
+        etag = make_etag(st)
+        algorithm = self.server.OPT_DIGEST
+        digest = (self.server.DIGEST_CACHE.get(st, algorithm) if algorithm else None)
+        content_type = "%(TYPE)s;charset=%(ENCODING)s" % {"TYPE": type, "ENCODING": encoding}
+
+        if AllowCache and self.is_not_modified(etag, st.st_mtime):
+            self.send_response(HTTP_NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_cache_header(CACHE_FILE)
+            self.end_headers()
+            return 0
+
+        ranges = self.get_requested_ranges(filesize, last_modified, etag)
+        if ranges == []:
+            self.send_response(HTTP_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", "bytes */%d" % (filesize))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return 0
+
+        if ranges is None:
+            self.send_response(HTTP_OK)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(filesize))
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            self.send_response(HTTP_PARTIAL_CONTENT)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (first, last, filesize))
+            self.send_header("Content-Length", str(last - first + 1))
+        else:
+            boundary = uuid.uuid4().hex
+            part_headers = ["\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+                            % (boundary, content_type, first, last, filesize)
+                            for first, last in ranges]
+            trailer = "\r\n--%s--\r\n" % (boundary)
+            length = sum(len(h) for h in part_headers) + len(trailer) \
+                + sum(last - first + 1 for first, last in ranges)
+            self.send_response(HTTP_PARTIAL_CONTENT)
+            self.send_header("Content-Type", "multipart/byteranges; boundary=%s" % (boundary))
+            self.send_header("Content-Length", str(length))
+
+        self.send_header("Accept-Ranges", "bytes")
         self.send_header("Last-Modified", last_modified)
-        if not AllowCache:
+        if digest is not None:
+            for name, value in format_digest_headers(algorithm, digest):
+                self.send_header(name, value)
+        if AllowCache:
+            self.send_header("ETag", etag)
+            self.send_cache_header(CACHE_FILE)
+        else:
             self.send_no_cache_header()
         if AsAttchment:
             self.send_header("Content-Disposition", "attachment;filename=\"%s\""
                             % (suffix(filename)))
         self.end_headers()
 
-        if RateLimit == 0:
-            rate_limit = 0 # no limit
-        else:
-            rate_limit = float(RateLimit) / TRANSMIT_CHUNK_SIZE
-
-        writer = RateLimitingWriter(self.wfile, rate_limit)
+        if self.head_only:
+            return 0
 
-        with open(filename, "rb") as f:
-            while 1:
-                chunk = f.read(TRANSMIT_CHUNK_SIZE)
-                if chunk:
-                    writer.write(chunk)
+        try:
+            with open(filename, "rb") as f, \
+                    self.server.DOWNLOAD_SHAPER.transfer(self.client_address[0],
+                                                         RateLimit) as throttle:
+                if ranges is None:
+                    digester = None
+                    if algorithm and digest is None and DigestCache.accepts(st):
+                        digester = Digester([algorithm])
+                    self.copy_file(f, 0, filesize, throttle, digester)
+                    if digester is not None and digester.offset == filesize \
+                            and DigestCache.key(os.fstat(f.fileno())) == DigestCache.key(st):
+                        self.server.DIGEST_CACHE.put(st, algorithm, digester.digest(algorithm))
+                    return filesize
+                elif len(ranges) == 1:
+                    first, last = ranges[0]
+                    self.copy_file(f, first, last - first + 1, throttle)
+                    return last - first + 1
                 else:
-                    break
+                    for (first, last), header in zip(ranges, part_headers):
+                        self.wfile.write(header)
+                        self.copy_file(f, first, last - first + 1, throttle)
+                    self.wfile.write(trailer)
+                    return length
+        except Exception:
+            # the headers are gone already; cut the body short instead
+            self.close_connection = 1
+            raise
+
+    def get_requested_ranges(self, size, last_modified, etag=None):
+        """ Return the byte ranges requested by the client for an entity of
+            size bytes, or None if the whole entity should be sent.
+            See parse_byte_ranges() for the format of the result. """
+        header = self.headers.getheader("Range")
+        if header is None:
+            return None
+        if_range = self.headers.getheader("If-Range")
+        if if_range is not None:
+            if_range = if_range.strip()
+            if if_range.startswith('"') or if_range.startswith("W/"):
+                valid = etag is not None and etag_matches(if_range, etag, weak=False)
+            else:
+                valid = (if_range == last_modified)
+            if not valid:
+                return None # the client's copy is outdated; send the whole entity
+        return parse_byte_ranges(header, size)
+
+    def is_not_modified(self, etag, mtime):
+        """ Evaluate If-None-Match and If-Modified-Since for a GET/HEAD. """
+        if_none_match = self.headers.getheader("If-None-Match")
+        if if_none_match is not None: # takes precedence over If-Modified-Since
+            return etag_matches(if_none_match, etag)
+        if_modified_since = self.headers.getheader("If-Modified-Since")
+        if if_modified_since is not None:
+            since = parse_http_date(if_modified_since)
+            return since is not None and int(mtime) <= since
+        return False
+
+    def can_sendfile(self):
+        """ Whether the response body can be handed to the kernel, i.e.
+            sendfile() is available and wfile writes to a plain socket. """
+        if sendfile is None or type(self.connection) is not socket.socket:
+            return False
+        try:
+            return self.wfile.fileno() == self.connection.fileno()
+        except Exception:
+            return False
+
+    def copy_file(self, f, offset, length, throttle, digester=None):
+        """ Send length bytes of the opened file f starting at offset.
+            If there is a digester, the data is given to it as well, so the
+            file is read here instead of by sendfile() or the event loop. """
+        defer_file = getattr(self.wfile, "defer_file", None)
+        if defer_file is not None and digester is None: # the event loop sends the file by itself
+            defer_file(f, offset, length, throttle)
+            return
 
-        return filesize
+        if self.can_sendfile() and digester is None:
+            self.wfile.flush()
+            self.sendfile_copy(f, offset, length, throttle)
+            return
 
-    def send_tar(self, virtualpaths, ArchiveName=None, RateLimit=0):
+        f.seek(offset)
+        left = length
+        while left > 0:
+            chunk = f.read(min(throttle.quantum, left))
+            if not chunk: # the file shrank; the body can't be completed
+                raise IOError("%s: unexpected end of file" % (f.name))
+            throttle.wait(len(chunk))
+            if digester is not None:
+                digester.update(chunk)
+            self.wfile.write(chunk)
+            left -= len(chunk)
+
+    def sendfile_copy(self, f, offset, length, throttle):
+        """ Zero-copy transfer with sendfile(), one throttle quantum at a time. """
+        out_fd = self.connection.fileno()
+        in_fd = f.fileno()
+        timeout = self.connection.gettimeout()
+        end = offset + length
+        while offset < end:
+            count = min(throttle.quantum, end - offset)
+            throttle.wait(count)
+            while count > 0:
+                try:
+                    sent = sendfile(out_fd, in_fd, offset, count)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        # the socket has a timeout and is non-blocking internally
+                        ready = select.select([], [out_fd], [], timeout)[1]
+                        if not ready:
+                            raise socket.timeout("timed out")
+                        continue
+                    raise
+                if sent == 0:
+                    raise IOError("%s: unexpected end of file" % (f.name))
+                offset += sent
+                count -= sent
+
+    def send_tar(self, virtualpaths, ArchiveName=None, RateLimit=0, members=None, CacheKey=None):
+        """ Stream the files as a gzip compressed tar archive.
+            members: the ArchiveMembers if they are listed already
+            CacheKey: the key to keep a copy of the archive under in the
+            archive cache """
         if ArchiveName == None:
             ArchiveName = "archive.tar.gz"
 
@@ -975,44 +4612,208 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
         self.send_header("Content-Type", "application/x-tar")
         self.send_header("Content-Disposition", "attachment;filename=\"%s\""
                          % (ArchiveName))
-        self.send_no_cache_header()
-        self.end_headers()
+        self.send_cache_header(CACHE_ARCHIVE)
+        body = self.start_chunked_body()
 
-        if RateLimit == 0:
-            rate_limit = 0 # no limit
+        if self.head_only:
+            return
+
+        # walker and readers -> archiver -> compression -> network writer
+        try:
+            if members is None:
+                members = itertools.chain.from_iterable(
+                    self.archive_members(self.get_local_path(f)) for f in virtualpaths)
+            with self.server.DOWNLOAD_SHAPER.transfer(self.client_address[0],
+                                                      RateLimit) as throttle:
+                sender = QueuedWriter(RateLimitingWriter(body, throttle), ARCHIVE_SEND_QUEUE)
+                output = sender
+                if CacheKey is not None:
+                    output = ArchiveCacheWriter(sender, self.server.ARCHIVE_CACHE, CacheKey)
+                workers = self.server.OPT_GZIP_WORKERS
+                adapter = None
+                if self.server.OPT_ADAPTIVE_GZIP:
+                    adapter = AdaptiveGzipLevel(self.server.OPT_GZIP_LEVEL, workers, sender,
+                                                self.client_address[0])
+                writer = ParallelGzipWriter(output,
+                                            self.server.get_gzip_pool() if workers > 0 else None,
+                                            self.server.OPT_GZIP_LEVEL, 2 * workers,
+                                            adapter, self.server.GZIP_STATS)
+                reader = ArchiveReadAhead(members)
+                try:
+                    reader.write_tar(writer)
+                    writer.close()
+                    if CacheKey is not None and not reader.changed:
+                        output.commit()
+                finally:
+                    if CacheKey is not None:
+                        output.discard() # unless committed
+                    reader.close()
+                    sender.close()
+        except Exception:
+            # the status line is gone already; cut the body short instead
+            self.close_connection = 1
+            raise
+        body.close()
+
+    def get_tar_cache_key(self, members):
+        """ Return the archive cache key of a tar.gz of members, or None if
+            it can't be cached. """
+        if not ArchiveCache.accepts(members):
+            return None
+        return ArchiveCache.key(ARCHIVE_TGZ, members, "level=%d%s" % (
+            self.server.OPT_GZIP_LEVEL, ",adaptive" if self.server.OPT_ADAPTIVE_GZIP else ""))
+
+    def send_archive(self, virtualpaths, format, ArchiveName=None, RateLimit=0):
+        """ Send the files in an uncompressed tar or zip archive. The archive
+            is laid out first, so that its length is known and a download
+            can be resumed with a Range request; the ETag changes with the
+            size, mtime, mode or owner of any file in it.
+            Returns the number of body bytes sent. """
+        members = self.list_archive_members(virtualpaths)
+        if format == ARCHIVE_ZIP:
+            archive = ZipArchive(members, self.server.get_file_crc)
         else:
-            rate_limit = float(RateLimit) / TRANSMIT_CHUNK_SIZE
+            archive = TarArchive(members)
+        return self.send_virtual_archive(archive, format, ArchiveName, RateLimit)
 
-        writer = RateLimitingWriter(self.wfile, rate_limit)
+    def send_virtual_archive(self, archive, format, ArchiveName=None, RateLimit=0):
+        """ Send a VirtualArchive, or the byte range of it that is asked for.
+            Returns the number of body bytes sent. """
+        default_name, content_type = ARCHIVE_FORMATS[format]
+        if ArchiveName == None:
+            ArchiveName = default_name
+        last_modified = self.date_time_string(int(archive.mtime))
+
+        ranges = self.get_requested_ranges(archive.size, last_modified, archive.etag)
+        if ranges == []:
+            self.send_response(HTTP_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", "bytes */%d" % (archive.size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return 0
+
+        if ranges is None or len(ranges) > 1: # several ranges get the whole archive
+            first, length = 0, archive.size
+            self.send_response(HTTP_OK)
+        else:
+            first, last = ranges[0]
+            length = last - first + 1
+            self.send_response(HTTP_PARTIAL_CONTENT)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (first, last, archive.size))
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Content-Disposition", "attachment;filename=\"%s\""
+                         % (ArchiveName))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("ETag", archive.etag)
+        self.send_cache_header(CACHE_ARCHIVE)
+        self.end_headers()
 
-        with tarfile.open(fileobj=writer, mode="w|gz", dereference=True) as tar:
-            for f in virtualpaths:
-                localpath = self.get_local_path(f)
-                self.tar_recursive_add_files(tar, "", localpath)
+        if self.head_only:
+            return 0
 
-    def tar_recursive_add_files(self, tar, prefix, localpath):
+        try:
+            with self.server.DOWNLOAD_SHAPER.transfer(self.client_address[0],
+                                                      RateLimit) as throttle:
+                writer = RateLimitingWriter(self.wfile, throttle)
+                for source, start, count in archive.iter_pieces(first, length):
+                    if isinstance(source, ArchiveMember):
+                        self.copy_archive_member(source, start, count, writer, throttle)
+                    else:
+                        if callable(source):
+                            source = source()
+                        writer.write(source[start:start + count])
+        except Exception:
+            # the headers are gone already; cut the body short instead
+            self.close_connection = 1
+            raise
+        return length
+
+    def copy_archive_member(self, member, offset, length, writer, throttle):
+        """ Send length bytes of the file of an archive member from offset.
+            The size of the file is fixed by the archive layout, so a file
+            found shorter is padded with zeros and a longer one is cut; one
+            that shrinks while it is sent raises IOError, like in send_file(). """
+        available = 0
+        try:
+            f = open(member.path, "rb")
+        except (IOError, OSError) as e:
+            DEBUG("send_archive: " + str(e))
+            f = None
+        if f is not None:
+            with f:
+                available = max(min(os.fstat(f.fileno()).st_size - offset, length), 0)
+                if available > 0:
+                    self.copy_file(f, offset, available, throttle)
+        if available < length:
+            DEBUG("send_archive: %s changed, padding it" % (member.path))
+        left = length - available
+        while left > 0:
+            count = min(SENDFILE_CHUNK_SIZE, left)
+            writer.write("\0" * count)
+            left -= count
+
+    def list_archive_members(self, virtualpaths):
+        members = []
+        for f in virtualpaths:
+            members.extend(self.archive_members(self.get_local_path(f)))
+        return members
+
+    def archive_members(self, localpath):
+        """ Yield an ArchiveMember for every file under localpath, named by
+            its path from localpath's parent. A selected link to a folder is
+            entered; the links below it only with OPT_FOLLOW_LINK. """
         name = suffix(localpath)
-        if is_file(localpath):
-            tar.add(localpath, prefix + name)
-            DEBUG("send_tar: add file " + localpath)
-        elif is_dir(localpath, self.server.OPT_FOLLOW_LINK or (prefix == "")):
-            fileList = os.listdir(localpath)
-            for f in fileList:
-                self.tar_recursive_add_files(tar, prefix + name + "/", \
-                                             os.path.join(localpath, f))
-
-    def send_tar_download(self, id, ArchiveName=None):
+        entry = stat_entry(name, localpath, AllowLink=True)
+        if entry is None:
+            return
+        if entry.is_file:
+            yield ArchiveMember(name, localpath, entry.st)
+        elif entry.is_dir:
+            for path, entry in walk_tree(name, localpath, self.server.OPT_FOLLOW_LINK):
+                if entry.is_file:
+                    yield ArchiveMember(path, entry.path, entry.st)
+
+    def send_tar_download(self, id, format=None, ArchiveName=None):
         if id == None:
+            self.send_html(generate_file_not_found_html("download"))
             return
-        if ArchiveName == None:
-            ArchiveName = "archive.tar.gz"
-
-        fileList = self.server.pop_download(id)
-
-        if len(fileList) != 0:
-            self.send_tar(fileList, ArchiveName, self.server.OPT_RATE_LIMIT)
-        else:
+        if format not in ARCHIVE_FORMATS:
+            format = ARCHIVE_TGZ
+
+        # tar and zip downloads, and tar.gz ones from the archive cache or
+        # with reusable downloads, are kept to be resumed until they expire;
+        # the following GET uses them after a HEAD
+        fileList = self.server.peek_download(id)
+        if len(fileList) == 0:
             self.send_html(generate_file_not_found_html(str("download " + id)))
+        elif format != ARCHIVE_TGZ:
+            self.send_archive(fileList, format, ArchiveName, self.server.OPT_RATE_LIMIT)
+        else:
+            cache = self.server.ARCHIVE_CACHE
+            members = key = None
+            if cache is not None:
+                members = self.list_archive_members(fileList)
+                key = self.get_tar_cache_key(members)
+                cached = (cache.get(key) if key is not None else None)
+                if cached is not None:
+                    DEBUG("Archive Cache: hit " + key)
+                    archive = CachedArchive(ARCHIVE_TGZ, members, *cached)
+                    self.send_virtual_archive(archive, ARCHIVE_TGZ, ArchiveName,
+                                              self.server.OPT_RATE_LIMIT)
+                    return
+            if not self.head_only and not self.server.OPT_REUSABLE_DOWNLOADS:
+                self.server.pop_download(id)
+            self.send_tar(fileList, ArchiveName, self.server.OPT_RATE_LIMIT, members, key)
+
+    def send_cache_header(self, route):
+        """ Send the Cache-Control policy configured for route. """
+        policy = self.server.OPT_CACHE_CONTROL.get(route)
+        if policy is None:
+            self.send_no_cache_header()
+        else:
+            self.send_header("Cache-Control", policy)
 
     def send_no_cache_header(self):
         """ Send HTTP header to prevent browser caching. """
@@ -1049,10 +4850,21 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
             result = ("<tr class='tr_odd'>" if index & 1 else "<tr class = 'tr_even'>")
         else: # don't change the class
             result = "<tr>"
-        for f in fields:
-            result += "<td>" + str(f) + "</td>"
-        result += "</tr>"
-        return result
+        return result + "".join("<td>" + str(f) + "</td>" for f in fields) + "</tr>"
+
+    def generate_view_link(self, virtualpath, DownloadMode, query, text):
+        """ Generate a link to another view of the listing of virtualpath. """
+        if DownloadMode:
+            query = "dlmode=1" + ("&" + query if query else "")
+        link = urllib.quote(PREFIX + virtualpath) + ("?" + query if query else "")
+        return "<a href='%s'>%s</a>" % (link, cgi.escape(text))
+
+    def generate_sort_link(self, virtualpath, DownloadMode, view, sort, text):
+        """ Link a column title to the listing sorted by it. Following the link
+            of the current column reverses the order. """
+        reverse = (view.sort == sort and not view.reverse)
+        return self.generate_view_link(virtualpath, DownloadMode,
+                                       view.query(sort=sort, reverse=reverse, offset=0), text)
 
     def generate_path_links(self, virtualpath):
         node_list = virtualpath.split("/")[1:]
@@ -1069,96 +4881,210 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
                 result += " / " + self.generate_link(path, node)
         return result
 
-    def list_files(self, virtualpath, localpath, ShowCheckbox=False):
-        """ List all the files in html. """
-        i = 1 # this index is used to decide the color of a row
-        body = ""
-
-        if virtualpath == "/":
-            fileList = sorted(self.server.get_shared_files()) # list virtual filesystem root
-            is_root = True
-        else:
-            fileList = sorted(os.listdir(localpath))
-            is_root = False
-
-        body += "<table>"
+    def iter_file_rows(self, virtualpath, localpath, ShowCheckbox=False, view=None):
+        """ List the files of a view of a folder in html, row by row. """
+        view = view or ListingView()
+        yield "<table>"
 
         # table title
-        body += self.generate_table_row(-1, "File", "Size", "Last Modified")
-        body += self.generate_table_row(-1, "", "", "")
-
-        # list subfolders
-        for f in fileList:
+        sort_link = lambda sort, text: self.generate_sort_link(virtualpath, ShowCheckbox,
+                                                               view, sort, text)
+        yield self.generate_table_row(-1, sort_link("name", "File"), sort_link("size", "Size"),
+                                      sort_link("mtime", "Last Modified"))
+        yield self.generate_table_row(-1, "", "", "")
+
+        entries = view.page(self.iter_folder_entries(virtualpath, localpath))
+        for i, entry in enumerate(entries, 1): # the index decides the color of a row
             if ShowCheckbox:
                 chkbox_html = "<input type='checkbox' name='chkfiles[]' value='%s'>" \
-                    % (os.path.join(virtualpath, f))
+                    % (os.path.join(virtualpath, entry.name))
             else:
                 chkbox_html = ""
 
-            local_filename = (self.server.get_shared_file(f) if is_root else os.path.join(localpath, f))
-
-            if is_dir(local_filename, AllowLink=(self.server.OPT_FOLLOW_LINK or is_root)):
-                last_modified = self.date_time_string(os.path.getmtime(local_filename))
-                body += self.generate_table_row(i, chkbox_html + "(DIR) " + \
-                    self.generate_link(os.path.join(virtualpath, f)) \
+            last_modified = self.date_time_string(entry.mtime)
+            if entry.is_dir:
+                yield self.generate_table_row(i, chkbox_html + "(DIR) " + \
+                    self.generate_link(os.path.join(virtualpath, entry.name)) \
                     , "", last_modified)
-                i += 1
-
-        # list files
-        for f in fileList:
-            if ShowCheckbox:
-                chkbox_html = "<input type='checkbox' name='chkfiles[]' value='%s'>" \
-                    % (os.path.join(virtualpath, f))
             else:
-                chkbox_html = ""
-
-            local_filename = (self.server.get_shared_file(f) if is_root else os.path.join(localpath, f))
-            if is_file(local_filename): # is file
-                last_modified = self.date_time_string(os.path.getmtime(local_filename))
-                body += self.generate_table_row(i, chkbox_html + \
-                    self.generate_link(os.path.join(virtualpath, f)) \
-                    , human_readable_size(os.path.getsize(local_filename))
+                yield self.generate_table_row(i, chkbox_html + \
+                    self.generate_link(os.path.join(virtualpath, entry.name)) \
+                    , human_readable_size(entry.size)
                     , last_modified)
-                i += 1
 
-        body += "</table>"
+        yield "</table>"
 
-        return body
+        if view.offset > 0:
+            previous = max(view.offset - view.limit, 0) if view.limit else 0
+            yield self.generate_view_link(virtualpath, ShowCheckbox,
+                                          view.query(offset=previous), "Previous Page") + " "
+        if view.has_more:
+            yield self.generate_view_link(virtualpath, ShowCheckbox,
+                                          view.query(offset=view.offset + view.limit), "Next Page")
 
-    def generate_folder_listing(self, virtualpath, localpath, DownloadMode=False):
-        """ Generate the file listing HTML for a folder. """
+    def list_files(self, virtualpath, localpath, ShowCheckbox=False, view=None):
+        """ List all the files in html. """
+        return "".join(self.iter_file_rows(virtualpath, localpath, ShowCheckbox, view))
+
+    def get_listing_validator(self, virtualpath, localpath):
+        """ Return a value that changes whenever the listing of a folder may
+            have changed, or None if the listing shouldn't be cached. """
+        if virtualpath == "/":
+            return tuple(sorted((name, self.server.get_shared_file(name))
+                                for name in self.server.get_shared_files()))
+        try:
+            st = os.stat(localpath)
+        except OSError:
+            return None
+        if time.time() - st.st_mtime < LISTING_CACHE_SETTLE:
+            return None # may still be changing within the same mtime tick
+        return (st.st_dev, st.st_ino, st.st_mtime)
+
+    def get_listing_view(self):
+        """ Read the offset, limit, sort and order parameters of a listing.
+            Invalid values are ignored; the limit is at most OPT_LISTING_PAGE_SIZE. """
+        def int_param(key):
+            value = self.get_param(key)
+            return int(value) if value and value.isdigit() else 0
+        page_size = self.server.OPT_LISTING_PAGE_SIZE
+        limit = int_param("limit")
+        if page_size and (limit == 0 or limit > page_size):
+            limit = page_size
+        sort = self.get_param("sort")
+        if sort not in LISTING_SORTS:
+            sort = "name"
+        return ListingView(int_param("offset"), limit, sort,
+                           self.get_param("order") == "desc", page_size)
+
+    def send_folder_listing(self, virtualpath, localpath, DownloadMode=False, view=None,
+                            format="html"):
+        """ Send a listing page in one of LISTING_FORMATS from the listing
+            cache, or stream it while it is generated and cache it if it
+            turns out to be small enough. """
+        view = view or ListingView()
+        content_type = LISTING_FORMATS[format]
+        if format == "html":
+            content_type += ";charset=%s" % (get_system_encoding())
+            pieces = self.iter_folder_listing(virtualpath, localpath, DownloadMode, view)
+        elif format == "json":
+            pieces = self.iter_json_listing(virtualpath, localpath, view)
+        else:
+            pieces = self.iter_ndjson_listing(virtualpath, localpath, view)
+
+        cache = self.server.LISTING_CACHE
+        key = ("page", virtualpath, DownloadMode, view.key(), format)
+        validator = self.get_listing_validator(virtualpath, localpath)
+        content = cache.get(key, validator)
+        if content is not None:
+            DEBUG("Listing cache hit: " + virtualpath)
+            self.send_data(content, content_type, route=CACHE_LISTING)
+            return
+        store = lambda pieces: cache.put(key, localpath, validator, "".join(pieces))
+        self.send_stream(record_items(pieces, LISTING_CACHE_MAX_PAGE, store),
+                         content_type, route=CACHE_LISTING)
+
+    def iter_json_listing(self, virtualpath, localpath, view):
+        """ Generate a view of a folder as a JSON object whose entries
+            array holds one object per entry (see FileEntry.to_json). """
+        yield '{"path": %s, "offset": %d, "limit": %d, "sort": %s, "order": %s, "entries": [' \
+            % (json.dumps(virtualpath), view.offset, view.limit, json.dumps(view.sort),
+               json.dumps("desc" if view.reverse else "asc"))
+        sep = "\n"
+        for entry in view.page(self.iter_folder_entries(virtualpath, localpath)):
+            yield sep + json.dumps(entry.to_json(posixpath.join(virtualpath, entry.name)))
+            sep = ",\n"
+        yield '\n], "more": %s}\n' % (json.dumps(view.has_more))
+
+    def iter_ndjson_listing(self, virtualpath, localpath, view):
+        """ Generate a view of a folder with one JSON object per line. """
+        for entry in view.page(self.iter_folder_entries(virtualpath, localpath)):
+            yield json.dumps(entry.to_json(posixpath.join(virtualpath, entry.name))) + "\n"
+
+    def iter_manifest(self, virtualpath, localpath):
+        """ Generate a line of JSON for everything below a folder. """
+        for path, entry in self.walk_folder(virtualpath, localpath):
+            yield json.dumps(entry.to_json(path)) + "\n"
+
+    def walk_folder(self, virtualpath, localpath):
+        """ Yield (virtual path, FileEntry) for everything below a folder
+            (see walk_tree()), including the shared files of the root. """
+        return walk_tree(virtualpath, localpath, read_entries=self.read_folder_entries)
+
+    def get_folder_entries(self, virtualpath, localpath):
+        """ Return the FileEntry list of a folder, directories first, each
+            group sorted by name. """
+        return list(ListingView().select(self.iter_folder_entries(virtualpath, localpath)))
+
+    def iter_folder_entries(self, virtualpath, localpath):
+        """ Yield the entries of a folder in directory order, through the
+            listing cache. Folders with more than LISTING_CACHE_MAX_ENTRIES
+            entries are read again every time. """
+        cache = self.server.LISTING_CACHE
+        key = ("entries", virtualpath)
+        validator = self.get_listing_validator(virtualpath, localpath)
+        entries = cache.get(key, validator)
+        if entries is not None:
+            return iter(entries)
+        store = lambda entries: cache.put(key, localpath, validator, entries)
+        return record_items(self.read_folder_entries(virtualpath, localpath),
+                            LISTING_CACHE_MAX_ENTRIES, store, size=lambda e: 1)
+
+    def read_folder_entries(self, virtualpath, localpath):
+        """ Read the entries of a folder for iter_folder_entries(). Entries
+            that are neither files nor directories (e.g. sockets, or links to
+            directories without OPT_FOLLOW_LINK) are dropped. """
+        if virtualpath == "/": # list virtual filesystem root
+            entries = (stat_entry(name, self.server.get_shared_file(name), AllowLink=True)
+                       for name in self.server.get_shared_files())
+        else:
+            entries = scan_dir(localpath, AllowLink=self.server.OPT_FOLLOW_LINK)
+        return (e for e in entries if e is not None and (e.is_dir or e.is_file))
+
+    def iter_folder_listing(self, virtualpath, localpath, DownloadMode=False, view=None):
+        """ Generate the file listing HTML for a folder piece by piece. """
 
         sep = "&nbsp;&nbsp;&nbsp;"
 
-        body = "<form name='frmfiles' onsubmit='return check_selected()' action='%s?r=%s' method='POST'>" \
+        head, tail = generate_folder_listing_html_parts()
+        yield head
+
+        yield "<form name='frmfiles' onsubmit='return check_selected()' action='%s?r=%s' method='POST'>" \
                 % (DOWNLOAD_TAR_PREFIX, PREFIX + virtualpath)
 
-        body += self.generate_path_links(virtualpath)
+        yield self.generate_path_links(virtualpath)
 
         if DownloadMode: # Show download button
-            body += "<input type='submit' name='download_tar' value='Download Tar'/>"
-            body += "<input type='button' onclick='select_all()' value='Select All'/>"
-            body += "<input type='button' onclick='reverse_all()' value='Reverse Selection'/>"
-            body += sep + "<a href='%s'>Back</a>" % (PREFIX + virtualpath) + "<br>"
+            yield "<select name='format'>"
+            for format in ARCHIVE_FORMATS:
+                yield "<option value='%s'>%s</option>" % (format, ARCHIVE_FORMATS[format][0])
+            yield "</select>"
+            yield "<input type='submit' name='download_tar' value='Download'/>"
+            yield "<input type='button' onclick='select_all()' value='Select All'/>"
+            yield "<input type='button' onclick='reverse_all()' value='Reverse Selection'/>"
+            yield sep + "<a href='%s'>Back</a>" % (PREFIX + virtualpath) + "<br>"
         else:   # Show navigation links and current path.
-            #body += self.generate_parent_link(virtualpath)
-            body += "<div align='right'>"
+            #yield self.generate_parent_link(virtualpath)
+            yield "<div align='right'>"
             if self.server.UPLOAD_PATH:
-                body += "<a href='%s'>Goto Upload Page</a>" % (UPLOAD_PREFIX) + sep
+                yield "<a href='%s'>Goto Upload Page</a>" % (UPLOAD_PREFIX) + sep
             if self.server.OPT_ALLOW_DOWNLOAD_TAR:
-                body += self.generate_dlmode_link(virtualpath)
-            body += "</div>"
+                yield self.generate_dlmode_link(virtualpath)
+            yield "</div>"
 
-        body += "<hr><br>"
+        yield "<hr><br>"
 
         allow_link = (self.server.OPT_FOLLOW_LINK or strip_suffix(virtualpath) == "/")
         if len(localpath) == 0 or is_dir(localpath, AllowLink=allow_link):
-            body += self.list_files(virtualpath, localpath, ShowCheckbox=DownloadMode)
+            for row in self.iter_file_rows(virtualpath, localpath, DownloadMode, view):
+                yield row
 
-        body += "<hr>"
-        body += "</form>"
+        yield "<hr>"
+        yield "</form>"
+        yield tail
 
-        return generate_folder_listing_html(body)
+    def generate_folder_listing(self, virtualpath, localpath, DownloadMode=False, view=None):
+        """ Generate the file listing HTML for a folder. """
+        return "".join(self.iter_folder_listing(virtualpath, localpath, DownloadMode, view))
 
     def get_param(self, key):
         if key in self.__params:
@@ -1183,6 +5109,505 @@ class MyServiceHandler(SimpleHTTPRequestHandler):
                     key, value = (pair, "")
                 self.__params[key] = value
 
+###### Asynchronous Engine ######
+
+class LoopReader:
+    """ rfile of a request served by the async engine.
+        The event loop feeds the data received from the socket and the
+        worker thread reads it as if it were a blocking file. """
+
+    def __init__(self, wakeup):
+        self.__cond = threading.Condition()
+        self.__chunks = collections.deque()
+        self.__size = 0
+        self.__wanted = 0 # bytes a blocked read() is waiting for
+        self.__eof = False
+        self.__wakeup = wakeup
+
+    # called by the event loop
+
+    def feed(self, data):
+        with self.__cond:
+            self.__chunks.append(data)
+            self.__size += len(data)
+            self.__cond.notify()
+
+    def feed_eof(self):
+        with self.__cond:
+            self.__eof = True
+            self.__cond.notify()
+
+    def wants_data(self):
+        with self.__cond:
+            return not self.__eof and self.__size < max(LOOP_BUFFER_SIZE, self.__wanted)
+
+    def is_finished(self):
+        """ Whether the client has closed and all its data has been read. """
+        with self.__cond:
+            return self.__eof and self.__size == 0
+
+    def has_request_head(self):
+        """ Whether the buffered data holds a complete request head. """
+        with self.__cond:
+            if self.__eof or self.__size >= LOOP_MAX_HEAD_SIZE:
+                return True
+            data = "".join(self.__chunks)
+            self.__chunks = collections.deque([data])
+            return "\r\n\r\n" in data or "\n\n" in data
+
+    # called by the worker thread
+
+    def __wait(self, ready, wanted=0):
+        if ready() or self.__eof:
+            return
+        self.__wanted = wanted
+        self.__wakeup() # the loop may have stopped reading at LOOP_BUFFER_SIZE
+        try:
+            while not ready() and not self.__eof:
+                t0 = time.time()
+                self.__cond.wait(LOOP_IO_TIMEOUT)
+                if time.time() - t0 >= LOOP_IO_TIMEOUT and not ready():
+                    raise socket.timeout("timed out")
+        finally:
+            self.__wanted = 0
+
+    def __take(self, size):
+        result = []
+        while size > 0 and self.__chunks:
+            chunk = self.__chunks.popleft()
+            if len(chunk) > size:
+                self.__chunks.appendleft(chunk[size:])
+                chunk = chunk[:size]
+            result.append(chunk)
+            size -= len(chunk)
+            self.__size -= len(chunk)
+        self.__wakeup() # there may be room to receive more
+        return "".join(result)
+
+    def read(self, size=-1):
+        with self.__cond:
+            if size < 0:
+                self.__wait(lambda: False, sys.maxsize)
+                return self.__take(self.__size)
+            self.__wait(lambda: self.__size >= size, size)
+            return self.__take(min(size, self.__size))
+
+    def readline(self, limit=-1):
+        with self.__cond:
+            def line_end():
+                if len(self.__chunks) > 1:
+                    self.__chunks = collections.deque(["".join(self.__chunks)])
+                index = (self.__chunks[0].find("\n") if self.__chunks else -1)
+                if index < 0 and 0 <= limit <= self.__size:
+                    return limit
+                return (index + 1 if index >= 0 else 0)
+            self.__wait(lambda: line_end() > 0, (limit if limit >= 0 else sys.maxsize))
+            end = line_end() or self.__size
+            if limit >= 0:
+                end = min(end, limit)
+            return self.__take(end)
+
+    def close(self):
+        pass
+
+class LoopWriter:
+    """ wfile of a request served by the async engine.
+        The worker thread queues data and file segments; the event loop
+        sends them. write() blocks while too much data is waiting. """
+
+    def __init__(self, wakeup):
+        self.__cond = threading.Condition()
+        self.__items = collections.deque()
+        self.__size = 0
+        self.__aborted = False
+        self.__wakeup = wakeup
+        self.closed = False
+
+    # called by the worker thread
+
+    def write(self, data):
+        if not data:
+            return
+        with self.__cond:
+            while self.__size >= LOOP_BUFFER_SIZE and not self.__aborted:
+                t0 = time.time()
+                self.__cond.wait(LOOP_IO_TIMEOUT)
+                if time.time() - t0 >= LOOP_IO_TIMEOUT:
+                    raise socket.timeout("timed out")
+            if self.__aborted:
+                raise socket.error(errno.EPIPE, "connection closed")
+            self.__items.append(str(data))
+            self.__size += len(data)
+        self.__wakeup()
+
+    def defer_file(self, f, offset, length, throttle):
+        """ Queue length bytes of the opened file f from offset. The event
+            loop sends them after the preceding data, so the worker thread
+            does not wait for slow clients. """
+        fobj = os.fdopen(os.dup(f.fileno()), "rb")
+        throttle.retain()
+        with self.__cond:
+            if self.__aborted:
+                fobj.close()
+                throttle.release()
+                raise socket.error(errno.EPIPE, "connection closed")
+            self.__items.append(FileSegment(fobj, offset, length, throttle))
+        self.__wakeup()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.__cond:
+            self.closed = True
+        self.__wakeup()
+
+    # called by the event loop
+
+    def has_data(self):
+        with self.__cond:
+            return len(self.__items) > 0
+
+    def pop(self):
+        """ Return the next string or FileSegment, or None. """
+        with self.__cond:
+            if not self.__items:
+                return None
+            item = self.__items.popleft()
+            if not isinstance(item, FileSegment):
+                self.__size -= len(item)
+                self.__cond.notify()
+            return item
+
+    def abort(self):
+        """ The connection is gone: fail the writer and drop the queue. """
+        with self.__cond:
+            self.__aborted = True
+            self.closed = True
+            for item in self.__items:
+                if isinstance(item, FileSegment):
+                    item.close()
+            self.__items.clear()
+            self.__size = 0
+            self.__cond.notify_all()
+
+class FileSegment:
+    """ A part of a file waiting to be sent by the event loop. """
+
+    def __init__(self, f, offset, length, throttle):
+        self.file = f
+        self.offset = offset
+        self.left = length
+        self.throttle = throttle
+
+    def close(self):
+        self.file.close()
+        self.throttle.release()
+
+class AsyncConnection(asyncore.dispatcher):
+    """ A client connection of AsyncHttpFileServer.
+        The event loop reads the request head, hands the request over to a
+        worker thread, and then moves data between the socket and the
+        worker. File bodies are sent by the loop itself. """
+
+    def __init__(self, sock, client_address, server, map, has_slot=True):
+        """ @param has_slot whether the connection was counted by
+                   server.acquire_client_slot() """
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.client_address = client_address
+        self.server = server
+        self.has_slot = has_slot
+        self.reader = LoopReader(server.wakeup)
+        self.writer = LoopWriter(server.wakeup)
+        self.dispatched = False
+        self.requests_served = 0
+        self.idle_since = time.time()
+        self.__pending = "" # data taken from the writer but not sent yet
+        self.__segment = None # FileSegment being sent
+        self.__credit = 0 # bytes of the segment paid to its throttle
+        self.resume_at = 0 # time when a throttled segment may continue
+
+    def readable(self):
+        return self.reader.wants_data()
+
+    def writable(self):
+        if self.__pending:
+            return True
+        if self.__segment is not None:
+            return self.resume_at <= time.time()
+        return self.writer.closed or self.writer.has_data()
+
+    def handle_read(self):
+        try:
+            data = self.socket.recv(LOOP_BUFFER_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        if data:
+            self.reader.feed(data)
+        else:
+            self.reader.feed_eof()
+        self.check_request()
+
+    def check_request(self):
+        """ Dispatch the next request once its head has arrived. """
+        if self.dispatched or not self.reader.has_request_head():
+            return
+        if self.reader.is_finished(): # closed by the client between requests
+            self.writer.close()
+            return
+        self.dispatched = True
+        self.server.dispatch(self)
+
+    def request_done(self):
+        """ The worker has finished a request and the connection is kept. """
+        self.dispatched = False
+        self.idle_since = time.time()
+        self.check_request()
+
+    def is_idle(self):
+        """ Waiting for a request with nothing left to send. """
+        return not self.dispatched and not self.__pending \
+            and self.__segment is None and not self.writer.has_data()
+
+    def handle_write(self):
+        while True:
+            if self.__pending:
+                sent = self.send(self.__pending)
+                self.__pending = self.__pending[sent:]
+                if self.__pending:
+                    return
+            elif self.__segment is not None:
+                if not self.send_segment():
+                    return
+            else:
+                item = self.writer.pop()
+                if item is None:
+                    break
+                elif isinstance(item, FileSegment):
+                    self.__segment = item
+                else:
+                    self.__pending = item
+
+        if self.writer.closed and not self.writer.has_data():
+            self.handle_close()
+
+    def send_segment(self):
+        """ Send a piece of the current file segment.
+            Returns False if the socket or the throttle is not ready. """
+        seg = self.__segment
+        if self.resume_at > time.time():
+            return False
+        if seg.left == 0:
+            seg.close()
+            self.__segment = None
+            return True
+        if self.__credit == 0:
+            self.__credit = min(seg.throttle.quantum, seg.left)
+            delay = seg.throttle.reserve(self.__credit)
+            if delay > 0:
+                self.resume_at = time.time() + delay
+                return False
+        count = min(self.__credit, seg.left)
+        if sendfile is not None:
+            try:
+                sent = sendfile(self.socket.fileno(), seg.file.fileno(), seg.offset, count)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return False
+                raise
+            if sent == 0:
+                raise IOError("%s: unexpected end of file" % (seg.file.name))
+        else:
+            seg.file.seek(seg.offset)
+            data = seg.file.read(min(count, LOOP_BUFFER_SIZE))
+            if not data:
+                raise IOError("%s: unexpected end of file" % (seg.file.name))
+            self.__pending = data[self.send(data):]
+            sent = len(data)
+        seg.offset += sent
+        seg.left -= sent
+        self.__credit -= sent
+        return not self.__pending
+
+    def reject(self, message):
+        """ Send 503 and close without handing the request to a worker. """
+        self.dispatched = True
+        self.reader.feed_eof()
+        self.writer.write(generate_service_unavailable_response(message))
+        self.writer.close()
+
+    def handle_close(self):
+        self.reader.feed_eof()
+        self.writer.abort()
+        if self.__segment is not None:
+            self.__segment.close()
+            self.__segment = None
+        if self.has_slot:
+            self.server.release_client_slot(self.client_address[0])
+            self.has_slot = False
+        self.close()
+
+    def handle_error(self):
+        DEBUG("Async connection %s: %s" % (self.client_address[0], traceback.format_exc()))
+        self.handle_close()
+
+class AsyncListener(asyncore.dispatcher):
+    """ Accept connections on the listening socket of the server. """
+
+    def __init__(self, server, map):
+        asyncore.dispatcher.__init__(self, server.socket, map)
+        self.accepting = True
+        self.server = server
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair is not None:
+            self.server.accept_connection(*pair)
+
+    def handle_error(self):
+        DEBUG("Async listener: " + traceback.format_exc())
+
+def make_socket_pair():
+    """ Return a pair of connected sockets. """
+    try:
+        return socket.socketpair()
+    except (AttributeError, socket.error): # not available on Windows
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(1)
+            a = socket.create_connection(listener.getsockname())
+            b = listener.accept()[0]
+            return a, b
+        finally:
+            listener.close()
+
+class AsyncWaker(asyncore.dispatcher):
+    """ A socket pair used by worker threads to wake up the event loop. """
+
+    def __init__(self, map):
+        rsock, self.__wsock = make_socket_pair()
+        asyncore.dispatcher.__init__(self, rsock, map)
+        self.__wsock.setblocking(False)
+
+    def wakeup(self):
+        try:
+            self.__wsock.send("x")
+        except socket.error: # the buffer is full, so the loop will wake up anyway
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.socket.recv(4096)
+        except socket.error:
+            pass
+
+class AsyncHttpFileServer(HttpFileServer):
+    """ HttpFileServer driven by a single event loop thread.
+        Connections are multiplexed with poll(); a request is handed to a
+        small pool of worker threads once its head has arrived. Workers do
+        the blocking work (directory listing, tar generation, uploads) while
+        file downloads are sent by the loop, so idle and slow clients do not
+        hold a thread. """
+
+    def __init__(self, server_address):
+        HttpFileServer.__init__(self, server_address)
+        self.__map = {}
+        self.__waker = AsyncWaker(self.__map)
+        AsyncListener(self, self.__map)
+        self.__finished = collections.deque() # connections to hand back to the loop
+        self.__shutdown_request = False
+        self.__is_shut_down = threading.Event()
+        self.__is_shut_down.set()
+
+    def wakeup(self):
+        self.__waker.wakeup()
+
+    def accept_connection(self, sock, client_address):
+        client = client_address[0]
+        if not self.acquire_client_slot(client):
+            WRITE_LOG(_("Too many connections, request rejected"), client)
+            connection = AsyncConnection(sock, client_address, self, self.__map, False)
+            connection.reject(_("Too many connections from your address."))
+        else:
+            AsyncConnection(sock, client_address, self, self.__map)
+
+    def dispatch(self, connection):
+        if not self.get_worker_pool().submit(self.process_async_request, connection):
+            WRITE_LOG(_("Server busy, request rejected"), connection.client_address[0])
+            connection.reject(_("The server is busy. Please try again later."))
+
+    def process_async_request(self, connection):
+        handler = None
+        try:
+            handler = AsyncServiceHandler(connection, connection.client_address, self)
+        finally:
+            connection.requests_served += 1
+            if handler is None or handler.close_connection:
+                connection.writer.close()
+            else: # keep-alive: the loop waits for the next request
+                self.__finished.append(connection)
+                self.wakeup()
+
+    def serve_forever(self, poll_interval=0.5):
+        self.__is_shut_down.clear()
+        try:
+            while not self.__shutdown_request:
+                asyncore.loop(timeout=self.next_timeout(poll_interval), use_poll=True,
+                              map=self.__map, count=1)
+                while self.__finished:
+                    self.__finished.popleft().request_done()
+        finally:
+            self.__shutdown_request = False
+            self.__is_shut_down.set()
+
+    def next_timeout(self, poll_interval):
+        """ Close connections idle for longer than OPT_KEEPALIVE_TIMEOUT, and
+            sleep no longer than until the first throttled connection resumes. """
+        now = time.time()
+        timeout = poll_interval
+        for obj in self.__map.values():
+            if not isinstance(obj, AsyncConnection):
+                continue
+            if obj.resume_at > now:
+                timeout = min(timeout, obj.resume_at - now)
+            if self.OPT_KEEPALIVE_TIMEOUT and obj.is_idle() \
+                    and now - obj.idle_since > self.OPT_KEEPALIVE_TIMEOUT:
+                obj.handle_close()
+        return timeout
+
+    def shutdown(self):
+        self.__shutdown_request = True
+        self.wakeup()
+        self.__is_shut_down.wait()
+
+class AsyncServiceHandler(MyServiceHandler):
+    """ MyServiceHandler running on a worker thread of AsyncHttpFileServer.
+        The socket is owned by the event loop; the handler talks to it
+        through the LoopReader and LoopWriter of the connection. """
+
+    def setup(self):
+        self.connection = self.request.socket
+        self.rfile = self.request.reader
+        self.wfile = self.request.writer
+        self.requests_served = self.request.requests_served
+
+    def handle(self):
+        """ Serve a single request; the event loop waits for the next one. """
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def finish(self):
+        pass # AsyncHttpFileServer.process_async_request() closes the writer
+
 if __name__ == "__main__":
     """ Parse command line option """
     OPT_PORT = 8000
@@ -1192,7 +5617,33 @@ if __name__ == "__main__":
     OPT_UPLOAD_PATH = None
     OPT_RATE_LIMIT = 1024 * 10
     OPT_UPLOAD_RATE_LIMIT = 1024 * 10
+    OPT_GLOBAL_RATE_LIMIT = 0
+    OPT_CLIENT_RATE_LIMIT = 0
+    OPT_GLOBAL_UPLOAD_RATE_LIMIT = 0
+    OPT_CLIENT_UPLOAD_RATE_LIMIT = 0
     OPT_FORCE_SAVE = False
+    OPT_ENGINE = ENGINE_THREADED
+    OPT_WORKERS = 32
+    OPT_ACCEPT_QUEUE = 64
+    OPT_MAX_CLIENT_CONNECTIONS = 0
+    OPT_KEEPALIVE_TIMEOUT = 15
+    OPT_MAX_KEEPALIVE_REQUESTS = 100
+    OPT_LISTING_CACHE_SIZE = LISTING_CACHE_SIZE
+    OPT_ENABLE_STATUS = False
+    OPT_LISTING_PAGE_SIZE = LISTING_PAGE_SIZE
+    OPT_UPLOAD_CONCURRENCY = UPLOAD_CONCURRENCY
+    OPT_UPLOAD_STREAMS = UPLOAD_STREAMS
+    OPT_DIGEST = DIGEST_ALGORITHM
+    OPT_DIGEST_CACHE = None
+    OPT_DEDUP = False
+    OPT_GZIP_WORKERS = GZIP_WORKERS
+    OPT_GZIP_LEVEL = GZIP_LEVEL
+    OPT_ADAPTIVE_GZIP = False
+    OPT_ARCHIVE_CACHE = None
+    OPT_ARCHIVE_CACHE_SIZE = ARCHIVE_CACHE_SIZE
+    OPT_DOWNLOAD_TTL = DOWNLOAD_TTL
+    OPT_MAX_DOWNLOADS = DOWNLOAD_MAX_ENTRIES
+    OPT_REUSABLE_DOWNLOADS = False
 
     parser = argparse.ArgumentParser(
             description="Share your files across the Internet.")
@@ -1209,8 +5660,72 @@ if __name__ == "__main__":
     parser.add_argument('--upload-path', type=str, default=OPT_UPLOAD_PATH)
     parser.add_argument('--upload-rate-limit', type=int, default=OPT_UPLOAD_RATE_LIMIT,
                         help="single file upload rate limit in KB/s")
+    parser.add_argument('--global-rate-limit', type=int, default=OPT_GLOBAL_RATE_LIMIT,
+                        help="total download rate limit of the server in KB/s; 0 means no limit")
+    parser.add_argument('--client-rate-limit', type=int, default=OPT_CLIENT_RATE_LIMIT,
+                        help="download rate limit of each client address in KB/s; 0 means no limit")
+    parser.add_argument('--global-upload-rate-limit', type=int, default=OPT_GLOBAL_UPLOAD_RATE_LIMIT,
+                        help="total upload rate limit of the server in KB/s; 0 means no limit")
+    parser.add_argument('--client-upload-rate-limit', type=int, default=OPT_CLIENT_UPLOAD_RATE_LIMIT,
+                        help="upload rate limit of each client address in KB/s; 0 means no limit")
+    parser.add_argument('--upload-concurrency', type=int, default=OPT_UPLOAD_CONCURRENCY,
+                        help="files the upload page sends at the same time")
+    parser.add_argument('--upload-streams', type=int, default=OPT_UPLOAD_STREAMS,
+                        help="pieces of one file the upload page sends in parallel")
+    parser.add_argument('--digest', type=str, default=OPT_DIGEST,
+                        choices=list(DIGEST_ALGORITHMS.keys()) + ["none"],
+                        help="digest sent with downloads in Repr-Digest")
+    parser.add_argument('--digest-cache', type=str, default=OPT_DIGEST_CACHE,
+                        help="file keeping the digests of shared files across restarts, "
+                             "e.g. ~/.cache/hfs/digests.json (default: keep them in memory)")
+    parser.add_argument('--dedup', action="store_true", default=OPT_DEDUP,
+                        help="store each distinct uploaded content once, with hard links")
+    parser.add_argument('--gzip-workers', type=int, default=OPT_GZIP_WORKERS,
+                        help="threads compressing tar downloads; 0 compresses in the "
+                             "request thread (default: number of CPUs)")
+    parser.add_argument('--gzip-level', type=int, default=OPT_GZIP_LEVEL,
+                        choices=range(1, 10), metavar="{1..9}",
+                        help="gzip compression level of tar downloads")
+    parser.add_argument('--adaptive-gzip', action="store_true", default=OPT_ADAPTIVE_GZIP,
+                        help="adapt the gzip level of each tar download, from 0 (stored) to 9, "
+                             "to the speed of the client and of the compression, starting "
+                             "from --gzip-level")
+    parser.add_argument('--archive-cache', type=str, default=OPT_ARCHIVE_CACHE,
+                        help="directory keeping generated tar.gz downloads to send them "
+                             "again (default: none)")
+    parser.add_argument('--archive-cache-size', type=int, default=OPT_ARCHIVE_CACHE_SIZE,
+                        help="size limit of the archive cache in MiB")
+    parser.add_argument('--download-ttl', type=int, default=OPT_DOWNLOAD_TTL,
+                        help="seconds a posted archive download is kept after it was last used")
+    parser.add_argument('--max-downloads', type=int, default=OPT_MAX_DOWNLOADS,
+                        help="posted archive downloads kept; the least recently used are dropped")
+    parser.add_argument('--reusable-downloads', action="store_true", default=OPT_REUSABLE_DOWNLOADS,
+                        help="let a tar.gz download be fetched again or in parallel until it "
+                             "expires, like tar and zip downloads")
     parser.add_argument('-s', '--force-save', action="store_true", default=OPT_FORCE_SAVE,
                         help="prevent the browser from opening the file directly")
+    parser.add_argument('--cache-control', type=str, action="append", default=[],
+                        metavar="ROUTE=POLICY",
+                        help="Cache-Control header for ROUTE (one of %s); may be repeated"
+                        % (", ".join(CACHE_ROUTES)))
+    parser.add_argument('--engine', type=str, choices=ENGINES, default=OPT_ENGINE,
+                        help="serve clients with a thread each (threaded) or with an event loop (async)")
+    parser.add_argument('--workers', type=int, default=OPT_WORKERS,
+                        help="number of worker threads; 0 starts a thread for every connection")
+    parser.add_argument('--accept-queue', type=int, default=OPT_ACCEPT_QUEUE,
+                        help="connections waiting for a worker before new ones get 503")
+    parser.add_argument('--max-client-connections', type=int, default=OPT_MAX_CLIENT_CONNECTIONS,
+                        help="open connections allowed per client address; 0 means no limit")
+    parser.add_argument('--keepalive-timeout', type=int, default=OPT_KEEPALIVE_TIMEOUT,
+                        help="seconds an idle persistent connection is kept open; 0 means forever")
+    parser.add_argument('--max-keepalive-requests', type=int, default=OPT_MAX_KEEPALIVE_REQUESTS,
+                        help="requests served on a connection before it is closed; 0 means no limit")
+    parser.add_argument('--listing-cache-size', type=int, default=OPT_LISTING_CACHE_SIZE,
+                        help="directory listings kept in memory; 0 disables the listing cache")
+    parser.add_argument('--listing-page-size', type=int, default=OPT_LISTING_PAGE_SIZE,
+                        help="entries shown on one page of a directory listing; 0 means no limit")
+    parser.add_argument('--enable-status', action="store_true", default=OPT_ENABLE_STATUS,
+                        help="show server counters at %s" % (STATUS_PREFIX))
     parser.add_argument('--debug', action="store_true", default=False,
                         help="print debug messages")
     args = parser.parse_args()
@@ -1222,7 +5737,51 @@ if __name__ == "__main__":
     OPT_UPLOAD_PATH = args.upload_path
     OPT_RATE_LIMIT = args.rate_limit
     OPT_UPLOAD_RATE_LIMIT = args.upload_rate_limit
+    OPT_GLOBAL_RATE_LIMIT = args.global_rate_limit
+    OPT_CLIENT_RATE_LIMIT = args.client_rate_limit
+    OPT_GLOBAL_UPLOAD_RATE_LIMIT = args.global_upload_rate_limit
+    OPT_CLIENT_UPLOAD_RATE_LIMIT = args.client_upload_rate_limit
     OPT_FORCE_SAVE = args.force_save
+    OPT_ENGINE = args.engine
+    OPT_WORKERS = args.workers
+    OPT_ACCEPT_QUEUE = args.accept_queue
+    OPT_MAX_CLIENT_CONNECTIONS = args.max_client_connections
+    OPT_KEEPALIVE_TIMEOUT = args.keepalive_timeout
+    OPT_MAX_KEEPALIVE_REQUESTS = args.max_keepalive_requests
+    OPT_LISTING_CACHE_SIZE = args.listing_cache_size
+    OPT_ENABLE_STATUS = args.enable_status
+    OPT_LISTING_PAGE_SIZE = args.listing_page_size
+    OPT_UPLOAD_CONCURRENCY = args.upload_concurrency
+    OPT_UPLOAD_STREAMS = args.upload_streams
+    OPT_DIGEST = (None if args.digest == "none" else args.digest)
+    OPT_DIGEST_CACHE = (os.path.expanduser(args.digest_cache) if args.digest_cache else None)
+    OPT_DEDUP = args.dedup
+    OPT_GZIP_WORKERS = args.gzip_workers
+    OPT_GZIP_LEVEL = args.gzip_level
+    OPT_ADAPTIVE_GZIP = args.adaptive_gzip
+    OPT_ARCHIVE_CACHE = (os.path.expanduser(args.archive_cache) if args.archive_cache else None)
+    OPT_ARCHIVE_CACHE_SIZE = args.archive_cache_size
+    OPT_DOWNLOAD_TTL = args.download_ttl
+    OPT_MAX_DOWNLOADS = args.max_downloads
+    OPT_REUSABLE_DOWNLOADS = args.reusable_downloads
+    if OPT_WORKERS < 0:
+        parser.error("--workers can't be negative")
+    if OPT_ACCEPT_QUEUE < 1:
+        parser.error("--accept-queue must be at least 1")
+    if OPT_DEDUP and not hasattr(os, "link"):
+        parser.error("--dedup needs hard links, which this system lacks")
+    if OPT_ARCHIVE_CACHE_SIZE < 1:
+        parser.error("--archive-cache-size must be at least 1 MiB")
+    if OPT_DOWNLOAD_TTL < 1:
+        parser.error("--download-ttl must be at least 1 second")
+    if OPT_MAX_DOWNLOADS < 1:
+        parser.error("--max-downloads must be at least 1")
+    OPT_CACHE_CONTROL = dict(DEFAULT_CACHE_CONTROL)
+    for item in args.cache_control:
+        route, sep, policy = item.partition("=")
+        if route not in CACHE_ROUTES or not sep:
+            parser.error("invalid --cache-control value: %s" % (item))
+        OPT_CACHE_CONTROL[route] = policy
     if not PREFIX.startswith('/'):
         PREFIX = '/' + PREFIX
     if PREFIX.endswith('/'):
@@ -1236,8 +5795,12 @@ if __name__ == "__main__":
             "Warning: Upload path" + OPT_UPLOAD_PATH + " is not a folder.")
 
     """ server """
+    server = None
     try:
-        server = HttpFileServer(('', OPT_PORT))
+        if OPT_ENGINE == ENGINE_ASYNC:
+            server = AsyncHttpFileServer(('', OPT_PORT))
+        else:
+            server = HttpFileServer(('', OPT_PORT))
         server.daemon_threads = True
 
         for f in FILES:
@@ -1251,7 +5814,36 @@ if __name__ == "__main__":
         server.UPLOAD_PATH = OPT_UPLOAD_PATH
         server.OPT_RATE_LIMIT = OPT_RATE_LIMIT * 1024
         server.OPT_UPLOAD_RATE_LIMIT = OPT_UPLOAD_RATE_LIMIT * 1024
+        server.DOWNLOAD_SHAPER.set_rates(OPT_GLOBAL_RATE_LIMIT * 1024,
+                                         OPT_CLIENT_RATE_LIMIT * 1024)
+        server.UPLOAD_SHAPER.set_rates(OPT_GLOBAL_UPLOAD_RATE_LIMIT * 1024,
+                                       OPT_CLIENT_UPLOAD_RATE_LIMIT * 1024)
         server.OPT_FORCE_SAVE = OPT_FORCE_SAVE
+        server.OPT_CACHE_CONTROL = OPT_CACHE_CONTROL
+        server.OPT_WORKERS = OPT_WORKERS
+        server.OPT_ACCEPT_QUEUE = OPT_ACCEPT_QUEUE
+        server.OPT_MAX_CLIENT_CONNECTIONS = OPT_MAX_CLIENT_CONNECTIONS
+        server.OPT_KEEPALIVE_TIMEOUT = OPT_KEEPALIVE_TIMEOUT
+        server.OPT_MAX_KEEPALIVE_REQUESTS = OPT_MAX_KEEPALIVE_REQUESTS
+        server.LISTING_CACHE.max_records = OPT_LISTING_CACHE_SIZE
+        server.OPT_ENABLE_STATUS = OPT_ENABLE_STATUS
+        server.OPT_LISTING_PAGE_SIZE = OPT_LISTING_PAGE_SIZE
+        server.OPT_UPLOAD_CONCURRENCY = OPT_UPLOAD_CONCURRENCY
+        server.OPT_UPLOAD_STREAMS = OPT_UPLOAD_STREAMS
+        server.OPT_DIGEST = OPT_DIGEST
+        if OPT_DIGEST and OPT_DIGEST_CACHE:
+            server.DIGEST_CACHE.open(OPT_DIGEST_CACHE)
+        server.OPT_GZIP_WORKERS = OPT_GZIP_WORKERS
+        server.OPT_GZIP_LEVEL = OPT_GZIP_LEVEL
+        server.OPT_ADAPTIVE_GZIP = OPT_ADAPTIVE_GZIP
+        if OPT_DEDUP and OPT_UPLOAD_PATH:
+            server.OBJECT_STORE = ObjectStore(OPT_UPLOAD_PATH)
+        if OPT_ARCHIVE_CACHE:
+            server.ARCHIVE_CACHE = ArchiveCache(OPT_ARCHIVE_CACHE,
+                                                OPT_ARCHIVE_CACHE_SIZE * 1024 * 1024)
+        server.DOWNLOADS.ttl = OPT_DOWNLOAD_TTL
+        server.DOWNLOADS.max_entries = OPT_MAX_DOWNLOADS
+        server.OPT_REUSABLE_DOWNLOADS = OPT_REUSABLE_DOWNLOADS
 
         WRITE_LOG(_("Server started on port %d") % (OPT_PORT))
         DEBUG("System Language: " + locale.getdefaultlocale()[0])
@@ -1269,5 +5861,7 @@ if __name__ == "__main__":
             DEBUG(e)
         sys.exit(1)
     except KeyboardInterrupt:
+        if server is not None:
+            server.DIGEST_CACHE.save() # digests not saved by the timer yet
         sys.stderr.write(_("Server Terminated") + "\n")
         sys.exit(0)